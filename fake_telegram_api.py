@@ -0,0 +1,211 @@
+"""Локальная заглушка Telegram Bot API для нагрузочного тестирования бота.
+
+Запуск:
+    python fake_telegram_api.py --port 8081 --latency 0.05 --rate-limit 0.01
+
+Бот подключается к ней через переменную окружения TELEGRAM_API_URL=http://127.0.0.1:8081.
+Счётчики по методам: GET /_stats (сброс - DELETE /_stats).
+Входящие апдейты для getUpdates: POST /_updates (один апдейт или список).
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+# Диапазоны значений анимированных эмодзи sendDice
+DICE_RANGES = {'🎲': 6, '🎯': 6, '🎳': 6, '🏀': 5, '⚽': 5, '🎰': 64}
+
+MESSAGE_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendVideo', 'sendDice', 'sendSticker', 'sendAnimation',
+    'sendVoice', 'sendVideoNote', 'sendDocument', 'editMessageText', 'editMessageCaption',
+    'editMessageReplyMarkup',
+}
+
+
+class FakeTelegramAPI:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit: float = 0.0,
+                 retry_after: int = 1, blocked: float = 0.0, max_rps: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.blocked = blocked
+        self.max_rps = max_rps
+
+        self.message_ids = itertools.count(1)
+        self.update_ids = itertools.count(1)
+        self.updates = asyncio.Queue()
+        self.recent_sends = deque()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.started_at = time.monotonic()
+        self.stats = defaultdict(lambda: {'calls': 0, 'ok': 0, 'retry_after': 0, 'forbidden': 0})
+
+    # ===== ОТВЕТЫ =====
+
+    def ok(self, result):
+        return web.json_response({'ok': True, 'result': result})
+
+    def error(self, code: int, description: str, parameters: dict = None):
+        body = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            body['parameters'] = parameters
+        return web.json_response(body, status=code)
+
+    def is_blocked(self, chat_id) -> bool:
+        # Стабильно для одного и того же chat_id, чтобы повторные рассылки видели тех же "заблокировавших"
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            return False
+        return (chat_id * 2654435761 % 2 ** 32) / 2 ** 32 < self.blocked
+
+    def over_rps(self) -> bool:
+        if not self.max_rps:
+            return False
+        now = time.monotonic()
+        while self.recent_sends and now - self.recent_sends[0] > 1:
+            self.recent_sends.popleft()
+        if len(self.recent_sends) >= self.max_rps:
+            return True
+        self.recent_sends.append(now)
+        return False
+
+    def make_message(self, method: str, params: dict) -> dict:
+        chat_id = int(params.get('chat_id') or 0)
+        message = {
+            'message_id': int(params.get('message_id') or next(self.message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'},
+        }
+        if method == 'sendDice':
+            emoji = params.get('emoji') or '🎲'
+            message['dice'] = {'emoji': emoji, 'value': random.randint(1, DICE_RANGES.get(emoji, 6))}
+        elif method == 'sendPhoto':
+            message['photo'] = [{'file_id': str(params.get('photo')), 'file_unique_id': 'photo', 'width': 1, 'height': 1}]
+            message['caption'] = params.get('caption')
+        elif method == 'sendVideo':
+            message['video'] = {'file_id': 'video', 'file_unique_id': 'video', 'width': 1, 'height': 1, 'duration': 1}
+            message['caption'] = params.get('caption')
+        elif method in ('sendMessage', 'editMessageText'):
+            message['text'] = params.get('text') or ''
+        return message
+
+    def handle_method(self, method: str, params: dict):
+        if method in MESSAGE_METHODS:
+            return self.make_message(method, params)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+        if method == 'getChatMember':
+            user_id = int(params.get('user_id') or 0)
+            return {'status': 'member', 'user': {'id': user_id, 'is_bot': False, 'first_name': 'User'}}
+        if method == 'getChat':
+            chat_id = int(params.get('chat_id') or 0)
+            return {'id': chat_id, 'type': 'private', 'accent_color_id': 0, 'max_reaction_count': 0}
+        # deleteMessage, answerCallbackQuery, setMyCommands, deleteWebhook, setWebhook и прочие
+        return True
+
+    # ===== HTTP =====
+
+    async def bot_method(self, request: web.Request):
+        method = request.match_info['method']
+        params = dict(await request.post()) if request.body_exists else {}
+        if not params and request.content_type == 'application/json':
+            params = await request.json()
+
+        stats = self.stats[method]
+        stats['calls'] += 1
+
+        if method == 'getUpdates':
+            return self.ok(await self.get_updates(params))
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if method.startswith('send'):
+            if self.over_rps() or (self.rate_limit and random.random() < self.rate_limit):
+                stats['retry_after'] += 1
+                return self.error(429, f"Too Many Requests: retry after {self.retry_after}",
+                                  {'retry_after': self.retry_after})
+            if self.is_blocked(params.get('chat_id')):
+                stats['forbidden'] += 1
+                return self.error(403, "Forbidden: bot was blocked by the user")
+
+        stats['ok'] += 1
+        return self.ok(self.handle_method(method, params))
+
+    async def get_updates(self, params: dict):
+        offset = int(params.get('offset') or 0)
+        timeout = min(int(params.get('timeout') or 0), 30)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout=timeout or 0.01))
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return [u for u in updates if u['update_id'] >= offset]
+
+    async def push_updates(self, request: web.Request):
+        payload = await request.json()
+        for update in payload if isinstance(payload, list) else [payload]:
+            update['update_id'] = next(self.update_ids)
+            self.updates.put_nowait(update)
+        return web.json_response({'ok': True})
+
+    async def get_stats(self, request: web.Request):
+        elapsed = time.monotonic() - self.started_at
+        sends = sum(s['ok'] for m, s in self.stats.items() if m.startswith('send'))
+        return web.json_response({
+            'elapsed': round(elapsed, 3),
+            'sends_per_second': round(sends / elapsed, 2) if elapsed else 0,
+            'methods': self.stats,
+        })
+
+    async def delete_stats(self, request: web.Request):
+        self.reset_stats()
+        return web.json_response({'ok': True})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.bot_method)
+        app.router.add_get('/bot{token}/{method}', self.bot_method)
+        app.router.add_post('/_updates', self.push_updates)
+        app.router.add_get('/_stats', self.get_stats)
+        app.router.add_delete('/_stats', self.delete_stats)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа, сек")
+    parser.add_argument('--jitter', type=float, default=0.0, help="разброс задержки, сек")
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="доля send* запросов с ответом 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429")
+    parser.add_argument('--max-rps', type=int, default=0, help="лимит send* в секунду, сверх него 429")
+    parser.add_argument('--blocked', type=float, default=0.0, help="доля пользователей, заблокировавших бота")
+    args = parser.parse_args()
+
+    api = FakeTelegramAPI(
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+        blocked=args.blocked,
+        max_rps=args.max_rps,
+    )
+    print(f"[FAKE_API] Listening on http://{args.host}:{args.port}")
+    web.run_app(api.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,23 @@
 import asyncio
+import contextvars
+import math
+import weakref
 import os
 import time
 import random
 import asyncpg
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from decimal import Decimal
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 import pytz
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
@@ -27,18 +36,957 @@ DATABASE_URL = os.getenv('DATABASE_URL')
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is not set")
 
+# Рассылки: глобальный лимит сообщений в секунду и число одновременных отправок
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '30'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '20'))
+BROADCAST_PROGRESS_INTERVAL = 5
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', '200'))
+BROADCAST_LEASE_SECONDS = 120
+
+# Пул соединений с БД. В адаптивном режиме пул открывается на DB_POOL_CEILING соединений,
+# а число одновременно выдаваемых растёт от DB_POOL_MAX, когда ожидание acquire превышает порог
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '5'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '60'))
+DB_POOL_ADAPTIVE = os.getenv('DB_POOL_ADAPTIVE', '0') == '1'
+DB_POOL_CEILING = max(DB_POOL_MAX, int(os.getenv('DB_POOL_CEILING', str(DB_POOL_MAX * 2))))
+DB_POOL_WAIT_THRESHOLD_MS = float(os.getenv('DB_POOL_WAIT_THRESHOLD_MS', '50'))
+# Кэш подготовленных запросов на соединение: реестр PREPARED плюс остальные запросы бота
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '256'))
+
+# Отложенная запись action_logs: сброс пачкой раз в ACTION_LOG_FLUSH_MS или при ACTION_LOG_BATCH_SIZE строк
+ACTION_LOG_FLUSH_MS = int(os.getenv('ACTION_LOG_FLUSH_MS', '500'))
+ACTION_LOG_BATCH_SIZE = int(os.getenv('ACTION_LOG_BATCH_SIZE', '500'))
+ACTION_LOG_MAX_BUFFER = int(os.getenv('ACTION_LOG_MAX_BUFFER', '50000'))
+# Месячные секции action_logs: сколько месяцев создавать наперёд и сколько хранить.
+# Старые секции отсоединяются (detach) или удаляются (drop); 0 месяцев - хранить всё
+ACTION_LOG_PARTITIONS_AHEAD = int(os.getenv('ACTION_LOG_PARTITIONS_AHEAD', '2'))
+ACTION_LOG_RETENTION_MONTHS = int(os.getenv('ACTION_LOG_RETENTION_MONTHS', '12'))
+ACTION_LOG_RETENTION_MODE = os.getenv('ACTION_LOG_RETENTION_MODE', 'detach')
+# Перенос строк из несекционированной action_logs после миграции 7: размер пачки и пауза между пачками
+ACTION_LOG_BACKFILL_BATCH = int(os.getenv('ACTION_LOG_BACKFILL_BATCH', '5000'))
+ACTION_LOG_BACKFILL_PAUSE_MS = int(os.getenv('ACTION_LOG_BACKFILL_PAUSE_MS', '200'))
+
+# Почасовые агрегаты для /stats: досчитываются раз в ROLLUP_INTERVAL_SECONDS с отставанием
+# ROLLUP_LAG_SECONDS от текущего времени, чтобы не пропустить ещё не закоммиченные строки
+ROLLUP_INTERVAL_SECONDS = int(os.getenv('ROLLUP_INTERVAL_SECONDS', '60'))
+ROLLUP_LAG_SECONDS = int(os.getenv('ROLLUP_LAG_SECONDS', '120'))
+ROLLUP_MAX_WINDOW_HOURS = 24
+
+# Джекпот: прирост сбрасывается в БД раз в JACKPOT_FLUSH_SECONDS, сумма для показа кэшируется на JACKPOT_CACHE_TTL
+JACKPOT_BASE = 20.0
+JACKPOT_FLUSH_SECONDS = float(os.getenv('JACKPOT_FLUSH_SECONDS', '5'))
+JACKPOT_CACHE_TTL = float(os.getenv('JACKPOT_CACHE_TTL', '10'))
+
+# Outbox уведомлений: пишется в транзакции вместе с изменением баланса, отправляется фоновым диспетчером.
+# Неудачная отправка повторяется с растущей паузой, после OUTBOX_MAX_ATTEMPTS попыток сообщение помечается failed
+OUTBOX_POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', '1'))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_LEASE_SECONDS = 120
+
+# Защита от повторных нажатий кнопок: множество в памяти процесса с TTL и ограниченным размером.
+# BUTTON_DEDUP_DB=1 дополнительно пишет нажатия в used_buttons (несколько реплик бота)
+BUTTON_DEDUP_TTL = int(os.getenv('BUTTON_DEDUP_TTL', '86400'))
+BUTTON_DEDUP_MAX = int(os.getenv('BUTTON_DEDUP_MAX', '500000'))
+BUTTON_DEDUP_DB = os.getenv('BUTTON_DEDUP_DB', '0') == '1'
+
+# Счётчики сессий (показы меню) копятся в памяти и сбрасываются в user_sessions раз в SESSION_FLUSH_SECONDS
+SESSION_FLUSH_SECONDS = float(os.getenv('SESSION_FLUSH_SECONDS', '5'))
+
+# Кэш состояний пользователей (user_states): LRU с TTL и ограничением по числу записей и объёму.
+# Изменения пишутся в БД пачкой раз в STATE_FLUSH_SECONDS, повторная запись того же значения пропускается
+STATE_CACHE_TTL = int(os.getenv('STATE_CACHE_TTL', '86400'))
+STATE_CACHE_MAX_ENTRIES = int(os.getenv('STATE_CACHE_MAX_ENTRIES', '200000'))
+STATE_CACHE_MAX_BYTES = int(os.getenv('STATE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+STATE_FLUSH_SECONDS = float(os.getenv('STATE_FLUSH_SECONDS', '1'))
+
+# Напоминания о ежедневном кейсе: сколько партий разослать за час
+BONUS_REMINDER_BATCHES_PER_HOUR = int(os.getenv('BONUS_REMINDER_BATCHES_PER_HOUR', '60'))
+
+# Альтернативный адрес Bot API (например, локальная заглушка fake_telegram_api.py для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
 storage = MemoryStorage()
-bot = Bot(token=BOT_TOKEN)
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    print(f"[BOT] Using Bot API at {TELEGRAM_API_URL}")
+else:
+    bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher(storage=storage)
 
 BOT_USERNAME = None
 db_pool = None
 
-user_states = {}
 used_buttons = {}
 user_sessions = {}
 pending_referrals = {}
 
+class PoolMetrics:
+    """Метрики пула и ограничение числа одновременно выданных соединений"""
+
+    WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+    def __init__(self, limit: int, ceiling: int):
+        self.limit = limit
+        self.ceiling = ceiling
+        self.slots = asyncio.Condition()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.waiters = 0
+        self.acquired = 0
+        self.wait_histogram = [0] * (len(self.WAIT_BUCKETS_MS) + 1)
+        self.recent_waits = deque(maxlen=500)
+        self.window_waits = deque(maxlen=5000)
+        self.opened_at = weakref.WeakKeyDictionary()
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self.lifetimes = deque(maxlen=200)
+
+    def observe_wait(self, wait_ms: float):
+        self.acquired += 1
+        self.recent_waits.append(wait_ms)
+        self.window_waits.append(wait_ms)
+        for i, bound in enumerate(self.WAIT_BUCKETS_MS):
+            if wait_ms <= bound:
+                self.wait_histogram[i] += 1
+                return
+        self.wait_histogram[-1] += 1
+
+    def on_connection_open(self, conn):
+        self.connections_opened += 1
+        self.opened_at[conn] = time.monotonic()
+        conn.add_termination_listener(self.on_connection_close)
+
+    def on_connection_close(self, conn):
+        self.connections_closed += 1
+        prepared_statements.pop(conn.get_server_pid(), None)
+        opened = self.opened_at.pop(conn, None)
+        if opened is not None:
+            self.lifetimes.append(time.monotonic() - opened)
+
+    async def checkout(self):
+        start = time.perf_counter()
+        self.waiters += 1
+        try:
+            async with self.slots:
+                await self.slots.wait_for(lambda: self.in_use < self.limit)
+                self.in_use += 1
+                self.peak_in_use = max(self.peak_in_use, self.in_use)
+            try:
+                conn = await db_pool.acquire()
+            except BaseException:
+                await self.free_slot()
+                raise
+        finally:
+            self.waiters -= 1
+        self.observe_wait((time.perf_counter() - start) * 1000)
+        return conn
+
+    async def checkin(self, conn):
+        try:
+            await db_pool.release(conn)
+        finally:
+            await self.free_slot()
+
+    async def free_slot(self):
+        async with self.slots:
+            self.in_use -= 1
+            self.slots.notify()
+
+    def wait_percentile(self, waits: list, q: float) -> float:
+        if not waits:
+            return 0.0
+        waits = sorted(waits)
+        return waits[min(len(waits) - 1, int(len(waits) * q))]
+
+    async def set_limit(self, limit: int):
+        async with self.slots:
+            self.limit = limit
+            self.slots.notify_all()
+
+    def snapshot(self) -> dict:
+        waits = list(self.recent_waits)
+        labels = [f"<={b}" for b in self.WAIT_BUCKETS_MS] + ['+inf']
+        lifetimes = list(self.lifetimes)
+        return {
+            'size': db_pool.get_size() if db_pool else 0,
+            'idle': db_pool.get_idle_size() if db_pool else 0,
+            'min_size': DB_POOL_MIN,
+            'max_size': DB_POOL_MAX,
+            'adaptive': DB_POOL_ADAPTIVE,
+            'limit': self.limit,
+            'ceiling': self.ceiling,
+            'in_use': self.in_use,
+            'peak_in_use': self.peak_in_use,
+            'waiters': self.waiters,
+            'acquired': self.acquired,
+            'wait_ms': {
+                'p50': round(self.wait_percentile(waits, 0.5), 3),
+                'p95': round(self.wait_percentile(waits, 0.95), 3),
+                'p99': round(self.wait_percentile(waits, 0.99), 3),
+                'max': round(max(waits), 3) if waits else 0.0,
+            },
+            'wait_histogram_ms': dict(zip(labels, self.wait_histogram)),
+            'connections': {
+                'opened': self.connections_opened,
+                'closed': self.connections_closed,
+                'lifetime_avg_s': round(sum(lifetimes) / len(lifetimes), 1) if lifetimes else None,
+                'lifetime_max_s': round(max(lifetimes), 1) if lifetimes else None,
+            },
+        }
+
+pool_metrics = PoolMetrics(DB_POOL_MAX, DB_POOL_CEILING if DB_POOL_ADAPTIVE else DB_POOL_MAX)
+
+# Реестр горячих запросов: готовятся на каждом новом соединении пула и вызываются через run_prepared
+PREPARED = {
+    'get_user_state': 'SELECT state_data FROM user_states WHERE user_id = $1',
+    'set_user_state': '''INSERT INTO user_states (user_id, state_data, updated_at)
+        VALUES ($1, $2, NOW())
+        ON CONFLICT (user_id)
+        DO UPDATE SET state_data = $2, updated_at = NOW()''',
+    'delete_user_state': 'DELETE FROM user_states WHERE user_id = $1',
+    'is_button_used': 'SELECT EXISTS(SELECT 1 FROM used_buttons WHERE user_id = $1 AND button_id = $2)',
+    'mark_button_used': '''INSERT INTO used_buttons (user_id, button_id, used_at)
+        VALUES ($1, $2, NOW())
+        ON CONFLICT (user_id, button_id) DO NOTHING
+        RETURNING 1''',
+    'get_user_session': 'SELECT session_count FROM user_sessions WHERE user_id = $1',
+    'flush_user_sessions': '''INSERT INTO user_sessions (user_id, session_count, last_activity)
+        SELECT user_id, delta, NOW() FROM unnest($1::bigint[], $2::int[]) AS t(user_id, delta)
+        ON CONFLICT (user_id)
+        DO UPDATE SET session_count = user_sessions.session_count + EXCLUDED.session_count, last_activity = NOW()
+        RETURNING user_id, session_count''',
+    'get_required_channels': 'SELECT channel_id, url, name FROM required_channels',
+    'log_action': '''INSERT INTO action_logs (user_id, action_type, amount, details, created_at)
+        VALUES ($1, $2, $3, $4, NOW())
+        RETURNING id''',
+    'get_user': 'SELECT user_id, name, username, balance, refs, last_bonus, used_promos FROM users WHERE user_id = $1',
+    'create_user': '''INSERT INTO users (user_id, name, username, balance, refs, last_bonus, used_promos)
+        VALUES ($1, $2, $3, 0, 0, 0, ARRAY[]::TEXT[])
+        ON CONFLICT (user_id) DO NOTHING''',
+    'load_user_context': '''WITH ins AS (
+            INSERT INTO users (user_id, name, username, balance, refs, last_bonus, used_promos)
+            VALUES ($1, $2, $3, 0, 0, 0, ARRAY[]::TEXT[])
+            ON CONFLICT (user_id) DO NOTHING
+            RETURNING user_id, name, username, balance, refs, last_bonus, used_promos
+        ),
+        u AS (
+            SELECT *, TRUE AS created FROM ins
+            UNION ALL
+            SELECT user_id, name, username, balance, refs, last_bonus, used_promos, FALSE
+            FROM users WHERE user_id = $1
+        ),
+        s AS (
+            SELECT COALESCE((SELECT session_count FROM user_sessions WHERE user_id = $1), 0) AS session_count
+        )
+        SELECT u.*, s.session_count,
+               (SELECT state_data FROM user_states WHERE user_id = $1) AS state_data
+        FROM u, s
+        ORDER BY u.created DESC
+        LIMIT 1''',
+    # То же без создания пользователя: для апдейтов, которые не должны заводить строку в users
+    'load_existing_user_context': '''SELECT u.user_id, u.name, u.username, u.balance, u.refs, u.last_bonus,
+               u.used_promos, FALSE AS created,
+               COALESCE((SELECT session_count FROM user_sessions WHERE user_id = $1), 0) AS session_count,
+               (SELECT state_data FROM user_states WHERE user_id = $1) AS state_data
+        FROM users u WHERE u.user_id = $1''',
+    'mark_user_reachable': 'UPDATE users SET reachable = TRUE, unreachable_at = NULL WHERE user_id = $1 AND NOT reachable',
+    'update_user_balance': 'UPDATE users SET balance = balance + $1 WHERE user_id = $2',
+    'get_user_balance': 'SELECT balance FROM users WHERE user_id = $1',
+    'settle_bet': '''WITH upd AS (
+            UPDATE users SET balance = balance - $2 + $3
+            WHERE user_id = $1 AND balance >= $2
+            RETURNING balance
+        ),
+        logs AS (
+            INSERT INTO action_logs (user_id, action_type, amount, details, created_at)
+            SELECT $1, v.action_type, v.amount, v.details::jsonb, NOW()
+            FROM upd, (VALUES ('casino_bet', $2, $4), ('casino_result', $3, $5)) AS v(action_type, amount, details)
+        ),
+        totals AS (
+            INSERT INTO user_game_totals (user_id, game, bets, wins, losses, draws, staked, won)
+            SELECT $1, $6, 1, ($7 = 'win')::int, ($7 = 'loss')::int, ($7 = 'draw')::int, $2, $3
+            FROM upd
+            ON CONFLICT (user_id, game) DO UPDATE SET
+                bets = user_game_totals.bets + 1,
+                wins = user_game_totals.wins + EXCLUDED.wins,
+                losses = user_game_totals.losses + EXCLUDED.losses,
+                draws = user_game_totals.draws + EXCLUDED.draws,
+                staked = user_game_totals.staked + EXCLUDED.staked,
+                won = user_game_totals.won + EXCLUDED.won
+        )
+        SELECT balance FROM upd''',
+    # Ставка в играх с кубиком Telegram: исход известен только после броска, поэтому ставка
+    # списывается до него (reserve_bet), а выигрыш начисляется после (settle_reserved_bet)
+    'reserve_bet': '''WITH upd AS (
+            UPDATE users SET balance = balance - $2
+            WHERE user_id = $1 AND balance >= $2
+            RETURNING balance
+        ),
+        log AS (
+            INSERT INTO action_logs (user_id, action_type, amount, details, created_at)
+            SELECT $1, 'casino_bet', $2, $3::jsonb, NOW() FROM upd
+        )
+        SELECT balance FROM upd''',
+    'settle_reserved_bet': '''WITH upd AS (
+            UPDATE users SET balance = balance + $3 WHERE user_id = $1
+            RETURNING balance
+        ),
+        log AS (
+            INSERT INTO action_logs (user_id, action_type, amount, details, created_at)
+            SELECT $1, 'casino_result', $3, $4::jsonb, NOW() FROM upd
+        ),
+        totals AS (
+            INSERT INTO user_game_totals (user_id, game, bets, wins, losses, draws, staked, won)
+            SELECT $1, $5, 1, ($6 = 'win')::int, ($6 = 'loss')::int, ($6 = 'draw')::int, $2, $3
+            FROM upd
+            ON CONFLICT (user_id, game) DO UPDATE SET
+                bets = user_game_totals.bets + 1,
+                wins = user_game_totals.wins + EXCLUDED.wins,
+                losses = user_game_totals.losses + EXCLUDED.losses,
+                draws = user_game_totals.draws + EXCLUDED.draws,
+                staked = user_game_totals.staked + EXCLUDED.staked,
+                won = user_game_totals.won + EXCLUDED.won
+        )
+        SELECT balance FROM upd''',
+    'bump_user_totals': '''INSERT INTO user_totals (user_id, promos_count, promos_amount, withdraw_count, withdrawn, support_requests)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (user_id) DO UPDATE SET
+            promos_count = user_totals.promos_count + EXCLUDED.promos_count,
+            promos_amount = user_totals.promos_amount + EXCLUDED.promos_amount,
+            withdraw_count = user_totals.withdraw_count + EXCLUDED.withdraw_count,
+            withdrawn = user_totals.withdrawn + EXCLUDED.withdrawn,
+            support_requests = user_totals.support_requests + EXCLUDED.support_requests''',
+    'get_top_users': 'SELECT user_id, name, balance FROM users ORDER BY balance DESC LIMIT $1',
+    'get_active_tournament': '''SELECT id, name, start_time, end_time, duration_days, prize_places, prizes, trophy_file_ids, status
+        FROM tournaments
+        WHERE status = 'active' AND start_time <= $1 AND end_time > $1
+        ORDER BY id DESC LIMIT 1''',
+    'add_tournament_participant': '''INSERT INTO tournament_participants (tournament_id, user_id, refs_count)
+        VALUES ($1, $2, 0)
+        ON CONFLICT (tournament_id, user_id) DO NOTHING''',
+}
+
+# Подготовленные запросы реестра по PID серверного процесса соединения: {имя: PreparedStatement}.
+# Готовятся через conn.prepare() при открытии соединения пулом и живут, пока живо соединение
+prepared_statements = {}
+# warm_calls - вызов готовым statement'ом, cold_calls - запрос пришлось подготовить при вызове
+# (соединение открыто до миграций или statement устарел после изменения схемы)
+prepared_stats = {name: {'warm_calls': 0, 'cold_calls': 0, 'calls': 0, 'total_ms': 0.0} for name in PREPARED}
+
+async def prepare_statements(conn):
+    prepared = prepared_statements.setdefault(conn.get_server_pid(), {})
+    # Разбор запроса берёт блокировки его таблиц до конца неявной транзакции; явная транзакция
+    # снимает их при COMMIT, иначе простаивающее соединение мешает DDL
+    async with conn.transaction():
+        for name, sql in PREPARED.items():
+            try:
+                async with conn.transaction():
+                    prepared[name] = await conn.prepare(sql)
+            except asyncpg.exceptions.PostgresError:
+                # Соединение открыто до создания схемы или миграций - запрос подготовится при первом вызове
+                pass
+
+def statement_for_checkout(stmt):
+    """asyncpg не даёт вызывать PreparedStatement после возврата соединения в пул, хотя сам statement
+    на сервере жив до закрытия соединения. Для новой выдачи создаём обёртку над тем же состоянием"""
+    if stmt._con_release_ctr == stmt._connection._pool_release_ctr:
+        return stmt
+    return asyncpg.prepared_stmt.PreparedStatement(stmt._connection, stmt._query, stmt._state)
+
+async def run_prepared(conn, name: str, method: str, *args):
+    """Выполняет запрос из PREPARED готовым statement'ом соединения, без разбора и планирования.
+    method - fetch/fetchrow/fetchval или execute (результат не возвращается)"""
+    prepared = prepared_statements.setdefault(conn.get_server_pid(), {})
+    stats = prepared_stats[name]
+    if method == 'execute':
+        method = 'fetch'
+
+    start = time.perf_counter()
+    stmt = prepared.get(name)
+    if stmt is not None:
+        stmt = prepared[name] = statement_for_checkout(stmt)
+        try:
+            result = await getattr(stmt, method)(*args)
+            stats['warm_calls'] += 1
+        except (asyncpg.exceptions.InvalidCachedStatementError, asyncpg.exceptions.OutdatedSchemaCacheError):
+            # Схема изменилась после подготовки; в транзакции ошибка уже её прервала - повторять нельзя
+            del prepared[name]
+            if conn.is_in_transaction():
+                raise
+            stmt = None
+    if stmt is None:
+        stats['cold_calls'] += 1
+        stmt = prepared[name] = await conn.prepare(PREPARED[name])
+        result = await getattr(stmt, method)(*args)
+    stats['calls'] += 1
+    stats['total_ms'] += (time.perf_counter() - start) * 1000
+    return result
+
+def prepared_snapshot() -> dict:
+    return {
+        name: {
+            'warm_calls': st['warm_calls'],
+            'cold_calls': st['cold_calls'],
+            'avg_ms': round(st['total_ms'] / st['calls'], 3) if st['calls'] else None,
+        }
+        for name, st in prepared_stats.items()
+    }
+
+async def init_pool_connection(conn):
+    pool_metrics.on_connection_open(conn)
+    await prepare_statements(conn)
+
+async def pool_autoscale_task():
+    """Адаптивный режим: поднимает лимит к потолку при долгих ожиданиях и возвращает обратно в простое"""
+    while True:
+        await asyncio.sleep(10)
+        try:
+            waits = list(pool_metrics.window_waits)
+            pool_metrics.window_waits.clear()
+            peak, pool_metrics.peak_in_use = pool_metrics.peak_in_use, pool_metrics.in_use
+            p95 = pool_metrics.wait_percentile(waits, 0.95)
+            limit = pool_metrics.limit
+
+            if p95 > DB_POOL_WAIT_THRESHOLD_MS and limit < pool_metrics.ceiling:
+                new_limit = min(pool_metrics.ceiling, limit + max(1, limit // 4))
+                await pool_metrics.set_limit(new_limit)
+                print(f"[DB] Pool limit raised {limit} -> {new_limit} (p95 wait {p95:.1f} ms)")
+            elif p95 < DB_POOL_WAIT_THRESHOLD_MS / 4 and peak < limit - 1 and limit > DB_POOL_MAX:
+                await pool_metrics.set_limit(limit - 1)
+                print(f"[DB] Pool limit lowered {limit} -> {limit - 1}")
+        except Exception as e:
+            print(f"[DB] Pool autoscale error: {e}")
+
+# ===== МИГРАЦИИ СХЕМЫ =====
+# Применённые версии хранятся в schema_version, при старте выполняются только новые.
+# Шаг миграции - SQL-строка или async-функция, принимающая соединение; миграция идёт в одной транзакции.
+
+MIGRATIONS_LOCK_ID = 5125001
+
+ACTION_LOG_COLUMNS = 'id, user_id, action_type, amount, details, created_at'
+
+def shift_month(month, months: int):
+    year, index = divmod(month.month - 1 + months, 12)
+    return month.replace(year=month.year + year, month=index + 1, day=1)
+
+def action_log_partition_name(month) -> str:
+    return f"action_logs_p{month:%Y%m}"
+
+async def create_action_log_partition(conn, month):
+    name = action_log_partition_name(month)
+    if await conn.fetchval('SELECT to_regclass($1) IS NOT NULL', name):
+        return
+    upper = shift_month(month, 1)
+    async with conn.transaction():
+        # Строки этого месяца, попавшие в DEFAULT до появления секции, иначе CREATE не пройдёт проверку границ
+        moved = await conn.fetch(
+            f'''DELETE FROM action_logs_default WHERE created_at >= $1 AND created_at < $2
+                RETURNING {ACTION_LOG_COLUMNS}''',
+            month, upper
+        )
+        await conn.execute(
+            f'''CREATE TABLE IF NOT EXISTS {name}
+                PARTITION OF action_logs
+                FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')'''
+        )
+        if moved:
+            await conn.copy_records_to_table(name, records=moved, columns=ACTION_LOG_COLUMNS.split(', '))
+
+async def ensure_action_log_partitions(conn):
+    """Секции action_logs на текущий месяц и ACTION_LOG_PARTITIONS_AHEAD вперёд (по часам БД)"""
+    current = await conn.fetchval("SELECT date_trunc('month', LOCALTIMESTAMP)")
+    for i in range(ACTION_LOG_PARTITIONS_AHEAD + 1):
+        await create_action_log_partition(conn, shift_month(current, i))
+
+async def apply_action_log_retention(conn) -> list:
+    """Отсоединяет или удаляет секции старше ACTION_LOG_RETENTION_MONTHS вместо массового DELETE"""
+    if ACTION_LOG_RETENTION_MONTHS <= 0:
+        return []
+    current = await conn.fetchval("SELECT date_trunc('month', LOCALTIMESTAMP)")
+    cutoff = action_log_partition_name(shift_month(current, -ACTION_LOG_RETENTION_MONTHS))
+    rows = await conn.fetch(
+        '''SELECT c.relname FROM pg_inherits i
+           JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = 'action_logs'::regclass
+           ORDER BY c.relname'''
+    )
+    # Имена секций action_logs_pYYYYMM сравниваются как строки в хронологическом порядке;
+    # action_logs_default под срок хранения не попадает
+    expired = [
+        row['relname'] for row in rows
+        if row['relname'].startswith('action_logs_p') and row['relname'] < cutoff
+    ]
+    for name in expired:
+        async with conn.transaction():
+            # DETACH коротко блокирует всю таблицу - не ждём дольше lock_timeout, повторим в следующий раз
+            await conn.execute("SET LOCAL lock_timeout = '5s'")
+            await conn.execute(f'ALTER TABLE action_logs DETACH PARTITION {name}')
+            if ACTION_LOG_RETENTION_MODE == 'drop':
+                await conn.execute(f'DROP TABLE {name}')
+        print(f"[DB] action_logs partition {name} {'dropped' if ACTION_LOG_RETENTION_MODE == 'drop' else 'detached'}")
+    return expired
+
+async def partition_action_logs(conn):
+    """Переводит action_logs на таблицу, секционированную по месяцам created_at.
+    Старые строки остаются в action_logs_legacy и переносятся фоновым backfill_action_logs;
+    до конца переноса историю целиком читают через вью action_log_history"""
+    await conn.execute('ALTER TABLE action_logs RENAME TO action_logs_legacy')
+    await conn.execute('ALTER TABLE action_logs_legacy RENAME CONSTRAINT action_logs_pkey TO action_logs_legacy_pkey')
+    # Индексы миграции 6 остаются на старой таблице: по ним читается вью и идёт перенос
+    for index in ('type_created', 'created', 'user'):
+        await conn.execute(f'ALTER INDEX IF EXISTS idx_action_logs_{index} RENAME TO idx_action_logs_legacy_{index}')
+    # В новой таблице created_at обязателен
+    await conn.execute('UPDATE action_logs_legacy SET created_at = LOCALTIMESTAMP WHERE created_at IS NULL')
+
+    # Ключ секционирования обязан входить в первичный ключ
+    await conn.execute('''
+        CREATE TABLE action_logs (
+            id BIGINT NOT NULL DEFAULT nextval('action_logs_id_seq'),
+            user_id BIGINT NOT NULL,
+            action_type TEXT NOT NULL,
+            amount DECIMAL(10, 2) DEFAULT 0,
+            details JSONB,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    ''')
+    await conn.execute('ALTER SEQUENCE action_logs_id_seq AS BIGINT OWNED BY action_logs.id')
+    await conn.execute('CREATE INDEX idx_action_logs_type_created ON action_logs (action_type, created_at)')
+    await conn.execute('CREATE INDEX idx_action_logs_created ON action_logs (created_at)')
+    await conn.execute('CREATE INDEX idx_action_logs_user ON action_logs (user_id)')
+    # Строка вне созданных секций попадает сюда, а не роняет запись лога
+    await conn.execute('CREATE TABLE action_logs_default PARTITION OF action_logs DEFAULT')
+    await ensure_action_log_partitions(conn)
+
+    await conn.execute(f'''
+        CREATE VIEW action_log_history AS
+        SELECT {ACTION_LOG_COLUMNS} FROM action_logs
+        UNION ALL
+        SELECT {ACTION_LOG_COLUMNS} FROM action_logs_legacy
+    ''')
+
+async def backfill_action_logs():
+    """Переносит action_logs_legacy в секционированную action_logs пачками по ACTION_LOG_BACKFILL_BATCH.
+    Пачка удаляется из старой таблицы и вставляется в новую в одной транзакции, поэтому
+    action_log_history видит каждую строку ровно один раз. После переноса старая таблица удаляется"""
+    moved = 0
+    while True:
+        try:
+            async with acquire_conn() as conn:
+                if not await conn.fetchval("SELECT to_regclass('action_logs_legacy') IS NOT NULL"):
+                    return
+                async with conn.transaction():
+                    # SKIP LOCKED: другие реплики переносят свои пачки параллельно
+                    rows = await conn.fetch(
+                        f'''DELETE FROM action_logs_legacy WHERE id IN (
+                               SELECT id FROM action_logs_legacy ORDER BY id LIMIT $1 FOR UPDATE SKIP LOCKED
+                           ) RETURNING {ACTION_LOG_COLUMNS}''',
+                        ACTION_LOG_BACKFILL_BATCH
+                    )
+                    if rows:
+                        months = {row['created_at'].replace(day=1, hour=0, minute=0, second=0, microsecond=0) for row in rows}
+                        for month in sorted(months):
+                            await create_action_log_partition(conn, month)
+                        await conn.copy_records_to_table(
+                            'action_logs', records=rows, columns=ACTION_LOG_COLUMNS.split(', ')
+                        )
+                    elif not await conn.fetchval('SELECT EXISTS (SELECT 1 FROM action_logs_legacy)'):
+                        await conn.execute(f'CREATE OR REPLACE VIEW action_log_history AS SELECT {ACTION_LOG_COLUMNS} FROM action_logs')
+                        await conn.execute('DROP TABLE action_logs_legacy')
+                        print(f"[DB] action_logs back-fill finished, {moved} rows moved")
+                        return
+            moved += len(rows)
+        except Exception as e:
+            print(f"[DB] action_logs back-fill failed: {e}")
+            await asyncio.sleep(60)
+            continue
+        await asyncio.sleep(ACTION_LOG_BACKFILL_PAUSE_MS / 1000)
+
+MIGRATIONS = [
+    (1, 'baseline', [
+        # Таблица связей рефералов
+        '''CREATE TABLE IF NOT EXISTS referral_connections (
+            user_id BIGINT PRIMARY KEY,
+            referrer_id BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        )''',
+        # Таблица каналов для подписки
+        '''CREATE TABLE IF NOT EXISTS required_channels (
+            channel_id BIGINT PRIMARY KEY,
+            url TEXT NOT NULL,
+            name TEXT NOT NULL
+        )''',
+        # Таблица джекпота
+        '''CREATE TABLE IF NOT EXISTS jackpot (
+            id INTEGER PRIMARY KEY DEFAULT 1,
+            amount DECIMAL(15, 2) DEFAULT 20.0,
+            CONSTRAINT single_row CHECK (id = 1)
+        )''',
+        # Инициализация джекпота если его нет
+        '''INSERT INTO jackpot (id, amount)
+        VALUES (1, 20.0)
+        ON CONFLICT (id) DO NOTHING''',
+        # Таблица пользователей
+        '''CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            name TEXT NOT NULL,
+            username TEXT,
+            balance DECIMAL(10, 2) DEFAULT 0,
+            refs INTEGER DEFAULT 0,
+            last_bonus BIGINT DEFAULT 0,
+            used_promos TEXT[] DEFAULT ARRAY[]::TEXT[]
+        )''',
+        # Таблица состояний пользователей
+        '''CREATE TABLE IF NOT EXISTS user_states (
+            user_id BIGINT PRIMARY KEY,
+            state_data TEXT,
+            updated_at TIMESTAMP DEFAULT NOW()
+        )''',
+        # Таблица использованных кнопок
+        '''CREATE TABLE IF NOT EXISTS used_buttons (
+            user_id BIGINT,
+            button_id TEXT,
+            used_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (user_id, button_id)
+        )''',
+        # Таблица ожидающих рефералов
+        '''CREATE TABLE IF NOT EXISTS pending_referrals (
+            user_id BIGINT PRIMARY KEY,
+            referrer_id BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        )''',
+        # Таблица сессий пользователей
+        '''CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id BIGINT PRIMARY KEY,
+            session_count INTEGER DEFAULT 0,
+            last_activity TIMESTAMP DEFAULT NOW()
+        )''',
+        # Таблица промокодов
+        '''CREATE TABLE IF NOT EXISTS promos (
+            code TEXT PRIMARY KEY,
+            reward DECIMAL(10, 2) NOT NULL,
+            uses INTEGER DEFAULT 0
+        )''',
+        # Таблица турниров
+        '''CREATE TABLE IF NOT EXISTS tournaments (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            start_time BIGINT NOT NULL,
+            end_time BIGINT NOT NULL,
+            duration_days INTEGER NOT NULL,
+            prize_places INTEGER NOT NULL,
+            prizes JSONB NOT NULL,
+            trophy_file_ids JSONB NOT NULL,
+            status TEXT DEFAULT 'active',
+            start_message TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        )''',
+        # Таблица участников турнира
+        '''CREATE TABLE IF NOT EXISTS tournament_participants (
+            tournament_id INTEGER REFERENCES tournaments(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            refs_count INTEGER DEFAULT 0,
+            PRIMARY KEY (tournament_id, user_id)
+        )''',
+        # Таблица наград пользователей
+        '''CREATE TABLE IF NOT EXISTS user_trophies (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            tournament_id INTEGER REFERENCES tournaments(id),
+            tournament_name TEXT NOT NULL,
+            place INTEGER NOT NULL,
+            trophy_file_id TEXT NOT NULL,
+            prize_stars DECIMAL(10, 2) NOT NULL,
+            date_received BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        )''',
+        # Таблица состояния создания турнира (для админа)
+        '''CREATE TABLE IF NOT EXISTS admin_tournament_creation (
+            admin_id BIGINT PRIMARY KEY,
+            step TEXT NOT NULL,
+            data TEXT DEFAULT '{}',
+            updated_at TIMESTAMP DEFAULT NOW()
+        )''',
+        # Таблица логов (для статистики)
+        '''CREATE TABLE IF NOT EXISTS action_logs (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            action_type TEXT NOT NULL,
+            amount DECIMAL(10, 2) DEFAULT 0,
+            details JSONB,
+            created_at TIMESTAMP DEFAULT NOW()
+        )''',
+        # Добавляем колонку start_message если её нет
+        '''ALTER TABLE tournaments
+        ADD COLUMN IF NOT EXISTS start_message TEXT''',
+    ]),
+    (2, 'broadcast_jobs', [
+        # Таблица заданий рассылки (курсор по users.user_id для продолжения после рестарта)
+        '''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id SERIAL PRIMARY KEY,
+            payload JSONB NOT NULL,
+            status TEXT DEFAULT 'running',
+            last_user_id BIGINT DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            progress_chat_id BIGINT,
+            progress_message_id BIGINT,
+            lease_until TIMESTAMP,
+            created_at TIMESTAMP DEFAULT NOW(),
+            updated_at TIMESTAMP DEFAULT NOW()
+        )''',
+    ]),
+    (3, 'users_reachable', [
+        # Флаг доступности пользователя для рассылок
+        '''ALTER TABLE users
+        ADD COLUMN IF NOT EXISTS reachable BOOLEAN NOT NULL DEFAULT TRUE,
+        ADD COLUMN IF NOT EXISTS unreachable_at TIMESTAMP''',
+        '''CREATE INDEX IF NOT EXISTS idx_users_reachable
+        ON users (user_id) WHERE reachable''',
+    ]),
+    (4, 'tournaments_start_notified_at', [
+        # Маркер отправленного стартового сообщения турнира
+        '''ALTER TABLE tournaments
+        ADD COLUMN IF NOT EXISTS start_notified_at TIMESTAMP''',
+    ]),
+    (5, 'users_last_reminded_at', [
+        # Время последнего напоминания о ежедневном кейсе
+        '''ALTER TABLE users
+        ADD COLUMN IF NOT EXISTS last_reminded_at BIGINT NOT NULL DEFAULT 0''',
+        '''CREATE INDEX IF NOT EXISTS idx_users_bonus_reminder
+        ON users (last_reminded_at, user_id) WHERE reachable AND last_bonus > 0''',
+    ]),
+    (6, 'hot_path_indexes', [
+        # /stats: выборки по типу действия за период и общий срез по времени
+        'CREATE INDEX IF NOT EXISTS idx_action_logs_type_created ON action_logs (action_type, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_action_logs_created ON action_logs (created_at)',
+        # /info: агрегаты по пользователю
+        'CREATE INDEX IF NOT EXISTS idx_action_logs_user ON action_logs (user_id)',
+        # get_top_users
+        'CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance DESC)',
+        # /info @username
+        'CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)',
+        # Лидерборды турниров
+        'CREATE INDEX IF NOT EXISTS idx_tournament_participants_refs ON tournament_participants (tournament_id, refs_count DESC)',
+        # Трофеи пользователя
+        'CREATE INDEX IF NOT EXISTS idx_user_trophies_user ON user_trophies (user_id, date_received DESC)',
+    ]),
+    (7, 'action_logs_monthly_partitions', [
+        partition_action_logs,
+    ]),
+    (8, 'hourly_rollups', [
+        # Игровые раунды по часам: исход и суммы берутся из строк casino_result, как в user_game_totals.
+        # Старый КНБ писал только casino_bet, его раунды до перехода на settle_bet сюда не попадают
+        '''CREATE TABLE IF NOT EXISTS hourly_game_stats (
+            hour TIMESTAMP NOT NULL,
+            game TEXT NOT NULL,
+            outcome TEXT NOT NULL,
+            bets INTEGER NOT NULL DEFAULT 0,
+            staked DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            won DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, game, outcome)
+        )''',
+        # Количество и сумма событий каждого типа по часам (промо, выводы, саппорт)
+        '''CREATE TABLE IF NOT EXISTS hourly_action_counts (
+            hour TIMESTAMP NOT NULL,
+            action_type TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, action_type)
+        )''',
+        # Активные пользователи не складываются между часами, поэтому храним сами пары час-пользователь
+        '''CREATE TABLE IF NOT EXISTS hourly_active_users (
+            hour TIMESTAMP NOT NULL,
+            user_id BIGINT NOT NULL,
+            PRIMARY KEY (hour, user_id)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS rollup_watermark (
+            name TEXT PRIMARY KEY,
+            processed_until TIMESTAMP NOT NULL
+        )''',
+        # История досчитывается фоновой задачей от самого старого часа в логе
+        '''INSERT INTO rollup_watermark (name, processed_until)
+        SELECT 'hourly', COALESCE(date_trunc('hour', MIN(created_at)), date_trunc('hour', LOCALTIMESTAMP))
+        FROM action_log_history
+        ON CONFLICT (name) DO NOTHING''',
+    ]),
+    (9, 'user_lifetime_totals', [
+        # Итоги игрока по каждой игре, обновляются в settle_bet
+        '''CREATE TABLE IF NOT EXISTS user_game_totals (
+            user_id BIGINT NOT NULL,
+            game TEXT NOT NULL,
+            bets INTEGER NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0,
+            losses INTEGER NOT NULL DEFAULT 0,
+            draws INTEGER NOT NULL DEFAULT 0,
+            staked DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            won DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, game)
+        )''',
+        # Промокоды, выводы и обращения в поддержку, обновляются в транзакции действия
+        '''CREATE TABLE IF NOT EXISTS user_totals (
+            user_id BIGINT PRIMARY KEY,
+            promos_count INTEGER NOT NULL DEFAULT 0,
+            promos_amount DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            withdraw_count INTEGER NOT NULL DEFAULT 0,
+            withdrawn DECIMAL(14, 2) NOT NULL DEFAULT 0,
+            support_requests INTEGER NOT NULL DEFAULT 0
+        )''',
+        # Начальные значения из истории action_logs. Как и settle_bet, раунд считается по casino_result
+        # (ставка - details->>'bet'), так же его считают почасовые агрегаты. Старый КНБ писал только
+        # casino_bet, дважды на раунд и без casino_result, поэтому его раунды до settle_bet в итоги не входят
+        '''INSERT INTO user_game_totals (user_id, game, bets, wins, losses, draws, staked, won)
+        SELECT user_id, COALESCE(details->>'game', 'knb'),
+               COUNT(*),
+               COUNT(*) FILTER (WHERE details->>'outcome' = 'win'),
+               COUNT(*) FILTER (WHERE details->>'outcome' = 'loss'),
+               COUNT(*) FILTER (WHERE details->>'outcome' = 'draw'),
+               COALESCE(SUM((details->>'bet')::numeric), 0),
+               COALESCE(SUM(amount), 0)
+        FROM action_log_history
+        WHERE action_type = 'casino_result'
+        GROUP BY 1, 2
+        ON CONFLICT (user_id, game) DO NOTHING''',
+        '''INSERT INTO user_totals (user_id, promos_count, promos_amount, withdraw_count, withdrawn, support_requests)
+        SELECT user_id,
+               COUNT(*) FILTER (WHERE action_type = 'promo'),
+               COALESCE(SUM(amount) FILTER (WHERE action_type = 'promo'), 0),
+               COUNT(*) FILTER (WHERE action_type = 'withdraw_request'),
+               COALESCE(SUM(amount) FILTER (WHERE action_type = 'withdraw_request'), 0),
+               COUNT(*) FILTER (WHERE action_type = 'support_request')
+        FROM action_log_history
+        WHERE action_type IN ('promo', 'withdraw_request', 'support_request')
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO NOTHING''',
+    ]),
+    (10, 'withdrawals', [
+        '''DO $$ BEGIN
+            CREATE TYPE withdrawal_status AS ENUM ('pending', 'approved');
+        EXCEPTION WHEN duplicate_object THEN NULL;
+        END $$''',
+        # Заявки на вывод; log_id - строка withdraw_request в action_logs (по нему работают старые кнопки)
+        '''CREATE TABLE IF NOT EXISTS withdrawals (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            amount DECIMAL(10, 2) NOT NULL,
+            status withdrawal_status NOT NULL DEFAULT 'pending',
+            log_id BIGINT,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            approved_at TIMESTAMP,
+            approved_by BIGINT
+        )''',
+        """CREATE INDEX IF NOT EXISTS idx_withdrawals_pending
+        ON withdrawals (created_at) WHERE status = 'pending'""",
+        '''CREATE UNIQUE INDEX IF NOT EXISTS idx_withdrawals_log
+        ON withdrawals (log_id) WHERE log_id IS NOT NULL''',
+        # Переносим историю: заявка одобрена, если есть withdraw_approve с её request_id
+        '''INSERT INTO withdrawals (user_id, amount, status, log_id, created_at, approved_at, approved_by)
+        SELECT r.user_id, r.amount,
+               CASE WHEN a.id IS NULL THEN 'pending' ELSE 'approved' END::withdrawal_status,
+               r.id, r.created_at, a.created_at, a.user_id
+        FROM action_log_history r
+        LEFT JOIN LATERAL (
+            SELECT id, user_id, created_at FROM action_log_history
+            WHERE action_type = 'withdraw_approve' AND details->>'request_id' = r.id::text
+            ORDER BY id LIMIT 1
+        ) a ON TRUE
+        WHERE r.action_type = 'withdraw_request'
+        ORDER BY r.id
+        ON CONFLICT DO NOTHING''',
+    ]),
+    (11, 'support_tickets', [
+        '''DO $$ BEGIN
+            CREATE TYPE support_ticket_status AS ENUM ('open', 'answered');
+        EXCEPTION WHEN duplicate_object THEN NULL;
+        END $$''',
+        # Обращение в поддержку: новые сообщения пользователя дописываются в его открытый тикет
+        '''CREATE TABLE IF NOT EXISTS support_tickets (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            status support_ticket_status NOT NULL DEFAULT 'open',
+            last_message TEXT,
+            messages INTEGER NOT NULL DEFAULT 1,
+            assignee BIGINT,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            last_message_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            answered_at TIMESTAMP
+        )''',
+        # Не больше одного открытого тикета на пользователя; по этому же индексу читает /active_support
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_support_tickets_open
+        ON support_tickets (user_id) WHERE status = 'open'""",
+        # Неотвеченные обращения из action_logs становятся открытыми тикетами
+        '''INSERT INTO support_tickets (user_id, last_message, messages, created_at, last_message_at)
+        SELECT DISTINCT ON (r.user_id) r.user_id, r.details->>'text',
+               COUNT(*) OVER (PARTITION BY r.user_id), MIN(r.created_at) OVER (PARTITION BY r.user_id), r.created_at
+        FROM action_log_history r
+        WHERE r.action_type = 'support_request'
+        AND NOT EXISTS (
+            SELECT 1 FROM action_log_history a
+            WHERE a.action_type = 'support_replied' AND a.details->>'request_id' = r.id::text
+        )
+        ORDER BY r.user_id, r.created_at DESC, r.id DESC
+        ON CONFLICT DO NOTHING''',
+    ]),
+    (12, 'outbox', [
+        '''DO $$ BEGIN
+            CREATE TYPE outbox_status AS ENUM ('pending', 'sent', 'failed');
+        EXCEPTION WHEN duplicate_object THEN NULL;
+        END $$''',
+        # Уведомления пользователям и админам; payload в формате заданий рассылки (text, photo)
+        '''CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            payload JSONB NOT NULL,
+            status outbox_status NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            sent_at TIMESTAMP
+        )''',
+        # Диспетчер выбирает только ожидающие отправки строки, готовые к очередной попытке
+        """CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox (next_attempt_at) WHERE status = 'pending'""",
+    ]),
+]
+
+async def run_migrations(conn):
+    """Применяет недостающие миграции. Advisory lock не даёт двум инстансам выполнять DDL одновременно"""
+    await conn.execute('SELECT pg_advisory_lock($1)', MIGRATIONS_LOCK_ID)
+    try:
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+        applied = {row['version'] for row in await conn.fetch('SELECT version FROM schema_version')}
+
+        pending = [m for m in MIGRATIONS if m[0] not in applied]
+        if not pending:
+            print(f"[DB] Schema is up to date (version {max(applied)})")
+            return 0
+
+        for version, name, steps in pending:
+            async with conn.transaction():
+                for step in steps:
+                    if callable(step):
+                        await step(conn)
+                    else:
+                        await conn.execute(step)
+                await conn.execute(
+                    'INSERT INTO schema_version (version, name) VALUES ($1, $2)',
+                    version, name
+                )
+            print(f"[DB] Migration {version} applied: {name}")
+        return len(pending)
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATIONS_LOCK_ID)
+
 async def init_db_pool():
     global db_pool
     max_retries = 10
@@ -49,9 +997,11 @@ async def init_db_pool():
             print(f"[DB] Attempting connection {attempt + 1}/{max_retries}...")
             db_pool = await asyncpg.create_pool(
                 DATABASE_URL,
-                min_size=5,
-                max_size=10,
-                command_timeout=60
+                min_size=min(DB_POOL_MIN, pool_metrics.ceiling),
+                max_size=pool_metrics.ceiling,
+                command_timeout=DB_COMMAND_TIMEOUT,
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                init=init_pool_connection
             )
             print("[DB] Connection pool created successfully")
             break
@@ -64,296 +1014,148 @@ async def init_db_pool():
                 print(f"[DB] Failed to connect after {max_retries} attempts: {e}")
                 raise
 
-    # Создаём все необходимые таблицы
+    # Применяем недостающие миграции схемы
     async with db_pool.acquire() as conn:
-        try:
-            # Таблица связей рефералов
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS referral_connections (
-                    user_id BIGINT PRIMARY KEY,
-                    referrer_id BIGINT NOT NULL,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-            
-            # Таблица каналов для подписки
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS required_channels (
-                    channel_id BIGINT PRIMARY KEY,
-                    url TEXT NOT NULL,
-                    name TEXT NOT NULL
-                )
-            ''')
-            
-            # Таблица джекпота
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS jackpot (
-                    id INTEGER PRIMARY KEY DEFAULT 1,
-                    amount DECIMAL(15, 2) DEFAULT 20.0,
-                    CONSTRAINT single_row CHECK (id = 1)
-                )
-            ''')
-            # Инициализация джекпота если его нет
-            await conn.execute('''
-                INSERT INTO jackpot (id, amount) 
-                VALUES (1, 20.0) 
-                ON CONFLICT (id) DO NOTHING
-            ''')
-
-            # Таблица пользователей
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    username TEXT,
-                    balance DECIMAL(10, 2) DEFAULT 0,
-                    refs INTEGER DEFAULT 0,
-                    last_bonus BIGINT DEFAULT 0,
-                    used_promos TEXT[] DEFAULT ARRAY[]::TEXT[]
-                )
-            ''')
-
-            # Таблица состояний пользователей
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS user_states (
-                    user_id BIGINT PRIMARY KEY,
-                    state_data TEXT,
-                    updated_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            # Таблица использованных кнопок
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS used_buttons (
-                    user_id BIGINT,
-                    button_id TEXT,
-                    used_at TIMESTAMP DEFAULT NOW(),
-                    PRIMARY KEY (user_id, button_id)
-                )
-            ''')
-
-            # Таблица ожидающих рефералов
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS pending_referrals (
-                    user_id BIGINT PRIMARY KEY,
-                    referrer_id BIGINT NOT NULL,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            # Таблица сессий пользователей
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS user_sessions (
-                    user_id BIGINT PRIMARY KEY,
-                    session_count INTEGER DEFAULT 0,
-                    last_activity TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            # Таблица промокодов
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS promos (
-                    code TEXT PRIMARY KEY,
-                    reward DECIMAL(10, 2) NOT NULL,
-                    uses INTEGER DEFAULT 0
-                )
-            ''')
-
-            # Таблица турниров
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS tournaments (
-                    id SERIAL PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    start_time BIGINT NOT NULL,
-                    end_time BIGINT NOT NULL,
-                    duration_days INTEGER NOT NULL,
-                    prize_places INTEGER NOT NULL,
-                    prizes JSONB NOT NULL,
-                    trophy_file_ids JSONB NOT NULL,
-                    status TEXT DEFAULT 'active',
-                    start_message TEXT,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            # Таблица участников турнира
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS tournament_participants (
-                    tournament_id INTEGER REFERENCES tournaments(id) ON DELETE CASCADE,
-                    user_id BIGINT NOT NULL,
-                    refs_count INTEGER DEFAULT 0,
-                    PRIMARY KEY (tournament_id, user_id)
-                )
-            ''')
-
-            # Таблица наград пользователей
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS user_trophies (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    tournament_id INTEGER REFERENCES tournaments(id),
-                    tournament_name TEXT NOT NULL,
-                    place INTEGER NOT NULL,
-                    trophy_file_id TEXT NOT NULL,
-                    prize_stars DECIMAL(10, 2) NOT NULL,
-                    date_received BIGINT NOT NULL,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            # Таблица состояния создания турнира (для админа)
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS admin_tournament_creation (
-                    admin_id BIGINT PRIMARY KEY,
-                    step TEXT NOT NULL,
-                    data TEXT DEFAULT '{}',
-                    updated_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-
-            # Таблица логов (для статистики)
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS action_logs (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    action_type TEXT NOT NULL,
-                    amount DECIMAL(10, 2) DEFAULT 0,
-                    details JSONB,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
+        applied = await run_migrations(conn)
+        await ensure_action_log_partitions(conn)
 
-            print("[DB] All tables initialized successfully")
+    # Соединения, открытые до изменения схемы, переоткрываются и готовят запросы заново
+    if applied:
+        await db_pool.expire_connections()
 
-            # Миграция: добавляем колонку start_message если её нет
-            try:
-                await conn.execute('''
-                    ALTER TABLE tournaments 
-                    ADD COLUMN IF NOT EXISTS start_message TEXT
-                ''')
-                print("[DB] Migration: start_message column ensured")
-            except Exception as migration_error:
-                print(f"[DB] Migration note: {migration_error}")
+class BackgroundFlusher:
+    """Фоновая задача: step() раз в interval секунд или раньше, по wakeup.
+    stop() не отменяет задачу, а дожидается идущего шага - отмена посреди записи потеряла бы
+    снятые с буфера данные, - после чего сбрасывает остаток через drain()"""
 
-        except Exception as e:
-            # If tables already exist, this is fine - just log and continue
-            print(f"[DB] Table initialization note: {e}")
-            print("[DB] Continuing with existing tables")
+    LOG_TAG = 'FLUSH'
 
-async def get_jackpot_amount():
-    async with db_pool.acquire() as conn:
-        amount = await conn.fetchval('SELECT amount FROM jackpot WHERE id = 1')
-        return float(amount) if amount is not None else 5.0
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.task = None
+        self.stopping = False
+        self.wakeup = asyncio.Event()
 
-async def add_to_jackpot(amount: float):
-    async with db_pool.acquire() as conn:
-        await conn.execute('UPDATE jackpot SET amount = amount + $1 WHERE id = 1', Decimal(str(amount)))
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
 
-async def reset_jackpot():
-    async with db_pool.acquire() as conn:
-        await conn.execute('UPDATE jackpot SET amount = 20.0 WHERE id = 1')
+    def has_pending(self) -> bool:
+        return False
 
-async def roll_fortune_wheel(user_id: int):
-    # Призы и вероятности (всего 2000 ед для точности 0.05%)
-    # 0.5 звезд -- 35% -> 700
-    # 1 звезда -- 25% -> 500
-    # 1.5 звезды -- 15% -> 300
-    # 2 звезды -- 10% -> 200
-    # 2.5 звезды -- 8% -> 160
-    # 3 звезды -- 4% -> 80
-    # 5 звезд -- 2% -> 40
-    # 10 звезд -- 0.6% -> 12
-    # 20 звезд -- 0.3% -> 6
-    # Джекпот -- 0.05% -> 1 (было 0.1% -> 2)
-    # Повышаем 0.5 звезд на 0.05% -> +1 -> 701
-    prizes = [
-        (0.5, 701), (1.0, 500), (1.5, 300), (2.0, 200), 
-        (2.5, 160), (3.0, 80), (5.0, 40), (10.0, 12), 
-        (20.0, 6), ("JACKPOT", 1)
-    ]
-    
-    total_weight = sum(p[1] for p in prizes)
-    rand_val = random.randint(1, total_weight)
-    
-    current_weight = 0
-    selected_prize = prizes[0][0]
-    for prize, weight in prizes:
-        current_weight += weight
-        if rand_val <= current_weight:
-            selected_prize = prize
-            break
-            
-    # Каждый прокрут добавляет 0.02 к джекпоту
-    await add_to_jackpot(0.02)
-    
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            # Проверяем последний бонус
-            row = await conn.fetchrow('SELECT last_bonus, username, name FROM users WHERE user_id = $1 FOR UPDATE', user_id)
-            if not row: return None, "user_not_found"
-            
-            now = time.time()
-            if now - row['last_bonus'] < 86400:
-                return None, "cooldown"
-            
-            # Проверяем реферальную систему: награждаем пригласителя, если это первый прокрут
-            if row['last_bonus'] == 0:
-                async with db_pool.acquire() as conn_ref:
-                    ref_id = await conn_ref.fetchval('SELECT referrer_id FROM referral_connections WHERE user_id = $1', user_id)
-                    if ref_id:
-                        print(f"[REFERRAL] First spin! Rewarding referrer {ref_id} for user {user_id}")
-                        await conn_ref.execute('UPDATE users SET balance = balance + 2, refs = refs + 1 WHERE user_id = $1', ref_id)
-                        await log_action(ref_id, 'referral_reward', 2, {'referred_user': user_id})
-                        try:
-                            await bot.send_message(ref_id, f"🎁 <b>Ваш реферал открыл свой первый кейс!</b>\n\nВам начислено 2 ⭐️", parse_mode='HTML')
-                        except: pass
-
-            reward_amount = 0.0
-            is_jackpot = False
-            
-            if selected_prize == "JACKPOT":
-                is_jackpot = True
-                reward_amount = await get_jackpot_amount()
-                await reset_jackpot()
-                
-                # Уведомление админу
-                try:
-                    admin_text = (
-                        f"🎰 <b>ДЖЕКПОТ ВЫБИТ!</b>\n\n"
-                        f"👤 Пользователь: {row['name']} (@{row['username'] if row['username'] else 'нет'})\n"
-                        f"🆔 ID: <code>{user_id}</code>\n"
-                        f"💰 Сумма джекпота: {reward_amount:.2f} ⭐️"
-                    )
-                    await bot.send_message(ADMIN_ID, admin_text, parse_mode="HTML")
-                except Exception as e:
-                    print(f"Error sending jackpot notification: {e}")
-            else:
-                reward_amount = float(selected_prize)
-            
-            await conn.execute(
-                'UPDATE users SET balance = balance + $1, last_bonus = $2 WHERE user_id = $3',
-                Decimal(str(reward_amount)), now, user_id
+    async def step(self) -> bool:
+        """Один проход; True - следующий нужен сразу, без ожидания"""
+        await self.flush()
+        return False
+
+    def log_failure(self, error: Exception):
+        print(f"[{self.LOG_TAG}] Flush failed: {error}")
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                if await self.step():
+                    continue
+            except Exception as e:
+                self.log_failure(e)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def start(self):
+        if not self.running:
+            self.stopping = False
+            self.wakeup.clear()
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        await self.drain()
+
+    async def drain(self):
+        if self.has_pending() and db_pool:
+            await self.flush()
+
+class JackpotAccumulator(BackgroundFlusher):
+    """Прирост джекпота копится в процессе и уходит в строку jackpot одним UPDATE раз в
+    JACKPOT_FLUSH_SECONDS, а не отдельной записью на каждый прокрут. Сумма для показа кэшируется"""
+
+    def __init__(self, flush_seconds: float, cache_ttl: float):
+        super().__init__(flush_seconds)
+        self.cache_ttl = cache_ttl
+        self.pending = Decimal('0')
+        self.cached = None
+        self.cached_at = 0.0
+
+    def has_pending(self) -> bool:
+        return bool(self.pending)
+
+    def log_failure(self, error: Exception):
+        print(f"[JACKPOT] Flush failed, {self.pending} kept in memory: {error}")
+
+    def add(self, amount: float):
+        self.pending += Decimal(str(amount))
+
+    async def flush(self):
+        if not self.pending:
+            return
+        amount, self.pending = self.pending, Decimal('0')
+        try:
+            async with acquire_conn() as conn:
+                await conn.execute('UPDATE jackpot SET amount = amount + $1 WHERE id = 1', amount)
+        except (Exception, asyncio.CancelledError):
+            # Прирост возвращается и при отмене, иначе он пропал бы вместе с задачей
+            self.pending += amount
+            raise
+
+    async def amount(self) -> float:
+        now = time.monotonic()
+        if self.cached is None or now - self.cached_at > self.cache_ttl:
+            async with acquire_conn() as conn:
+                amount = await conn.fetchval('SELECT amount FROM jackpot WHERE id = 1')
+            self.cached = float(amount) if amount is not None else 5.0
+            self.cached_at = now
+        return self.cached + float(self.pending)
+
+    async def claim(self, conn) -> tuple:
+        """Забирает банк и сбрасывает его до JACKPOT_BASE одним запросом в транзакции вызывающего;
+        накопленный здесь прирост входит в выигрыш. Возвращает (выигрыш, забранный прирост):
+        если транзакция потом откатится, прирост возвращается через restore()"""
+        pending, self.pending = self.pending, Decimal('0')
+        try:
+            amount = await conn.fetchval(
+                '''WITH pot AS (SELECT amount FROM jackpot WHERE id = 1 FOR UPDATE)
+                   UPDATE jackpot SET amount = $2
+                   FROM pot WHERE jackpot.id = 1
+                   RETURNING pot.amount + $1''',
+                pending, Decimal(str(JACKPOT_BASE))
             )
-            
-            return {
-                "amount": reward_amount,
-                "is_jackpot": is_jackpot
-            }, None
+        except (Exception, asyncio.CancelledError):
+            self.pending += pending
+            raise
+        self.cached = None
+        return (float(amount) if amount is not None else 0.0), pending
+
+    def restore(self, amount: Decimal):
+        self.pending += amount
+
+jackpot = JackpotAccumulator(JACKPOT_FLUSH_SECONDS, JACKPOT_CACHE_TTL)
 
 async def get_jackpot_amount():
-    async with db_pool.acquire() as conn:
-        amount = await conn.fetchval('SELECT amount FROM jackpot WHERE id = 1')
-        return float(amount) if amount is not None else 5.0
+    return await jackpot.amount()
 
 async def add_to_jackpot(amount: float):
-    async with db_pool.acquire() as conn:
-        await conn.execute('UPDATE jackpot SET amount = amount + $1 WHERE id = 1', Decimal(str(amount)))
-
-async def reset_jackpot():
-    async with db_pool.acquire() as conn:
-        await conn.execute('UPDATE jackpot SET amount = 20.0 WHERE id = 1')
+    jackpot.add(amount)
 
 async def roll_fortune_wheel(user_id: int):
+    """Открытие ежедневного кейса: приз, награда пригласителю, джекпот, логи и уведомления (через outbox) -
+    в одной транзакции на одном соединении (в апдейте - соединении самого апдейта)"""
     # Призы и вероятности (всего 2000 ед для точности 0.05%)
     # 0.5 звезд -- 35% -> 700
     # 1 звезда -- 25% -> 500
@@ -382,63 +1184,78 @@ async def roll_fortune_wheel(user_id: int):
         if rand_val <= current_weight:
             selected_prize = prize
             break
+
+    import json
+    # Прирост джекпота в памяти, который надо вернуть, если транзакция откатится:
+    # забранный claim() минус вклад самого прокрута
+    taken = contributed = Decimal('0')
+    try:
+        async with acquire_conn() as conn:
+            async with conn.transaction():
+                # Проверяем последний бонус
+                row = await conn.fetchrow('SELECT last_bonus, username, name FROM users WHERE user_id = $1 FOR UPDATE', user_id)
+                if not row: return None, "user_not_found"
             
-    # Каждый прокрут добавляет 0.02 к джекпоту
-    await add_to_jackpot(0.02)
-    
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            # Проверяем последний бонус
-            row = await conn.fetchrow('SELECT last_bonus, username, name FROM users WHERE user_id = $1 FOR UPDATE', user_id)
-            if not row: return None, "user_not_found"
-            
-            now = time.time()
-            if now - row['last_bonus'] < 86400:
-                return None, "cooldown"
+                now = time.time()
+                if now - row['last_bonus'] < 86400:
+                    return None, "cooldown"
+
+                # Каждый прокрут добавляет 0.02 к джекпоту; нажатия во время кулдауна - не прокруты
+                await add_to_jackpot(0.02)
+                contributed = Decimal('0.02')
             
-            # Проверяем реферальную систему: награждаем пригласителя, если это первый прокрут
-            if row['last_bonus'] == 0:
-                async with db_pool.acquire() as conn_ref:
-                    ref_id = await conn_ref.fetchval('SELECT referrer_id FROM referral_connections WHERE user_id = $1', user_id)
+                # Проверяем реферальную систему: награждаем пригласителя, если это первый прокрут.
+                # Всё на том же соединении: второе соединение из пула под FOR UPDATE исчерпывало пул
+                if row['last_bonus'] == 0:
+                    ref_id = await conn.fetchval(
+                        '''UPDATE users SET balance = balance + 2, refs = refs + 1
+                           WHERE user_id = (SELECT referrer_id FROM referral_connections WHERE user_id = $1)
+                           RETURNING user_id''',
+                        user_id
+                    )
                     if ref_id:
                         print(f"[REFERRAL] First spin! Rewarding referrer {ref_id} for user {user_id}")
-                        await conn_ref.execute('UPDATE users SET balance = balance + 2, refs = refs + 1 WHERE user_id = $1', ref_id)
-                        await log_action(ref_id, 'referral_reward', 2, {'referred_user': user_id})
-                        try:
-                            await bot.send_message(ref_id, f"🎁 <b>Ваш реферал открыл свой первый кейс!</b>\n\nВам начислено 2 ⭐️", parse_mode='HTML')
-                        except: pass
-
-            reward_amount = 0.0
-            is_jackpot = False
+                        await run_prepared(
+                            conn, 'log_action', 'execute',
+                            ref_id, 'referral_reward', Decimal('2'), json.dumps({'referred_user': user_id})
+                        )
+                        await enqueue_notification(conn, ref_id, "🎁 <b>Ваш реферал открыл свой первый кейс!</b>\n\nВам начислено 2 ⭐️")
+
+                reward_amount = 0.0
+                is_jackpot = False
             
-            if selected_prize == "JACKPOT":
-                is_jackpot = True
-                reward_amount = await get_jackpot_amount()
-                await reset_jackpot()
+                if selected_prize == "JACKPOT":
+                    is_jackpot = True
+                    reward_amount, taken = await jackpot.claim(conn)
                 
-                # Уведомление админу
-                try:
+                    # Уведомление админу
                     admin_text = (
                         f"🎰 <b>ДЖЕКПОТ ВЫБИТ!</b>\n\n"
                         f"👤 Пользователь: {row['name']} (@{row['username'] if row['username'] else 'нет'})\n"
                         f"🆔 ID: <code>{user_id}</code>\n"
                         f"💰 Сумма джекпота: {reward_amount:.2f} ⭐️"
                     )
-                    await bot.send_message(ADMIN_ID, admin_text, parse_mode="HTML")
-                except Exception as e:
-                    print(f"Error sending jackpot notification: {e}")
-            else:
-                reward_amount = float(selected_prize)
+                    await enqueue_notification(conn, ADMIN_ID, admin_text)
+                else:
+                    reward_amount = float(selected_prize)
             
-            await conn.execute(
-                'UPDATE users SET balance = balance + $1, last_bonus = $2 WHERE user_id = $3',
-                Decimal(str(reward_amount)), now, user_id
-            )
+                await conn.execute(
+                    'UPDATE users SET balance = balance + $1, last_bonus = $2 WHERE user_id = $3',
+                    Decimal(str(reward_amount)), now, user_id
+                )
+                if is_jackpot:
+                    await run_prepared(
+                        conn, 'log_action', 'execute',
+                        user_id, 'jackpot_win', Decimal(str(reward_amount)), None
+                    )
             
-            return {
-                "amount": reward_amount,
-                "is_jackpot": is_jackpot
-            }, None
+                return {
+                    "amount": reward_amount,
+                    "is_jackpot": is_jackpot
+                }, None
+    except (Exception, asyncio.CancelledError):
+        jackpot.restore(taken - contributed)
+        raise
 
 @dp.message(Command("jackpot"))
 async def admin_jackpot_cmd(message: types.Message):
@@ -451,58 +1268,317 @@ async def close_db_pool():
         await db_pool.close()
         print("[DB] Connection pool closed")
 
+# ===== ЕДИНИЦА РАБОТЫ НА АПДЕЙТ =====
+
+class RequestScope:
+    """Одно соединение из пула на всю обработку апдейта, берётся лениво при первом запросе"""
+
+    def __init__(self):
+        self.owner = asyncio.current_task()
+        self.conn = None
+        self.depth = 0
+
+    async def get(self):
+        if self.conn is None:
+            self.conn = await pool_metrics.checkout()
+        return self.conn
+
+    async def release(self):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            await pool_metrics.checkin(conn)
+
+request_scope = contextvars.ContextVar('request_scope', default=None)
+
+def current_scope():
+    # Задачи, порождённые обработчиком, наследуют контекст, но соединение не делят
+    scope = request_scope.get()
+    if scope is not None and scope.owner is asyncio.current_task():
+        return scope
+    return None
+
+@asynccontextmanager
+async def acquire_conn():
+    """Соединение текущего апдейта, а вне апдейта (фоновые задачи) - обычное из пула"""
+    scope = current_scope()
+    if scope is None:
+        conn = await pool_metrics.checkout()
+        try:
+            yield conn
+        finally:
+            await pool_metrics.checkin(conn)
+        return
+
+    conn = await scope.get()
+    scope.depth += 1
+    try:
+        yield conn
+    finally:
+        scope.depth -= 1
+
+async def release_request_conn():
+    """Возвращает соединение апдейта в пул, если оно сейчас не используется;
+    следующий запрос в этом апдейте возьмёт новое"""
+    scope = current_scope()
+    if scope is not None and scope.depth == 0:
+        await scope.release()
+
+async def animation_pause(seconds: float):
+    """Пауза под анимацию: соединение апдейта возвращается в пул, чтобы не простаивало"""
+    await release_request_conn()
+    await asyncio.sleep(seconds)
+
+@dp.update.outer_middleware()
+async def request_scope_middleware(handler, event, data):
+    scope = RequestScope()
+    token = request_scope.set(scope)
+    try:
+        user = data.get('event_from_user')
+        # Пользователь снова пишет боту или жмёт кнопки - возвращаем его в рассылки.
+        # Соединение остаётся в scope и достаётся обработчику апдейта
+        if user is not None and (event.message or event.callback_query):
+            try:
+                await mark_user_reachable(user.id)
+            except Exception as e:
+                print(f"[USER] Failed to mark {user.id} reachable: {e}")
+        return await handler(event, data)
+    finally:
+        request_scope.reset(token)
+        await scope.release()
+
+class StateCache(BackgroundFlusher):
+    """Состояния пользователей в памяти процесса: LRU с TTL, ограниченный по числу записей и примерному объёму.
+
+    value - текущее состояние в памяти (часть состояний, как и раньше, в БД не пишется),
+    stored - сериализованное значение, которое есть (или вот-вот будет) в user_states.
+    Запись в БД только при изменении stored; изменения копятся в dirty и уходят пачкой.
+    Вытеснение не теряет несохранённые изменения: dirty живёт отдельно от LRU.
+
+    Строка, прочитанная из БД параллельно со сбросом, может ещё не содержать записанного значения.
+    Поэтому для пользователя с записью в dirty, в идущем сбросе (flushing) или в двух последних
+    сбросах (written) значение из БД не используется - берётся то, что записал этот процесс"""
+
+    MISSING = object()
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int, flush_seconds: float):
+        super().__init__(flush_seconds)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.dirty = {}
+        self.flushing = {}
+        self.written = {}
+        self.written_before = {}
+        self.bytes = 0
+        self.writes = 0
+        self.skipped = 0
+        self.evicted = 0
+
+    @staticmethod
+    def serialize(value):
+        import json
+        return json.dumps(value) if isinstance(value, dict) else value
+
+    @staticmethod
+    def entry_size(entry: dict) -> int:
+        size = StateCache.ENTRY_OVERHEAD
+        for key in ('value', 'stored'):
+            value = entry[key]
+            if isinstance(value, dict):
+                size += len(StateCache.serialize(value))
+            elif isinstance(value, str):
+                size += len(value)
+        return size
+
+    def entry(self, user_id: int):
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        if entry['expires_at'] <= time.monotonic():
+            self.drop(user_id)
+            return None
+        self.entries.move_to_end(user_id)
+        return entry
+
+    def drop(self, user_id: int):
+        entry = self.entries.pop(user_id)
+        self.bytes -= entry['size']
+
+    def put(self, user_id: int, entry: dict):
+        if user_id in self.entries:
+            self.drop(user_id)
+        entry['expires_at'] = time.monotonic() + self.ttl
+        entry['size'] = self.entry_size(entry)
+        self.entries[user_id] = entry
+        self.bytes += entry['size']
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            oldest = next(iter(self.entries))
+            self.drop(oldest)
+            self.evicted += 1
+
+    def get(self, user_id: int):
+        """Состояние из памяти или None"""
+        entry = self.entry(user_id)
+        if entry is not None and entry['value'] is not self.MISSING:
+            return entry['value']
+        if entry is None:
+            change = self.dirty.get(user_id) or self.flushing.get(user_id)
+            if change:
+                return change[0]
+        return None
+
+    def own_write(self, user_id: int):
+        """Сериализованное значение, которое этот процесс пишет или недавно записал в БД, иначе MISSING"""
+        for changes in (self.dirty, self.flushing, self.written, self.written_before):
+            if user_id in changes:
+                return changes[user_id][1]
+        return self.MISSING
+
+    def set(self, user_id: int, value, persist: bool = True):
+        entry = self.entry(user_id) or {'value': self.MISSING, 'stored': self.MISSING}
+        entry['value'] = value
+        if persist:
+            stored = self.serialize(value)
+            if stored == entry['stored']:
+                self.skipped += 1
+            else:
+                entry['stored'] = stored
+                self.dirty[user_id] = (value, stored)
+                self.writes += 1
+        self.put(user_id, entry)
+
+    def stored(self, user_id: int, state_data):
+        """Запоминает state_data, прочитанное из БД; возвращает значение с учётом несохранённой записи"""
+        own = self.own_write(user_id)
+        if own is not self.MISSING:
+            # Строка из БД могла быть прочитана до коммита нашей записи - stored не трогаем
+            return own
+        entry = self.entry(user_id) or {'value': self.MISSING, 'stored': self.MISSING}
+        entry['stored'] = state_data
+        self.put(user_id, entry)
+        return state_data
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        self.flushing, self.dirty = self.dirty, {}
+        batch = self.flushing
+        updates = [(user_id, stored) for user_id, (_, stored) in batch.items() if stored is not None]
+        deletes = [user_id for user_id, (_, stored) in batch.items() if stored is None]
+        try:
+            async with acquire_conn() as conn:
+                async with conn.transaction():
+                    if updates:
+                        await run_prepared(conn, 'set_user_state', 'executemany', updates)
+                    if deletes:
+                        await conn.execute('DELETE FROM user_states WHERE user_id = ANY($1::bigint[])', deletes)
+        except (Exception, asyncio.CancelledError):
+            # Возвращаем в очередь то, что не успели перезаписать новыми значениями
+            for user_id, change in batch.items():
+                self.dirty.setdefault(user_id, change)
+            raise
+        else:
+            self.written_before, self.written = self.written, batch
+        finally:
+            self.flushing = {}
+
+    def has_pending(self) -> bool:
+        return bool(self.dirty)
+
+    def log_failure(self, error: Exception):
+        print(f"[STATE] Flush failed, {len(self.dirty)} states kept in memory: {error}")
+
+    def snapshot(self) -> dict:
+        return {
+            'size': len(self.entries),
+            'bytes': self.bytes,
+            'dirty': len(self.dirty) + len(self.flushing),
+            'writes': self.writes,
+            'skipped': self.skipped,
+            'evicted': self.evicted,
+        }
+
+state_cache = StateCache(STATE_CACHE_TTL, STATE_CACHE_MAX_ENTRIES, STATE_CACHE_MAX_BYTES, STATE_FLUSH_SECONDS)
+
 async def get_user_state(user_id: int):
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            'SELECT state_data FROM user_states WHERE user_id = $1',
-            user_id
-        )
-        return row['state_data'] if row else None
+    own = state_cache.own_write(user_id)
+    if own is not state_cache.MISSING:
+        return own
+    async with acquire_conn() as conn:
+        row = await run_prepared(conn, 'get_user_state', 'fetchrow', user_id)
+        return state_cache.stored(user_id, row['state_data'] if row else None)
 
 async def set_user_state(user_id: int, state_data):
-    import json
-    async with db_pool.acquire() as conn:
-        # Если это уже строка, мы не пытаемся её сериализовать повторно
-        # Но для надежности проверяем, является ли она валидным JSON
-        if isinstance(state_data, dict):
-            state_data = json.dumps(state_data)
-        elif state_data is None:
-            state_data = None
-
-        await conn.execute(
-            '''INSERT INTO user_states (user_id, state_data, updated_at) 
-               VALUES ($1, $2, NOW())
-               ON CONFLICT (user_id) 
-               DO UPDATE SET state_data = $2, updated_at = NOW()''',
-            user_id, state_data
-        )
+    """Состояние сразу видно в state_cache, в user_states оно попадёт при следующем сбросе"""
+    state_cache.set(user_id, state_data)
 
 async def delete_user_state(user_id: int):
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            'DELETE FROM user_states WHERE user_id = $1',
-            user_id
-        )
+    state_cache.set(user_id, None)
+
+class ButtonDedup:
+    """Нажатые кнопки за последние ttl секунд. Ключ хранится как хэш (int), значение - момент истечения.
+    TTL у всех записей одинаковый, поэтому порядок вставки совпадает с порядком истечения:
+    просроченные и лишние записи снимаются с начала OrderedDict за O(1)"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.evicted = 0
+
+    def prune(self, now: float):
+        entries = self.entries
+        while entries:
+            key, expires_at = next(iter(entries.items()))
+            if expires_at > now and len(entries) < self.max_entries:
+                break
+            entries.popitem(last=False)
+            if expires_at > now:
+                self.evicted += 1
+
+    def seen(self, key) -> bool:
+        expires_at = self.entries.get(hash(key))
+        return expires_at is not None and expires_at > time.monotonic()
+
+    def add(self, key) -> bool:
+        """Помечает кнопку нажатой; False, если она уже была нажата"""
+        now = time.monotonic()
+        key = hash(key)
+        expires_at = self.entries.get(key)
+        if expires_at is not None and expires_at > now:
+            self.hits += 1
+            return False
+        self.entries.pop(key, None)
+        self.prune(now)
+        self.entries[key] = now + self.ttl
+        return True
+
+    def snapshot(self) -> dict:
+        return {'size': len(self.entries), 'hits': self.hits, 'evicted': self.evicted}
+
+button_dedup = ButtonDedup(BUTTON_DEDUP_TTL, BUTTON_DEDUP_MAX)
 
 async def is_button_used(user_id: int, button_id: str) -> bool:
-    async with db_pool.acquire() as conn:
-        result = await conn.fetchval(
-            'SELECT EXISTS(SELECT 1 FROM used_buttons WHERE user_id = $1 AND button_id = $2)',
-            user_id, button_id
-        )
+    if button_dedup.seen((user_id, button_id)):
+        return True
+    if not BUTTON_DEDUP_DB:
+        return False
+    async with acquire_conn() as conn:
+        result = await run_prepared(conn, 'is_button_used', 'fetchval', user_id, button_id)
         return result
 
 async def mark_button_used(user_id: int, button_id: str):
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            '''INSERT INTO used_buttons (user_id, button_id, used_at) 
-               VALUES ($1, $2, NOW())
-               ON CONFLICT (user_id, button_id) DO NOTHING''',
-            user_id, button_id
-        )
+    button_dedup.add((user_id, button_id))
+    if not BUTTON_DEDUP_DB:
+        return
+    async with acquire_conn() as conn:
+        await run_prepared(conn, 'mark_button_used', 'execute', user_id, button_id)
 
 async def get_pending_referral(user_id: int):
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         result = await conn.fetchval(
             'SELECT referrer_id FROM pending_referrals WHERE user_id = $1',
             user_id
@@ -510,7 +1586,7 @@ async def get_pending_referral(user_id: int):
         return result
 
 async def set_pending_referral(user_id: int, referrer_id: int):
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         await conn.execute(
             '''INSERT INTO pending_referrals (user_id, referrer_id, created_at) 
                VALUES ($1, $2, NOW())
@@ -520,34 +1596,92 @@ async def set_pending_referral(user_id: int, referrer_id: int):
         )
 
 async def delete_pending_referral(user_id: int):
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         await conn.execute(
             'DELETE FROM pending_referrals WHERE user_id = $1',
             user_id
         )
 
-async def get_user_session(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
-        result = await conn.fetchval(
-            'SELECT session_count FROM user_sessions WHERE user_id = $1',
-            user_id
+class SessionCounters(BackgroundFlusher):
+    """Приросты счётчиков сессий, ещё не записанные в user_sessions.
+
+    Значение из БД, прочитанное параллельно со сбросом, может уже включать уходящую пачку, а может нет.
+    Поэтому сброс запоминает значения, которые вернул upsert (committed, за два последних сброса),
+    а читатель ждёт завершения идущего сброса своего пользователя и берёт максимум из БД и committed:
+    счётчик только растёт, так что старое committed ничего не портит"""
+
+    def __init__(self, flush_seconds: float):
+        super().__init__(flush_seconds)
+        self.pending = {}
+        self.flushing = {}
+        self.committed = {}
+        self.committed_before = {}
+        self.flush_done = asyncio.Event()
+        self.flush_done.set()
+        self.flushed = 0
+
+    def increment(self, user_id: int):
+        self.pending[user_id] = self.pending.get(user_id, 0) + 1
+
+    async def current(self, user_id: int, db_count: int) -> int:
+        """Актуальный счётчик по значению, прочитанному из user_sessions.
+        Вызывается вне acquire_conn: на время ожидания сброса соединение апдейта отдаётся в пул,
+        иначе ждущие апдейты могут занять весь пул, и сброс не получит соединения"""
+        if user_id in self.flushing:
+            await release_request_conn()
+            await self.flush_done.wait()
+        db_count = max(
+            db_count or 0,
+            self.committed.get(user_id, 0),
+            self.committed_before.get(user_id, 0)
         )
-        return result if result is not None else 0
+        return db_count + self.pending.get(user_id, 0)
 
-async def increment_user_session(user_id: int) -> int:
-    async with db_pool.acquire() as conn:
-        result = await conn.fetchval(
-            '''INSERT INTO user_sessions (user_id, session_count, last_activity) 
-               VALUES ($1, 1, NOW())
-               ON CONFLICT (user_id) 
-               DO UPDATE SET session_count = user_sessions.session_count + 1, last_activity = NOW()
-               RETURNING session_count''',
-            user_id
-        )
-        return result
+    async def flush(self):
+        if not self.pending:
+            return
+        self.flushing, self.pending = self.pending, {}
+        self.flush_done = asyncio.Event()
+        try:
+            async with acquire_conn() as conn:
+                rows = await run_prepared(
+                    conn, 'flush_user_sessions', 'fetch',
+                    list(self.flushing), list(self.flushing.values())
+                )
+        except (Exception, asyncio.CancelledError):
+            # Не записали (или сброс отменён) - возвращаем приросты к новым, отправим при следующем сбросе
+            for user_id, delta in self.flushing.items():
+                self.pending[user_id] = self.pending.get(user_id, 0) + delta
+            raise
+        else:
+            self.committed_before, self.committed = self.committed, {row['user_id']: row['session_count'] for row in rows}
+            self.flushed += len(self.flushing)
+        finally:
+            self.flushing = {}
+            self.flush_done.set()
+
+    def has_pending(self) -> bool:
+        return bool(self.pending)
+
+    def log_failure(self, error: Exception):
+        print(f"[SESSION] Flush failed, {len(self.pending)} users kept in memory: {error}")
+
+    def snapshot(self) -> dict:
+        return {'pending': len(self.pending), 'flushed': self.flushed}
+
+session_counters = SessionCounters(SESSION_FLUSH_SECONDS)
+
+async def get_user_session(user_id: int) -> int:
+    async with acquire_conn() as conn:
+        result = await run_prepared(conn, 'get_user_session', 'fetchval', user_id)
+    return await session_counters.current(user_id, result)
+
+async def increment_user_session(user_id: int):
+    """Прирост уходит в БД пачкой вместе с остальными (session_counters)"""
+    session_counters.increment(user_id)
 
 async def cleanup_old_records():
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         deleted_buttons = await conn.execute(
             "DELETE FROM used_buttons WHERE used_at < NOW() - INTERVAL '24 hours'"
         )
@@ -557,15 +1691,74 @@ async def cleanup_old_records():
         deleted_refs = await conn.execute(
             "DELETE FROM pending_referrals WHERE created_at < NOW() - INTERVAL '24 hours'"
         )
+        await conn.execute(
+            "DELETE FROM outbox WHERE status <> 'pending' AND created_at < NOW() - INTERVAL '7 days'"
+        )
+        await ensure_action_log_partitions(conn)
+        await apply_action_log_retention(conn)
         print(f"[CLEANUP] Deleted old records")
 
+ROLLUP_STATEMENTS = [
+    '''INSERT INTO hourly_game_stats (hour, game, outcome, bets, staked, won)
+       SELECT date_trunc('hour', created_at), COALESCE(details->>'game', 'knb'), COALESCE(details->>'outcome', 'unknown'),
+              COUNT(*), COALESCE(SUM((details->>'bet')::numeric), 0), COALESCE(SUM(amount), 0)
+       FROM action_log_history
+       WHERE action_type = 'casino_result' AND created_at >= $1 AND created_at < $2
+       GROUP BY 1, 2, 3
+       ON CONFLICT (hour, game, outcome) DO UPDATE SET
+           bets = hourly_game_stats.bets + EXCLUDED.bets,
+           staked = hourly_game_stats.staked + EXCLUDED.staked,
+           won = hourly_game_stats.won + EXCLUDED.won''',
+    '''INSERT INTO hourly_action_counts (hour, action_type, count, amount)
+       SELECT date_trunc('hour', created_at), action_type, COUNT(*), COALESCE(SUM(amount), 0)
+       FROM action_log_history
+       WHERE created_at >= $1 AND created_at < $2
+       GROUP BY 1, 2
+       ON CONFLICT (hour, action_type) DO UPDATE SET
+           count = hourly_action_counts.count + EXCLUDED.count,
+           amount = hourly_action_counts.amount + EXCLUDED.amount''',
+    '''INSERT INTO hourly_active_users (hour, user_id)
+       SELECT DISTINCT date_trunc('hour', created_at), user_id
+       FROM action_log_history
+       WHERE created_at >= $1 AND created_at < $2
+       ON CONFLICT DO NOTHING''',
+]
+
+async def refresh_hourly_rollups() -> int:
+    """Переносит в почасовые агрегаты строки action_logs между водяной отметкой и NOW() - ROLLUP_LAG_SECONDS.
+    Отметка блокируется на время шага, поэтому несколько инстансов не посчитают одни строки дважды"""
+    steps = 0
+    while True:
+        async with acquire_conn() as conn:
+            async with conn.transaction():
+                window = await conn.fetchrow(
+                    '''SELECT processed_until AS lower,
+                              LEAST(processed_until + make_interval(hours => $2),
+                                    LOCALTIMESTAMP - make_interval(secs => $1)) AS upper,
+                              processed_until + make_interval(hours => $2) < LOCALTIMESTAMP - make_interval(secs => $1) AS behind
+                       FROM rollup_watermark WHERE name = 'hourly' FOR UPDATE''',
+                    ROLLUP_LAG_SECONDS, ROLLUP_MAX_WINDOW_HOURS
+                )
+                if window is None or window['upper'] <= window['lower']:
+                    return steps
+                for statement in ROLLUP_STATEMENTS:
+                    await conn.execute(statement, window['lower'], window['upper'])
+                await conn.execute(
+                    "UPDATE rollup_watermark SET processed_until = $1 WHERE name = 'hourly'",
+                    window['upper']
+                )
+        steps += 1
+        # Догоняем историю окнами по ROLLUP_MAX_WINDOW_HOURS, каждое в своей транзакции
+        if not window['behind']:
+            return steps
+
 async def get_required_channels():
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch('SELECT channel_id, url, name FROM required_channels')
+    async with acquire_conn() as conn:
+        rows = await run_prepared(conn, 'get_required_channels', 'fetch')
         return [dict(row) for row in rows]
 
 async def add_required_channel(channel_id: int, url: str, name: str):
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         await conn.execute(
             '''INSERT INTO required_channels (channel_id, url, name) 
                VALUES ($1, $2, $3)
@@ -574,26 +1767,116 @@ async def add_required_channel(channel_id: int, url: str, name: str):
         )
 
 async def remove_required_channel(channel_id: int):
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         await conn.execute('DELETE FROM required_channels WHERE channel_id = $1', channel_id)
 
+class ActionLogWriter(BackgroundFlusher):
+    """Буфер событий action_logs, сбрасывается в таблицу через COPY.
+    created_at проставляет БД в момент сброса, как и при обычном INSERT"""
+
+    COLUMNS = ('user_id', 'action_type', 'amount', 'details')
+    LOG_TAG = 'ACTION_LOG'
+
+    def __init__(self, flush_ms: int, batch_size: int, max_buffer: int):
+        super().__init__(flush_ms / 1000)
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self.buffer = deque()
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    def add(self, user_id: int, action_type: str, amount: float = 0, details: dict = None):
+        import json
+        if len(self.buffer) >= self.max_buffer:
+            # БД недоступна слишком долго - теряем самые старые события, а не память процесса
+            self.buffer.popleft()
+            self.dropped += 1
+        self.buffer.append((user_id, action_type, Decimal(str(amount)), json.dumps(details) if details else None))
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+
+    async def flush(self) -> int:
+        written = 0
+        while self.buffer:
+            batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+            try:
+                async with acquire_conn() as conn:
+                    await conn.copy_records_to_table('action_logs', records=batch, columns=self.COLUMNS)
+            except asyncio.CancelledError:
+                # Отмена посреди COPY не должна терять уже снятую с буфера пачку
+                self.buffer.extendleft(reversed(batch))
+                raise
+            except asyncpg.PostgresError as e:
+                # Пачку испортила конкретная строка - пишем по одной, чтобы не потерять остальные
+                self.failed_flushes += 1
+                print(f"[ACTION_LOG] COPY failed ({e}), falling back to row inserts")
+                written += await self.insert_rows(batch)
+                continue
+            except Exception as e:
+                # Соединение недоступно - возвращаем пачку в начало буфера до следующего сброса
+                self.failed_flushes += 1
+                self.buffer.extendleft(reversed(batch))
+                print(f"[ACTION_LOG] Flush failed, {len(self.buffer)} events kept in buffer: {e}")
+                break
+            written += len(batch)
+        if written:
+            self.written += written
+            self.flushes += 1
+        return written
+
+    async def insert_rows(self, batch) -> int:
+        written = 0
+        async with acquire_conn() as conn:
+            for record in batch:
+                try:
+                    await run_prepared(conn, 'log_action', 'fetchrow', *record)
+                    written += 1
+                except asyncpg.PostgresError as e:
+                    self.dropped += 1
+                    print(f"[ACTION_LOG] Dropped event {record[:2]}: {e}")
+        return written
+
+    def has_pending(self) -> bool:
+        return bool(self.buffer)
+
+    async def drain(self):
+        if self.buffer and db_pool:
+            written = await self.flush()
+            print(f"[ACTION_LOG] Flushed {written} events on shutdown")
+
+    def snapshot(self) -> dict:
+        return {
+            'buffered': len(self.buffer),
+            'written': self.written,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'dropped': self.dropped,
+        }
+
+action_log_writer = ActionLogWriter(ACTION_LOG_FLUSH_MS, ACTION_LOG_BATCH_SIZE, ACTION_LOG_MAX_BUFFER)
+
 async def log_action(user_id: int, action_type: str, amount: float = 0, details: dict = None):
+    """Событие уходит в буфер action_log_writer; без запущенного писателя пишется сразу"""
+    if action_log_writer.running:
+        action_log_writer.add(user_id, action_type, amount, details)
+        return
+    await log_action_now(user_id, action_type, amount, details)
+
+async def log_action_now(user_id: int, action_type: str, amount: float = 0, details: dict = None):
+    """Синхронная запись, когда нужен id строки (например, заявка на вывод)"""
     import json
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            '''INSERT INTO action_logs (user_id, action_type, amount, details, created_at) 
-               VALUES ($1, $2, $3, $4, NOW())
-               RETURNING id''',
+    async with acquire_conn() as conn:
+        row = await run_prepared(
+            conn, 'log_action', 'fetchrow',
             user_id, action_type, Decimal(str(amount)), json.dumps(details) if details else None
         )
         return row['id'] if row else None
 
 async def get_user(user_id: int):
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            'SELECT user_id, name, username, balance, refs, last_bonus, used_promos FROM users WHERE user_id = $1',
-            user_id
-        )
+    async with acquire_conn() as conn:
+        row = await run_prepared(conn, 'get_user', 'fetchrow', user_id)
         if row:
             return {
                 'user_id': row['user_id'],
@@ -607,32 +1890,183 @@ async def get_user(user_id: int):
         return None
 
 async def create_user(user_id: int, name: str, username: str = ''):
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            '''INSERT INTO users (user_id, name, username, balance, refs, last_bonus, used_promos) 
-               VALUES ($1, $2, $3, 0, 0, 0, ARRAY[]::TEXT[])
-               ON CONFLICT (user_id) DO NOTHING''',
-            user_id, name, username
-        )
+    async with acquire_conn() as conn:
+        await run_prepared(conn, 'create_user', 'execute', user_id, name, username)
         print(f"[USER] Created new user {user_id}: {name}")
 
-async def update_user_balance(user_id: int, delta: float):
-    async with db_pool.acquire() as conn:
+@dataclass
+class UserContext:
+    """Всё, что нужно обработчику о пользователе, за один запрос к БД"""
+    user_id: int
+    name: str
+    username: str
+    balance: float
+    refs: int
+    last_bonus: float
+    used_promos: list
+    session: int
+    state_data: str
+    button_used: bool
+    created: bool
+
+    @property
+    def user(self) -> dict:
+        # Тот же формат, что возвращает get_user
+        return {
+            'user_id': self.user_id,
+            'name': self.name,
+            'username': self.username,
+            'balance': self.balance,
+            'refs': self.refs,
+            'last_bonus': self.last_bonus,
+            'used_promos': self.used_promos
+        }
+
+    @property
+    def state(self):
+        import json
+        if not self.state_data:
+            return None
+        try:
+            return json.loads(self.state_data)
+        except (TypeError, ValueError):
+            return self.state_data
+
+async def load_user_context(user_id: int, name: str, username: str = '', msg_id: int = None,
+                            create: bool = True) -> UserContext:
+    """Создаёт пользователя при необходимости и возвращает его строку, счётчик сессии, состояние
+    и признак повторного нажатия кнопки (если передан msg_id, кнопка сразу помечается использованной).
+    Нажатия проверяются по button_dedup, в used_buttons они пишутся только при BUTTON_DEDUP_DB.
+    С create=False пользователь не создаётся, и для неизвестного возвращается None"""
+    if not create:
+        async with acquire_conn() as conn:
+            row = await run_prepared(conn, 'load_existing_user_context', 'fetchrow', user_id)
+        if not row:
+            return None
+        return await build_user_context(row, msg_id)
+
+    async with acquire_conn() as conn:
+        row = None
+        # Пустой результат возможен, только если пользователя параллельно создал другой апдейт
+        for _ in range(2):
+            row = await run_prepared(conn, 'load_user_context', 'fetchrow', user_id, name, username)
+            if row:
+                break
+
+    if row['created']:
+        print(f"[USER] Created new user {user_id}: {name}")
+    return await build_user_context(row, msg_id)
+
+async def build_user_context(row, msg_id: int = None) -> UserContext:
+    """UserContext по строке load_user_context или load_existing_user_context"""
+    user_id = row['user_id']
+    # Счётчик с приростом, ещё не сброшенным в user_sessions; читается после запроса, см. SessionCounters
+    session = await session_counters.current(user_id, row['session_count'])
+    button_used = False
+    if msg_id is not None:
+        # Ключ в формате button_id из used_buttons: пользователь, сообщение, номер сессии.
+        # В used_buttons пишется тот же ключ, поэтому запись идёт после подсчёта session
+        button_id = f"{user_id}:{msg_id}:{session}"
+        button_used = not button_dedup.add((user_id, button_id))
+        if not button_used and BUTTON_DEDUP_DB:
+            async with acquire_conn() as conn:
+                inserted = await run_prepared(conn, 'mark_button_used', 'fetchval', user_id, button_id)
+            button_used = inserted is None
+    return UserContext(
+        user_id=row['user_id'],
+        name=row['name'],
+        username=row['username'],
+        balance=float(row['balance']),
+        refs=row['refs'],
+        last_bonus=row['last_bonus'],
+        used_promos=row['used_promos'] or [],
+        session=session,
+        state_data=state_cache.stored(user_id, row['state_data']),
+        button_used=button_used,
+        created=row['created']
+    )
+
+def is_unreachable_error(error: Exception) -> bool:
+    """Пользователь заблокировал бота, удалил аккаунт или чат не существует"""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    return isinstance(error, TelegramBadRequest) and 'chat not found' in str(error).lower()
+
+async def mark_users_unreachable(user_ids: list):
+    """Исключает пользователей из массовых рассылок"""
+    if not user_ids:
+        return
+    async with acquire_conn() as conn:
         await conn.execute(
-            'UPDATE users SET balance = balance + $1 WHERE user_id = $2',
-            Decimal(str(delta)), user_id
+            'UPDATE users SET reachable = FALSE, unreachable_at = NOW() WHERE user_id = ANY($1::bigint[]) AND reachable',
+            list(user_ids)
         )
+    print(f"[USER] Marked {len(user_ids)} users as unreachable")
+
+async def mark_user_reachable(user_id: int):
+    async with acquire_conn() as conn:
+        await run_prepared(conn, 'mark_user_reachable', 'execute', user_id)
+
+async def update_user_balance(user_id: int, delta: float):
+    async with acquire_conn() as conn:
+        await run_prepared(conn, 'update_user_balance', 'execute', Decimal(str(delta)), user_id)
 
 async def get_user_balance(user_id: int) -> float:
-    async with db_pool.acquire() as conn:
-        balance = await conn.fetchval(
-            'SELECT balance FROM users WHERE user_id = $1',
-            user_id
-        )
+    async with acquire_conn() as conn:
+        balance = await run_prepared(conn, 'get_user_balance', 'fetchval', user_id)
         return float(balance) if balance is not None else 0
 
+async def settle_bet(user_id: int, game: str, bet: float, payout: float, outcome: str):
+    """Списывает ставку, начисляет выигрыш, пишет casino_bet/casino_result и обновляет
+    user_game_totals одним запросом.
+    Возвращает новый баланс или None, если на балансе уже не хватает на ставку"""
+    import json
+    async with acquire_conn() as conn:
+        balance = await run_prepared(
+            conn, 'settle_bet', 'fetchval',
+            user_id, Decimal(str(bet)), Decimal(str(payout)),
+            json.dumps({'game': game}),
+            json.dumps({'game': game, 'bet': bet, 'outcome': outcome}),
+            game, outcome
+        )
+    return float(balance) if balance is not None else None
+
+async def reserve_bet(user_id: int, game: str, bet: float):
+    """Списывает ставку и пишет casino_bet одним запросом.
+    Возвращает новый баланс или None, если на балансе не хватает на ставку"""
+    import json
+    async with acquire_conn() as conn:
+        balance = await run_prepared(
+            conn, 'reserve_bet', 'fetchval',
+            user_id, Decimal(str(bet)), json.dumps({'game': game})
+        )
+    return float(balance) if balance is not None else None
+
+async def settle_reserved_bet(user_id: int, game: str, bet: float, payout: float, outcome: str) -> float:
+    """Начисляет выигрыш по ставке, списанной reserve_bet, пишет casino_result и обновляет user_game_totals"""
+    import json
+    async with acquire_conn() as conn:
+        balance = await run_prepared(
+            conn, 'settle_reserved_bet', 'fetchval',
+            user_id, Decimal(str(bet)), Decimal(str(payout)),
+            json.dumps({'game': game, 'bet': bet, 'outcome': outcome}),
+            game, outcome
+        )
+    return float(balance) if balance is not None else 0
+
+async def roll_for_bet(user_id: int, game: str, bet: float, roll):
+    """Списывает ставку и только потом вызывает roll() - отправку кубиков. Возвращает результат roll()
+    или None, если на ставку не хватает баланса. Если бросок не отправился, ставка возвращается (outcome 'refund')"""
+    if await reserve_bet(user_id, game, bet) is None:
+        return None
+    try:
+        return await roll()
+    except (Exception, asyncio.CancelledError):
+        await settle_reserved_bet(user_id, game, bet, bet, 'refund')
+        raise
+
 async def update_daily_bonus(user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         async with conn.transaction():
             row = await conn.fetchrow(
                 'SELECT last_bonus FROM users WHERE user_id = $1 FOR UPDATE',
@@ -654,7 +2088,7 @@ async def process_referral_db(user_id: int, ref_id: int, user_name: str):
     try:
         print(f"[REFERRAL] Processing referral: user {user_id} referred by {ref_id}")
 
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             async with conn.transaction():
                 referrer = await conn.fetchrow(
                     'SELECT user_id, balance, refs FROM users WHERE user_id = $1 FOR UPDATE',
@@ -690,7 +2124,7 @@ async def process_referral_db(user_id: int, ref_id: int, user_name: str):
         print(f"[REFERRAL] ERROR: Failed to process referral: {e}")
 
 async def get_promo(code: str):
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         row = await conn.fetchrow(
             'SELECT code, reward, uses FROM promos WHERE code = $1',
             code
@@ -704,7 +2138,7 @@ async def get_promo(code: str):
         return None
 
 async def use_promo(user_id: int, code: str):
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         async with conn.transaction():
             user = await conn.fetchrow(
                 'SELECT used_promos FROM users WHERE user_id = $1 FOR UPDATE',
@@ -742,35 +2176,101 @@ async def use_promo(user_id: int, code: str):
                 'UPDATE promos SET uses = uses - 1 WHERE code = $1',
                 code
             )
+            await bump_user_totals(conn, user_id, promos=1, promos_amount=reward)
 
             return {
                 'success': True,
                 'message': f'✅ Промокод {code} активирован — +{reward} ⭐️'
             }
 
-async def get_top_users(limit: int = 10):
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch(
-            'SELECT user_id, name, balance FROM users ORDER BY balance DESC LIMIT $1',
-            limit
+async def bump_user_totals(conn, user_id: int, promos: int = 0, promos_amount: float = 0,
+                           withdrawals: int = 0, withdrawn: float = 0, support_requests: int = 0):
+    """Счётчики пользователя для /info; вызывается в транзакции самого действия"""
+    await run_prepared(
+        conn, 'bump_user_totals', 'execute',
+        user_id, promos, Decimal(str(promos_amount)), withdrawals, Decimal(str(withdrawn)), support_requests
+    )
+
+def support_message_preview(message: types.Message) -> str:
+    return message.text or message.caption or f"[{message.content_type}]"
+
+async def open_support_ticket(user_id: int, text: str) -> int:
+    """Создаёт тикет или дописывает сообщение в уже открытый тикет пользователя"""
+    async with acquire_conn() as conn:
+        async with conn.transaction():
+            ticket_id = await conn.fetchval(
+                '''INSERT INTO support_tickets (user_id, last_message)
+                   VALUES ($1, $2)
+                   ON CONFLICT (user_id) WHERE status = 'open' DO UPDATE SET
+                       last_message = EXCLUDED.last_message,
+                       last_message_at = NOW(),
+                       messages = support_tickets.messages + 1
+                   RETURNING id''',
+                user_id, text
+            )
+            await bump_user_totals(conn, user_id, support_requests=1)
+    await log_action(user_id, 'support_request', 0, {'request_id': ticket_id, 'text': text})
+    return ticket_id
+
+async def answer_support_ticket(user_id: int, admin_id: int):
+    """Закрывает открытый тикет пользователя ответом администратора"""
+    async with acquire_conn() as conn:
+        ticket_id = await conn.fetchval(
+            '''UPDATE support_tickets SET status = 'answered', assignee = $2, answered_at = NOW()
+               WHERE user_id = $1 AND status = 'open'
+               RETURNING id''',
+            user_id, admin_id
         )
+    if ticket_id is None:
+        # Ответ без открытого тикета (уже закрыт другим админом или пользователь не писал) -
+        # отдельное событие, чтобы не считать его ответом на обращение в /stats
+        await log_action(admin_id, 'support_replied_no_ticket', 0, {'target_user': user_id})
+    else:
+        await log_action(admin_id, 'support_replied', 0, {'target_user': user_id, 'request_id': ticket_id})
+    return ticket_id
+
+async def get_top_users(limit: int = 10):
+    async with acquire_conn() as conn:
+        rows = await run_prepared(conn, 'get_top_users', 'fetch', limit)
         return [{'name': row['name'], 'balance': float(row['balance'])} for row in rows]
 
 async def withdraw_balance(user_id: int, amount: float):
-    async with db_pool.acquire() as conn:
+    """Списывает сумму и создаёт заявку в withdrawals. Возвращает id заявки или None"""
+    async with acquire_conn() as conn:
         async with conn.transaction():
             balance = await conn.fetchval(
                 'SELECT balance FROM users WHERE user_id = $1 FOR UPDATE',
                 user_id
             )
             if not balance or float(balance) < amount:
-                return False
+                return None
 
             await conn.execute(
                 'UPDATE users SET balance = balance - $1 WHERE user_id = $2',
                 Decimal(str(amount)), user_id
             )
-            return True
+            await bump_user_totals(conn, user_id, withdrawals=1, withdrawn=amount)
+            log_id = await run_prepared(
+                conn, 'log_action', 'fetchval', user_id, 'withdraw_request', Decimal(str(amount)), None
+            )
+            return await conn.fetchval(
+                'INSERT INTO withdrawals (user_id, amount, log_id) VALUES ($1, $2, $3) RETURNING id',
+                user_id, Decimal(str(amount)), log_id
+            )
+
+async def approve_withdrawal(withdrawal_id: int, admin_id: int):
+    """Переводит заявку в approved. Повторное нажатие ничего не меняет: возвращает (заявка, False)"""
+    async with acquire_conn() as conn:
+        row = await conn.fetchrow(
+            '''UPDATE withdrawals SET status = 'approved', approved_at = NOW(), approved_by = $2
+               WHERE id = $1 AND status = 'pending'
+               RETURNING id, user_id, amount, log_id''',
+            withdrawal_id, admin_id
+        )
+        if row:
+            return dict(row), True
+        row = await conn.fetchrow('SELECT id, user_id, amount, log_id FROM withdrawals WHERE id = $1', withdrawal_id)
+        return (dict(row) if row else None), False
 
 def is_admin(user_id: int) -> bool:
     return user_id == ADMIN_ID
@@ -780,7 +2280,7 @@ def is_admin(user_id: int) -> bool:
 async def create_tournament(name: str, start_time: int, duration_days: int, 
                            prize_places: int, prizes: dict, trophy_file_ids: dict, start_message: str = None):
     """Создает новый турнир"""
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         end_time = start_time + (duration_days * 86400)
 
         # Конвертируем словари в JSONB совместимый формат
@@ -801,15 +2301,9 @@ async def create_tournament(name: str, start_time: int, duration_days: int,
 async def get_active_tournament():
     """Получает активный турнир"""
     import json
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         now = int(time.time())
-        row = await conn.fetchrow(
-            '''SELECT id, name, start_time, end_time, duration_days, prize_places, prizes, trophy_file_ids, status
-               FROM tournaments 
-               WHERE status = 'active' AND start_time <= $1 AND end_time > $1
-               ORDER BY id DESC LIMIT 1''',
-            now
-        )
+        row = await run_prepared(conn, 'get_active_tournament', 'fetchrow', now)
         if row:
             # Парсим JSON поля если они строки
             prizes = row['prizes']
@@ -835,17 +2329,12 @@ async def get_active_tournament():
 
 async def add_tournament_participant(tournament_id: int, user_id: int):
     """Добавляет участника в турнир"""
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            '''INSERT INTO tournament_participants (tournament_id, user_id, refs_count)
-               VALUES ($1, $2, 0)
-               ON CONFLICT (tournament_id, user_id) DO NOTHING''',
-            tournament_id, user_id
-        )
+    async with acquire_conn() as conn:
+        await run_prepared(conn, 'add_tournament_participant', 'execute', tournament_id, user_id)
 
 async def increment_tournament_refs(tournament_id: int, user_id: int):
     """Увеличивает счетчик рефералов участника в турнире"""
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         await conn.execute(
             '''INSERT INTO tournament_participants (tournament_id, user_id, refs_count)
                VALUES ($1, $2, 1)
@@ -856,7 +2345,7 @@ async def increment_tournament_refs(tournament_id: int, user_id: int):
 
 async def get_tournament_leaderboard(tournament_id: int, limit: int = 10):
     """Получает таблицу лидеров турнира"""
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         rows = await conn.fetch(
             '''SELECT tp.user_id, u.name, u.username, tp.refs_count
                FROM tournament_participants tp
@@ -872,7 +2361,7 @@ async def get_tournament_leaderboard(tournament_id: int, limit: int = 10):
 
 async def get_user_tournament_position(tournament_id: int, user_id: int):
     """Получает позицию пользователя в турнире"""
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         position = await conn.fetchval(
             '''SELECT COUNT(*) + 1
                FROM tournament_participants tp1
@@ -890,9 +2379,9 @@ async def get_user_tournament_position(tournament_id: int, user_id: int):
         )
         return {'position': position, 'refs_count': refs_count or 0}
 
-async def finish_tournament(tournament_id: int):
-    """Завершает турнир и выдает награды"""
-    async with db_pool.acquire() as conn:
+async def finish_tournament(tournament_id: int, headline: str = "🎉 <b>Поздравляем!</b>"):
+    """Завершает турнир и выдает награды, headline - первая строка уведомления победителям"""
+    async with acquire_conn() as conn:
         # Получаем данные турнира
         tournament = await conn.fetchrow(
             'SELECT name, prize_places, prizes, trophy_file_ids FROM tournaments WHERE id = $1',
@@ -939,44 +2428,54 @@ async def finish_tournament(tournament_id: int):
                 'place': row['place']
             })
 
-        # Выдаем награды
+        # Выдаем награды и ставим поздравления в outbox в одной транзакции: блокировки держатся только на время запросов
         now = int(time.time())
         from decimal import Decimal
-        for winner in winners:
-            place = int(winner['place'])
-            user_id = winner['user_id']
-
-            place_str = str(place)
-            if place_str in prizes:
-                prize_stars = float(prizes[place_str])
-                trophy_file_id = trophy_file_ids.get(place_str, trophy_file_ids.get('default', ''))
+        async with conn.transaction():
+            for winner in winners:
+                place = int(winner['place'])
+                user_id = winner['user_id']
+
+                place_str = str(place)
+                if place_str in prizes:
+                    prize_stars = float(prizes[place_str])
+                    trophy_file_id = trophy_file_ids.get(place_str, trophy_file_ids.get('default', ''))
+
+                    # Добавляем награду в таблицу
+                    await conn.execute(
+                        '''INSERT INTO user_trophies 
+                           (user_id, tournament_id, tournament_name, place, trophy_file_id, prize_stars, date_received)
+                           VALUES ($1, $2, $3, $4, $5, $6, $7)''',
+                        user_id, tournament_id, tournament['name'], place, 
+                        trophy_file_id, Decimal(str(prize_stars)), now
+                    )
 
-                # Добавляем награду в таблицу
-                await conn.execute(
-                    '''INSERT INTO user_trophies 
-                       (user_id, tournament_id, tournament_name, place, trophy_file_id, prize_stars, date_received)
-                       VALUES ($1, $2, $3, $4, $5, $6, $7)''',
-                    user_id, tournament_id, tournament['name'], place, 
-                    trophy_file_id, Decimal(str(prize_stars)), now
-                )
+                    # Добавляем звезды на баланс
+                    await conn.execute(
+                        'UPDATE users SET balance = balance + $1 WHERE user_id = $2',
+                        Decimal(str(prize_stars)), user_id
+                    )
 
-                # Добавляем звезды на баланс
-                await conn.execute(
-                    'UPDATE users SET balance = balance + $1 WHERE user_id = $2',
-                    Decimal(str(prize_stars)), user_id
+                # Уведомление победителю
+                await enqueue_notification(
+                    conn, user_id,
+                    f"{headline}\n\n"
+                    f"Ты занял {place} место в турнире <b>{tournament['name']}</b>!\n"
+                    f"🏆 Твоя награда: {prizes.get(place_str, 0)}⭐️\n\n"
+                    f"Проверь раздел 'Мои награды' 🏅"
                 )
 
-        # Закрываем турнир
-        await conn.execute(
-            'UPDATE tournaments SET status = $1 WHERE id = $2',
-            'finished', tournament_id
-        )
+            # Закрываем турнир
+            await conn.execute(
+                'UPDATE tournaments SET status = $1 WHERE id = $2',
+                'finished', tournament_id
+            )
 
         return winners
 
 async def get_user_trophies(user_id: int):
     """Получает все награды пользователя"""
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         rows = await conn.fetch(
             '''SELECT id, tournament_name, place, trophy_file_id, prize_stars, date_received
                FROM user_trophies
@@ -992,7 +2491,7 @@ async def get_user_trophies(user_id: int):
 async def get_admin_tournament_creation_state(admin_id: int):
     """Получает состояние создания турнира админом"""
     import json
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         row = await conn.fetchrow(
             'SELECT step, data FROM admin_tournament_creation WHERE admin_id = $1',
             admin_id
@@ -1004,7 +2503,7 @@ async def get_admin_tournament_creation_state(admin_id: int):
 async def set_admin_tournament_creation_state(admin_id: int, step: str, data: dict):
     """Устанавливает состояние создания турнира админом"""
     import json
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         await conn.execute(
             '''INSERT INTO admin_tournament_creation (admin_id, step, data, updated_at)
                VALUES ($1, $2, $3, NOW())
@@ -1015,7 +2514,7 @@ async def set_admin_tournament_creation_state(admin_id: int, step: str, data: di
 
 async def delete_admin_tournament_creation_state(admin_id: int):
     """Удаляет состояние создания турнира админом"""
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         await conn.execute(
             'DELETE FROM admin_tournament_creation WHERE admin_id = $1',
             admin_id
@@ -1163,6 +2662,446 @@ async def show_menu(chat_id: int, user_id: str = None):
         parse_mode='HTML'
     )
 
+# ===== BROADCAST =====
+
+class RateLimiter:
+    """Token bucket для исходящих сообщений, общий для всех рассылок"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов всем отправителям (RetryAfter от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated_at = self.paused_until
+
+broadcast_limiter = RateLimiter(BROADCAST_RATE)
+
+async def send_with_retry(send_func, chat_id: int, attempts: int = 3, deadline: float = None) -> tuple:
+    """Отправляет одно сообщение через общий лимитер, повторяя после RetryAfter.
+
+    Возвращает (результат, текст ошибки), результат - 'sent', 'failed', 'unreachable'
+    (бот заблокирован / чат не найден) или 'expired', если к моменту отправки
+    прошел deadline (time.monotonic()) - например, пока лимитер стоял на паузе.
+    """
+    error = None
+    for _ in range(attempts):
+        await broadcast_limiter.acquire()
+        if deadline is not None and time.monotonic() >= deadline:
+            return 'expired', error
+        try:
+            await send_func(chat_id)
+            return 'sent', None
+        except TelegramRetryAfter as e:
+            print(f"[BROADCAST] Flood control, pausing for {e.retry_after}s")
+            broadcast_limiter.pause(e.retry_after)
+            error = f"retry after {e.retry_after}s"
+        except Exception as e:
+            if is_unreachable_error(e):
+                return 'unreachable', str(e)
+            print(f"[BROADCAST] Failed to send to {chat_id}: {e}")
+            return 'failed', str(e)
+    return 'failed', error
+
+def format_broadcast_progress(title: str, stats: dict, total: int, finished: bool = False) -> str:
+    done = stats['success'] + stats['failed']
+    header = f"✅ {title} завершена!" if finished else f"🚀 {title}: {done}/{total}"
+    return (
+        f"{header}\n\n"
+        f"📈 Итоги:\n"
+        f"- Успешно: {stats['success']}\n"
+        f"- Ошибок: {stats['failed']}"
+    )
+
+async def run_broadcast(recipients, send_func, total: int, stats: dict = None,
+                        progress: tuple = None, title: str = "Рассылка"):
+    """Рассылает сообщение пачкой воркеров под общим лимитом и обновляет одно сообщение с прогрессом.
+
+    recipients - список или async-итератор chat_id, send_func(chat_id) - корутина отправки
+    одному пользователю, progress - (chat_id, message_id) сообщения с прогрессом.
+    В stats['last_started'] хранится последний взятый в работу chat_id.
+    """
+    if stats is None:
+        stats = {'success': 0, 'failed': 0}
+    stats.setdefault('last_started', None)
+    queue = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
+    unreachable = []
+
+    async def flush_unreachable():
+        batch = unreachable[:]
+        unreachable.clear()
+        try:
+            await mark_users_unreachable(batch)
+        except Exception as e:
+            print(f"[BROADCAST] Failed to mark unreachable users: {e}")
+
+    async def worker():
+        while True:
+            chat_id = await queue.get()
+            if chat_id is None:
+                return
+            # Очередь FIFO, поэтому все chat_id до last_started уже взяты в работу
+            stats['last_started'] = chat_id
+            result, _ = await send_with_retry(send_func, chat_id)
+            if result == 'sent':
+                stats['success'] += 1
+            else:
+                stats['failed'] += 1
+            if result == 'unreachable':
+                unreachable.append(chat_id)
+                if len(unreachable) >= 100:
+                    await flush_unreachable()
+
+    async def edit_progress(finished: bool = False):
+        try:
+            await bot.edit_message_text(
+                format_broadcast_progress(title, stats, total, finished),
+                chat_id=progress[0],
+                message_id=progress[1]
+            )
+        except Exception as e:
+            print(f"[BROADCAST] Failed to update progress: {e}")
+
+    async def report_progress():
+        last_done = None
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            done = stats['success'] + stats['failed']
+            if done != last_done:
+                await edit_progress()
+                last_done = done
+
+    workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_CONCURRENCY)]
+    reporter = asyncio.create_task(report_progress()) if progress else None
+
+    try:
+        if hasattr(recipients, '__aiter__'):
+            async for chat_id in recipients:
+                await queue.put(chat_id)
+        else:
+            for chat_id in recipients:
+                await queue.put(chat_id)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        if reporter:
+            reporter.cancel()
+        await flush_unreachable()
+
+    if progress:
+        await edit_progress(finished=True)
+
+    return stats['success'], stats['failed']
+
+# ===== BROADCAST JOBS =====
+
+broadcast_tasks = {}
+
+def make_broadcast_sender(payload: dict):
+    """Собирает функцию отправки для задания рассылки"""
+    text = payload.get('text') or ''
+    photo_id = payload.get('photo')
+
+    async def send_func(chat_id: int):
+        if photo_id:
+            # Отправляем фото с текстом
+            await bot.send_photo(chat_id, photo_id, caption=text, parse_mode='HTML')
+        else:
+            # Отправляем только текст
+            await bot.send_message(chat_id, text, parse_mode='HTML')
+
+    return send_func
+
+async def create_broadcast_job(payload: dict, progress_chat_id: int = None, conn=None) -> int:
+    """Сохраняет задание рассылки по всем пользователям и возвращает его ID.
+
+    Если передан conn, задание создаётся в его текущей транзакции.
+    """
+    import json
+    query = '''INSERT INTO broadcast_jobs (payload, total, progress_chat_id)
+               VALUES ($1::jsonb, (SELECT COUNT(*) FROM users WHERE reachable), $2)
+               RETURNING id'''
+    if conn is not None:
+        return await conn.fetchval(query, json.dumps(payload), progress_chat_id)
+    async with acquire_conn() as conn:
+        return await conn.fetchval(query, json.dumps(payload), progress_chat_id)
+
+async def claim_broadcast_job(job_id: int):
+    """Захватывает задание (lease), чтобы его выполнял только один процесс"""
+    async with acquire_conn() as conn:
+        return await conn.fetchrow(
+            '''UPDATE broadcast_jobs
+               SET lease_until = NOW() + $2 * INTERVAL '1 second', updated_at = NOW()
+               WHERE id = $1 AND status = 'running'
+               AND (lease_until IS NULL OR lease_until < NOW())
+               RETURNING id, payload, last_user_id, total, sent, failed, progress_chat_id, progress_message_id''',
+            job_id, BROADCAST_LEASE_SECONDS
+        )
+
+async def save_broadcast_checkpoint(job_id: int, last_user_id: int, stats: dict, status: str = 'running'):
+    async with acquire_conn() as conn:
+        await conn.execute(
+            '''UPDATE broadcast_jobs
+               SET last_user_id = $2, sent = $3, failed = $4, status = $5, updated_at = NOW(),
+                   lease_until = CASE WHEN $5 = 'running' THEN NOW() + $6 * INTERVAL '1 second' END
+               WHERE id = $1''',
+            job_id, last_user_id, stats['success'], stats['failed'], status, BROADCAST_LEASE_SECONDS
+        )
+
+async def run_broadcast_job(job_id: int):
+    """Выполняет (или продолжает после рестарта) задание рассылки.
+
+    Получатели читаются страницами по keyset-курсору users.user_id. Курсор страницы
+    сохраняется до её отправки, поэтому после падения никто не получит сообщение дважды.
+    При штатной остановке курсор откатывается к последнему взятому в работу пользователю.
+    """
+    import json
+    job = await claim_broadcast_job(job_id)
+    if not job:
+        return
+
+    payload = job['payload']
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+
+    stats = {'success': job['sent'], 'failed': job['failed'], 'last_started': None}
+    cursor = job['last_user_id']
+
+    progress = None
+    if job['progress_chat_id']:
+        progress_message_id = job['progress_message_id']
+        if not progress_message_id:
+            try:
+                msg = await bot.send_message(
+                    job['progress_chat_id'],
+                    format_broadcast_progress(payload.get('title', "Рассылка"), stats, job['total'])
+                )
+                progress_message_id = msg.message_id
+                async with acquire_conn() as conn:
+                    await conn.execute(
+                        'UPDATE broadcast_jobs SET progress_message_id = $2 WHERE id = $1',
+                        job_id, progress_message_id
+                    )
+            except Exception as e:
+                print(f"[BROADCAST] Failed to send progress message for job {job_id}: {e}")
+        if progress_message_id:
+            progress = (job['progress_chat_id'], progress_message_id)
+
+    async def recipients():
+        nonlocal cursor
+        while True:
+            async with acquire_conn() as conn:
+                rows = await conn.fetch(
+                    'SELECT user_id FROM users WHERE user_id > $1 AND reachable ORDER BY user_id LIMIT $2',
+                    cursor, BROADCAST_PAGE_SIZE
+                )
+            if not rows:
+                return
+            # Резервируем страницу до отправки
+            cursor = rows[-1]['user_id']
+            await save_broadcast_checkpoint(job_id, cursor, stats)
+            for row in rows:
+                yield row['user_id']
+
+    print(f"[BROADCAST] Job {job_id} started from user_id > {cursor}")
+    try:
+        await run_broadcast(
+            recipients(),
+            make_broadcast_sender(payload),
+            total=job['total'],
+            stats=stats,
+            progress=progress,
+            title=payload.get('title', "Рассылка")
+        )
+    except asyncio.CancelledError:
+        last_started = stats['last_started'] if stats['last_started'] is not None else job['last_user_id']
+        try:
+            await save_broadcast_checkpoint(job_id, min(cursor, last_started), stats)
+            async with acquire_conn() as conn:
+                await conn.execute('UPDATE broadcast_jobs SET lease_until = NULL WHERE id = $1', job_id)
+            print(f"[BROADCAST] Job {job_id} paused at user_id {last_started}")
+        except Exception as e:
+            print(f"[BROADCAST] Failed to save checkpoint for job {job_id}: {e}")
+        raise
+
+    await save_broadcast_checkpoint(job_id, cursor, stats, status='done')
+    print(f"[BROADCAST] Job {job_id} finished: {stats['success']} ok, {stats['failed']} fail")
+
+def start_broadcast_job(job_id: int):
+    task = broadcast_tasks.get(job_id)
+    if task and not task.done():
+        return
+    broadcast_tasks[job_id] = asyncio.create_task(run_broadcast_job(job_id))
+
+async def broadcast_jobs_watchdog():
+    """Подхватывает незавершённые задания рассылки (после рестарта или падения другой реплики)"""
+    while True:
+        try:
+            if db_pool:
+                async with acquire_conn() as conn:
+                    rows = await conn.fetch(
+                        '''SELECT id FROM broadcast_jobs
+                           WHERE status = 'running' AND (lease_until IS NULL OR lease_until < NOW())
+                           ORDER BY id'''
+                    )
+                for row in rows:
+                    print(f"[BROADCAST] Resuming job {row['id']}")
+                    start_broadcast_job(row['id'])
+        except Exception as e:
+            print(f"[BROADCAST] Error in jobs watchdog: {e}")
+        await asyncio.sleep(60)
+
+async def stop_broadcast_jobs():
+    """Останавливает рассылки и сохраняет их курсоры (до закрытия пула)"""
+    tasks = [task for task in broadcast_tasks.values() if not task.done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# ===== OUTBOX =====
+
+async def enqueue_notification(conn, chat_id: int, text: str, photo: str = None):
+    """Ставит уведомление в outbox в текущей транзакции вызывающего; отправит его диспетчер после коммита"""
+    import json
+    payload = {'text': text}
+    if photo:
+        payload['photo'] = photo
+    await conn.execute(
+        'INSERT INTO outbox (chat_id, payload) VALUES ($1, $2::jsonb)',
+        chat_id, json.dumps(payload)
+    )
+
+class OutboxDispatcher(BackgroundFlusher):
+    """Отправляет уведомления из outbox через общий лимитер рассылок.
+    Строки забираются с арендой на OUTBOX_LEASE_SECONDS (SKIP LOCKED), поэтому реплики не шлют одно и то же,
+    а сообщения упавшего процесса уходят повторно после истечения аренды.
+    Отправка прекращается за четверть аренды до её конца, а результат записывается только
+    в строки, аренда которых не сменилась - иначе их уже могла забрать другая реплика"""
+
+    def __init__(self, poll_seconds: float, batch_size: int, max_attempts: int):
+        super().__init__(poll_seconds)
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.expired = 0
+
+    async def claim(self):
+        async with acquire_conn() as conn:
+            return await conn.fetch(
+                '''UPDATE outbox SET next_attempt_at = NOW() + make_interval(secs => $2)
+                   WHERE id IN (
+                       SELECT id FROM outbox
+                       WHERE status = 'pending' AND next_attempt_at <= NOW()
+                       ORDER BY next_attempt_at
+                       LIMIT $1
+                       FOR UPDATE SKIP LOCKED
+                   )
+                   RETURNING id, chat_id, payload, attempts, next_attempt_at AS lease_until''',
+                self.batch_size, OUTBOX_LEASE_SECONDS
+            )
+
+    async def deliver(self, row, deadline: float) -> tuple:
+        """Возвращает (результат, текст ошибки) как send_with_retry"""
+        import json
+        payload = row['payload']
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+        return await send_with_retry(make_broadcast_sender(payload), row['chat_id'], deadline=deadline)
+
+    async def dispatch(self) -> int:
+        """Отправляет одну пачку и возвращает её размер"""
+        rows = await self.claim()
+        if not rows:
+            return 0
+        deadline = time.monotonic() + OUTBOX_LEASE_SECONDS * 0.75
+        results = await asyncio.gather(*(self.deliver(row, deadline) for row in rows))
+
+        sent, retries, failed, expired = [], [], [], 0
+        for row, (result, error) in zip(rows, results):
+            attempts = row['attempts'] + 1
+            if result == 'expired':
+                # Аренда на исходе: строка уйдет со следующим claim, здесь или на другой реплике
+                expired += 1
+            elif result == 'sent':
+                sent.append((row['id'], row['lease_until']))
+            elif result == 'unreachable' or attempts >= self.max_attempts:
+                failed.append((row['id'], row['lease_until'], error or result))
+            else:
+                # 30 с, 1 мин, 2 мин, ... до часа между попытками
+                retries.append((row['id'], row['lease_until'], error or result,
+                                min(30 * 2 ** (attempts - 1), 3600)))
+
+        async with acquire_conn() as conn:
+            async with conn.transaction():
+                if sent:
+                    await conn.executemany(
+                        '''UPDATE outbox SET status = 'sent', sent_at = NOW(), attempts = attempts + 1
+                           WHERE id = $1 AND next_attempt_at = $2''',
+                        sent
+                    )
+                if retries:
+                    await conn.executemany(
+                        '''UPDATE outbox SET attempts = attempts + 1, last_error = $3,
+                           next_attempt_at = NOW() + make_interval(secs => $4)
+                           WHERE id = $1 AND next_attempt_at = $2''',
+                        retries
+                    )
+                if failed:
+                    await conn.executemany(
+                        '''UPDATE outbox SET status = 'failed', attempts = attempts + 1, last_error = $3
+                           WHERE id = $1 AND next_attempt_at = $2''',
+                        failed
+                    )
+
+        unreachable = [row['chat_id'] for row, (result, _) in zip(rows, results) if result == 'unreachable']
+        if unreachable:
+            await mark_users_unreachable(unreachable)
+
+        self.sent += len(sent)
+        self.retried += len(retries)
+        self.failed += len(failed)
+        self.expired += expired
+        return len(rows)
+
+    async def step(self) -> bool:
+        # Полная пачка - в очереди, скорее всего, есть ещё. Остаток после stop() не досылается:
+        # строки уйдут после истечения аренды, здесь или на другой реплике
+        return bool(db_pool) and await self.dispatch() >= self.batch_size
+
+    def log_failure(self, error: Exception):
+        print(f"[OUTBOX] Dispatch failed: {error}")
+
+    def snapshot(self) -> dict:
+        return {'sent': self.sent, 'retried': self.retried, 'failed': self.failed, 'expired': self.expired}
+
+outbox_dispatcher = OutboxDispatcher(OUTBOX_POLL_SECONDS, OUTBOX_BATCH_SIZE, OUTBOX_MAX_ATTEMPTS)
+
 # ===== ADMIN COMMANDS =====
 @dp.message(Command("send"))
 async def send_handler(message: types.Message):
@@ -1240,43 +3179,12 @@ async def sendall_handler(message: types.Message):
         await message.reply("❌ Введите текст сообщения или прикрепите фото")
         return
 
-    # Получаем всех пользователей из БД
-    async with db_pool.acquire() as conn:
-        users = await conn.fetch('SELECT user_id FROM users')
-
-    if not users:
-        await message.reply("❌ В базе данных нет пользователей")
-        return
-
-    await message.reply(f"🚀 Начинаю рассылку на {len(users)} пользователей...")
-
-    success = 0
-    failed = 0
-
-    for user in users:
-        try:
-            if message.photo:
-                # Отправляем фото с текстом
-                await bot.send_photo(
-                    user['user_id'],
-                    message.photo[-1].file_id,
-                    caption=text,
-                    parse_mode='HTML'
-                )
-            else:
-                # Отправляем только текст
-                await bot.send_message(
-                    user['user_id'],
-                    text,
-                    parse_mode='HTML'
-                )
-            success += 1
-            await asyncio.sleep(0.05) # Небольшая задержка, чтобы не поймать лимиты
-        except Exception:
-            failed += 1
-
-    await message.reply(f"✅ Рассылка завершена!\n\n📈 Итоги:\n- Успешно: {success}\n- Ошибок: {failed}")
-    print(f"[ADMIN] Admin {message.from_user.id} completed mass mailing: {success} ok, {failed} fail")
+    job_id = await create_broadcast_job(
+        {'text': text, 'photo': message.photo[-1].file_id if message.photo else None},
+        progress_chat_id=message.chat.id
+    )
+    start_broadcast_job(job_id)
+    print(f"[ADMIN] Admin {message.from_user.id} started mass mailing job {job_id}")
 
 @dp.message(Command("addpromo"))
 async def add_promo_handler(message: types.Message):
@@ -1297,7 +3205,7 @@ async def add_promo_handler(message: types.Message):
         reward = float(parts[2])
         uses = int(parts[3])
 
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             await conn.execute(
                 'INSERT INTO promos (code, reward, uses) VALUES ($1, $2, $3) ON CONFLICT (code) DO UPDATE SET reward = $2, uses = $3',
                 code, reward, uses
@@ -1325,44 +3233,52 @@ async def stats_command_handler(message: types.Message):
         amount = int(args[1])
         unit = args[2].lower()
         if unit.startswith('hour'):
-            interval = f"'{amount} hours'"
+            hours = amount
         elif unit.startswith('day'):
-            interval = f"'{amount} days'"
+            hours = amount * 24
         else:
             await message.reply("❌ Используйте hours или day")
             return
 
-        async with db_pool.acquire() as conn:
-            # Общая статистика
-            stats = await conn.fetchrow(f"""
-                SELECT 
-                    COUNT(DISTINCT user_id) as active_users,
-                    COUNT(*) FILTER (WHERE action_type = 'casino_bet') as total_games,
-                    SUM(amount) FILTER (WHERE action_type = 'casino_bet') as total_staked,
-                    SUM(amount) FILTER (WHERE action_type = 'casino_result') as total_won,
-                    COUNT(*) FILTER (WHERE action_type = 'promo') as promos_used,
-                    (SELECT COUNT(*) FROM action_logs WHERE action_type = 'withdraw_request' AND created_at > NOW() - INTERVAL {interval}) as withdraw_requests,
-                    (SELECT COUNT(*) FROM action_logs WHERE action_type = 'withdraw_approve' AND created_at > NOW() - INTERVAL {interval}) as withdraw_approved,
-                    (SELECT COUNT(*) FROM action_logs WHERE action_type = 'support_request' AND created_at > NOW() - INTERVAL {interval}) as support_requests,
-                    (SELECT COUNT(*) FROM action_logs WHERE action_type = 'support_replied' AND created_at > NOW() - INTERVAL {interval}) as support_replied
-                FROM action_logs 
-                WHERE created_at > NOW() - INTERVAL {interval}
-            """)
+        async with acquire_conn() as conn:
+            # Только почасовые агрегаты: период округляется до начала часа
+            stats = await conn.fetchrow("""
+                WITH bounds AS (
+                    SELECT date_trunc('hour', LOCALTIMESTAMP - make_interval(hours => $1)) AS since
+                ),
+                games AS (
+                    SELECT SUM(bets) AS total_games, SUM(staked) AS total_staked, SUM(won) AS total_won
+                    FROM hourly_game_stats, bounds WHERE hour >= bounds.since
+                ),
+                actions AS (
+                    SELECT
+                        COALESCE(SUM(count) FILTER (WHERE action_type = 'promo'), 0) AS promos_used,
+                        COALESCE(SUM(count) FILTER (WHERE action_type = 'withdraw_request'), 0) AS withdraw_requests,
+                        COALESCE(SUM(count) FILTER (WHERE action_type = 'withdraw_approve'), 0) AS withdraw_approved,
+                        COALESCE(SUM(count) FILTER (WHERE action_type = 'support_request'), 0) AS support_requests,
+                        COALESCE(SUM(count) FILTER (WHERE action_type = 'support_replied'), 0) AS support_replied
+                    FROM hourly_action_counts, bounds WHERE hour >= bounds.since
+                )
+                SELECT
+                    (SELECT COUNT(DISTINCT user_id) FROM hourly_active_users, bounds WHERE hour >= bounds.since) AS active_users,
+                    COALESCE(games.total_games, 0) AS total_games, games.total_staked, games.total_won, actions.*
+                FROM games, actions
+            """, hours)
 
             # По играм
-            game_stats = await conn.fetch(f"""
-                SELECT 
-                    COALESCE(details->>'game', 'knb') as game, 
-                    COUNT(*) FILTER (WHERE action_type = 'casino_bet') as count,
-                    COUNT(*) FILTER (WHERE action_type = 'casino_result' AND details->>'outcome' = 'win') as wins,
-                    COUNT(*) FILTER (WHERE action_type = 'casino_result' AND details->>'outcome' = 'loss') as losses,
-                    SUM(amount) FILTER (WHERE action_type = 'casino_bet') as staked,
-                    SUM(amount) FILTER (WHERE action_type = 'casino_result') as won
-                FROM action_logs 
-                WHERE created_at > NOW() - INTERVAL {interval}
-                AND (action_type = 'casino_bet' OR action_type = 'casino_result')
-                GROUP BY COALESCE(details->>'game', 'knb')
-            """)
+            game_stats = await conn.fetch("""
+                SELECT
+                    game,
+                    SUM(bets) AS count,
+                    COALESCE(SUM(bets) FILTER (WHERE outcome = 'win'), 0) AS wins,
+                    COALESCE(SUM(bets) FILTER (WHERE outcome = 'loss'), 0) AS losses,
+                    SUM(staked) AS staked,
+                    SUM(won) AS won
+                FROM hourly_game_stats
+                WHERE hour >= date_trunc('hour', LOCALTIMESTAMP - make_interval(hours => $1))
+                GROUP BY game
+                ORDER BY game
+            """, hours)
 
             staked = float(stats['total_staked'] or 0)
             won = float(stats['total_won'] or 0)
@@ -1398,19 +3314,14 @@ async def active_withdraw_handler(message: types.Message):
     if not is_admin(message.from_user.id):
         return
 
-    async with db_pool.acquire() as conn:
-        # Получаем уникальный ID для лога (action_logs имеет серийный ID)
+    async with acquire_conn() as conn:
+        # Частичный индекс idx_withdrawals_pending: читаются только ожидающие заявки
         pending = await conn.fetch("""
-            SELECT l1.id as log_id, l1.user_id, l1.amount, l1.created_at, u.username
-            FROM action_logs l1
-            JOIN users u ON l1.user_id = u.user_id
-            WHERE l1.action_type = 'withdraw_request'
-            AND NOT EXISTS (
-                SELECT 1 FROM action_logs l2 
-                WHERE l2.action_type = 'withdraw_approve' 
-                AND l2.details->>'request_id' = l1.id::text
-            )
-            ORDER BY l1.created_at ASC
+            SELECT w.id, w.user_id, w.amount, w.created_at, u.username
+            FROM withdrawals w
+            JOIN users u ON w.user_id = u.user_id
+            WHERE w.status = 'pending'
+            ORDER BY w.created_at ASC
         """)
 
     if not pending:
@@ -1419,38 +3330,38 @@ async def active_withdraw_handler(message: types.Message):
 
     await message.reply(f"💰 <b>Пересылаю {len(pending)} активных заявок:</b>", parse_mode='HTML')
 
+    # Дальше только отправка через общий лимитер рассылок, БД больше не нужна
+    await release_request_conn()
     for p in pending:
         admin_markup = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="✅ Принять", callback_data=f"withdraw_approve_{p['log_id']}")]
+            [types.InlineKeyboardButton(text="✅ Принять", callback_data=f"withdrawal_approve_{p['id']}")]
         ])
         admin_msg = (
-            f"💰 <b>Заявка на вывод #{p['log_id']}</b>\n\n"
+            f"💰 <b>Заявка на вывод #{p['id']}</b>\n\n"
             f"👤 Пользователь: @{p['username'] or 'нет'}\n"
             f"🆔 ID: <code>{p['user_id']}</code>\n"
             f"💵 Сумма: {p['amount']} ⭐️\n"
             f"📅 Дата: {p['created_at'].strftime('%d.%m %H:%M')}"
         )
-        await bot.send_message(ADMIN_ID, admin_msg, parse_mode='HTML', reply_markup=admin_markup)
-        await asyncio.sleep(0.5)
+
+        async def send(chat_id):
+            await bot.send_message(chat_id, admin_msg, parse_mode='HTML', reply_markup=admin_markup)
+
+        await send_with_retry(send, ADMIN_ID)
 
 @dp.message(Command("active_support"))
 async def active_support_handler(message: types.Message):
     if not is_admin(message.from_user.id):
         return
 
-    async with db_pool.acquire() as conn:
-        # Теперь ищем конкретные сообщения, на которые не было ответа по ID сообщения (log_id)
+    async with acquire_conn() as conn:
+        # Открытые тикеты читаются по частичному индексу idx_support_tickets_open
         unanswered = await conn.fetch("""
-            SELECT l1.id as log_id, l1.user_id, l1.created_at, u.username, l1.details->>'text' as msg
-            FROM action_logs l1
-            JOIN users u ON l1.user_id = u.user_id
-            WHERE l1.action_type = 'support_request'
-            AND NOT EXISTS (
-                SELECT 1 FROM action_logs l2 
-                WHERE l2.action_type = 'support_replied' 
-                AND l2.details->>'request_id' = l1.id::text
-            )
-            ORDER BY l1.created_at ASC
+            SELECT t.id, t.user_id, t.created_at, t.messages, u.username, t.last_message as msg
+            FROM support_tickets t
+            LEFT JOIN users u ON t.user_id = u.user_id
+            WHERE t.status = 'open'
+            ORDER BY t.last_message_at ASC
         """)
 
     if not unanswered:
@@ -1458,16 +3369,21 @@ async def active_support_handler(message: types.Message):
         return
 
     await message.reply(f"🆘 <b>Пересылаю {len(unanswered)} активных обращений:</b>", parse_mode='HTML')
+    # Дальше только отправка через общий лимитер рассылок, БД больше не нужна
+    await release_request_conn()
 
     for u in unanswered:
         markup = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="💬 Ответить", callback_data=f"support_reply_{u['log_id']}")]
+            [types.InlineKeyboardButton(text="💬 Ответить", callback_data=f"support_reply_{u['id']}_{u['user_id']}")]
         ])
-        user_info = f"🆘 <b>Запрос #{u['log_id']}</b>\n👤 От: @{u['username'] or 'нет username'} (ID <code>{u['user_id']}</code>)\n📅 Дата: {u['created_at'].strftime('%d.%m %H:%M')}"
+        user_info = f"🆘 <b>Запрос #{u['id']}</b>\n👤 От: @{u['username'] or 'нет username'} (ID <code>{u['user_id']}</code>)\n📅 Дата: {u['created_at'].strftime('%d.%m %H:%M')}\n✉️ Сообщений: {u['messages']}"
 
         txt = f"{user_info}\n\n📝 Сообщение:\n{u['msg'] or '[Медиа]'}"
-        await bot.send_message(ADMIN_ID, txt, parse_mode='HTML', reply_markup=markup)
-        await asyncio.sleep(0.5)
+
+        async def send(chat_id):
+            await bot.send_message(chat_id, txt, parse_mode='HTML', reply_markup=markup)
+
+        await send_with_retry(send, ADMIN_ID)
 @dp.message(Command("info"))
 async def info_command_handler(message: types.Message):
     if not is_admin(message.from_user.id):
@@ -1480,7 +3396,7 @@ async def info_command_handler(message: types.Message):
 
     target = args[1].replace('@', '')
 
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         if target.isdigit():
             user_row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", int(target))
         else:
@@ -1492,34 +3408,19 @@ async def info_command_handler(message: types.Message):
 
         uid = user_row['user_id']
 
-        # Сбор детальной статистики
-        stats = await conn.fetchrow("""
-            SELECT 
-                COUNT(*) FILTER (WHERE action_type = 'casino_bet') as total_games,
-                SUM(amount) FILTER (WHERE action_type = 'casino_bet') as total_staked,
-                SUM(amount) FILTER (WHERE action_type = 'casino_result') as total_won,
-                COUNT(*) FILTER (WHERE action_type = 'promo') as promos_count,
-                SUM(amount) FILTER (WHERE action_type = 'withdraw_request') as total_withdrawn,
-                COUNT(*) FILTER (WHERE action_type = 'support_request') as support_count
-            FROM action_logs WHERE user_id = $1
-        """, uid)
-
-        # По играм
-        user_game_stats = await conn.fetch("""
-            SELECT 
-                COALESCE(details->>'game', 'knb') as game,
-                COUNT(*) FILTER (WHERE action_type = 'casino_bet') as count,
-                COUNT(*) FILTER (WHERE action_type = 'casino_result' AND details->>'outcome' = 'win') as wins,
-                COUNT(*) FILTER (WHERE action_type = 'casino_result' AND details->>'outcome' = 'loss') as losses,
-                SUM(amount) FILTER (WHERE action_type = 'casino_bet') as staked,
-                SUM(amount) FILTER (WHERE action_type = 'casino_result') as won
-            FROM action_logs 
-            WHERE user_id = $1 AND (action_type = 'casino_bet' OR action_type = 'casino_result')
-            GROUP BY COALESCE(details->>'game', 'knb')
-        """, uid)
-
-        staked = float(stats['total_staked'] or 0)
-        won = float(stats['total_won'] or 0)
+        # Накопленные счётчики: точечное чтение по user_id вместо агрегации всей истории
+        totals = await conn.fetchrow(
+            'SELECT promos_count, withdrawn, support_requests FROM user_totals WHERE user_id = $1', uid
+        )
+        user_game_stats = await conn.fetch(
+            '''SELECT game, bets AS count, wins, losses, staked, won
+               FROM user_game_totals WHERE user_id = $1 ORDER BY game''',
+            uid
+        )
+
+        total_games = sum(g['count'] for g in user_game_stats)
+        staked = float(sum(g['staked'] for g in user_game_stats))
+        won = float(sum(g['won'] for g in user_game_stats))
         profit = won - staked
         profit_text = f"📈 Профит: +{profit:.2f} ⭐️" if profit >= 0 else f"📉 Убыток: {profit:.2f} ⭐️"
 
@@ -1531,7 +3432,7 @@ async def info_command_handler(message: types.Message):
             f"💰 Баланс: {user_row['balance']} ⭐️\n"
             f"👥 Рефералов: {user_row['refs']}\n\n"
             f"📊 <b>Игровая активность:</b>\n"
-            f"🎮 Всего игр: {stats['total_games'] or 0}\n"
+            f"🎮 Всего игр: {total_games}\n"
             f"💰 Проставлено: {staked:.2f} ⭐️\n"
             f"🏆 Выиграно: {won:.2f} ⭐️\n"
             f"{profit_text}\n\n"
@@ -1546,9 +3447,9 @@ async def info_command_handler(message: types.Message):
 
         text += (
             f"\nдругое:\n"
-            f"🎫 Промокодов: {stats['promos_count'] or 0}\n"
-            f"💸 Выведено: {stats['total_withdrawn'] or 0} ⭐️\n"
-            f"📩 Поддержка: {stats['support_count'] or 0} раз\n"
+            f"🎫 Промокодов: {totals['promos_count'] if totals else 0}\n"
+            f"💸 Выведено: {totals['withdrawn'] if totals else 0} ⭐️\n"
+            f"📩 Поддержка: {totals['support_requests'] if totals else 0} раз\n"
         )
 
         await message.reply(text, parse_mode='HTML')
@@ -1561,7 +3462,7 @@ async def list_promos_handler(message: types.Message):
         return
 
     try:
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             promos = await conn.fetch('SELECT code, reward, uses FROM promos ORDER BY code')
 
             if not promos:
@@ -1644,7 +3545,7 @@ async def end_tournament_handler(message: types.Message):
     tournament_name = command_parts[1].strip()
 
     # Ищем турнир по названию (регистронезависимо и с обрезкой пробелов) или по ID
-    async with db_pool.acquire() as conn:
+    async with acquire_conn() as conn:
         import json
         tournament_row = await conn.fetchrow(
             '''SELECT id, name, prize_places, prizes, trophy_file_ids 
@@ -1684,19 +3585,6 @@ async def end_tournament_handler(message: types.Message):
         prize = tournament['prizes'].get(str(place), 0)
         text += f"{place}. {user['name']} - {winner['refs_count']} рефералов (награда: {prize}⭐️)\n"
 
-        # Отправляем уведомление победителю
-        try:
-            await bot.send_message(
-                winner['user_id'],
-                f"🎉 <b>Поздравляем!</b>\n\n"
-                f"Ты занял {place} место в турнире <b>{tournament['name']}</b>!\n"
-                f"🏆 Твоя награда: {prize}⭐️\n\n"
-                f"Проверь раздел 'Мои награды' 🏅",
-                parse_mode='HTML'
-            )
-        except:
-            pass
-
     await message.reply(text, parse_mode='HTML')
 
 @dp.message(Command("start"))
@@ -1827,7 +3715,7 @@ async def start_command_logic(message: types.Message):
                 ref_user = await get_user(ref_id_int)
                 if ref_user and ref_id_int != uid:
                     # Сохраняем связь, но не даем награду сразу
-                    async with db_pool.acquire() as conn:
+                    async with acquire_conn() as conn:
                         await conn.execute(
                             'INSERT INTO referral_connections (user_id, referrer_id) VALUES ($1, $2) ON CONFLICT DO NOTHING',
                             uid, ref_id_int
@@ -1846,8 +3734,6 @@ async def support_callback(callback: types.CallbackQuery, state: FSMContext):
     ])
     await callback.message.answer("✍️ <b>Напишите ваше сообщение в техподдержку:</b>", parse_mode='HTML', reply_markup=markup)
 
-    uid = str(callback.from_user.id)
-    user_states[uid] = 'awaiting_support'
     await set_user_state(callback.from_user.id, 'awaiting_support')
 
     await callback.answer()
@@ -1857,9 +3743,7 @@ async def reply_to_user_callback(callback: types.CallbackQuery, state: FSMContex
     try:
         user_id = int(callback.data.split(':')[1])
 
-        uid = str(callback.from_user.id)
         new_state = {'state': 'answering_support', 'target_user_id': user_id, 'message_to_edit': callback.message.message_id, 'chat_to_edit': callback.message.chat.id}
-        user_states[uid] = new_state
         await set_user_state(callback.from_user.id, new_state)
 
         markup = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -1875,9 +3759,7 @@ async def reply_to_user_callback(callback: types.CallbackQuery, state: FSMContex
 @dp.callback_query(F.data.startswith('reply_to_admin:'))
 async def reply_to_admin_callback(callback: types.CallbackQuery, state: FSMContext):
     try:
-        uid = str(callback.from_user.id)
-        user_states[uid] = {'state': 'answering_admin', 'message_to_edit': callback.message.message_id, 'chat_to_edit': callback.message.chat.id}
-        await set_user_state(callback.from_user.id, user_states[uid])
+        await set_user_state(callback.from_user.id, {'state': 'answering_admin', 'message_to_edit': callback.message.message_id, 'chat_to_edit': callback.message.chat.id})
 
         markup = types.InlineKeyboardMarkup(inline_keyboard=[
             [types.InlineKeyboardButton(text="❌ Отмена", callback_data='menu')]
@@ -1914,7 +3796,7 @@ async def handle_query(call: types.CallbackQuery):
                     ref_user = await get_user(ref_id)
                     if ref_user and ref_id != user_id_int:
                         # Сохраняем связь, но не даем награду сразу
-                        async with db_pool.acquire() as conn:
+                        async with acquire_conn() as conn:
                             await conn.execute(
                                 'INSERT INTO referral_connections (user_id, referrer_id) VALUES ($1, $2) ON CONFLICT DO NOTHING',
                                 user_id_int, ref_id
@@ -1928,27 +3810,40 @@ async def handle_query(call: types.CallbackQuery):
             await call.answer("❌ Вы ещё не подписались на канал!", show_alert=True)
         return
 
-    if call.data.startswith('withdraw_approve_'):
+    if call.data.startswith('withdrawal_approve_') or call.data.startswith('withdraw_approve_'):
         if not is_admin(user_id_int):
             await call.answer("❌ Доступно только администратору", show_alert=True)
             return
 
         parts = call.data.split('_')
-        # Обработка нового формата с ID лога ИЛИ старого (для совместимости)
-        if len(parts) == 3: # withdraw_approve_ID
-            request_id = int(parts[2])
-            async with db_pool.acquire() as conn:
-                req = await conn.fetchrow("SELECT user_id, amount FROM action_logs WHERE id = $1", request_id)
-                if not req:
-                    await call.answer("❌ Заявка не найдена", show_alert=True)
-                    return
-                target_uid = req['user_id']
-                amount = req['amount']
-                await log_action(ADMIN_ID, 'withdraw_approve', amount, {'target_user': target_uid, 'request_id': request_id})
-        else: # Старый формат: withdraw_approve_UID_AMOUNT
-            target_uid = int(parts[2])
-            amount = float(parts[3])
-            await log_action(ADMIN_ID, 'withdraw_approve', amount, {'target_user': target_uid})
+        if parts[0] == 'withdrawal': # withdrawal_approve_ID - id заявки в withdrawals
+            withdrawal_id = int(parts[2])
+        else:
+            # Кнопки, отправленные до появления withdrawals: withdraw_approve_LOGID или withdraw_approve_UID_AMOUNT
+            async with acquire_conn() as conn:
+                if len(parts) == 3:
+                    withdrawal_id = await conn.fetchval('SELECT id FROM withdrawals WHERE log_id = $1', int(parts[2]))
+                else:
+                    withdrawal_id = await conn.fetchval(
+                        '''SELECT id FROM withdrawals
+                           WHERE user_id = $1 AND amount = $2
+                           ORDER BY status = 'pending' DESC, created_at LIMIT 1''',
+                        int(parts[2]), Decimal(parts[3])
+                    )
+
+        withdrawal, approved = await approve_withdrawal(withdrawal_id, user_id_int) if withdrawal_id else (None, False)
+        if not withdrawal:
+            await call.answer("❌ Заявка не найдена", show_alert=True)
+            return
+        if not approved:
+            await call.answer("ℹ️ Заявка уже обработана")
+            return
+
+        target_uid = withdrawal['user_id']
+        amount = withdrawal['amount']
+        await log_action(ADMIN_ID, 'withdraw_approve', amount, {
+            'target_user': target_uid, 'request_id': withdrawal['id'], 'log_id': withdrawal['log_id']
+        })
 
         try:
 
@@ -1994,12 +3889,11 @@ async def handle_query(call: types.CallbackQuery):
             # Определяем, кто нажал: админ или пользователь
             if is_admin(user_id):
                 # АДМИН отвечает пользователю
-                user_states[str(user_id)] = {
+                await set_user_state(user_id, {
                     'state': 'awaiting_admin_reply',
                     'target_user_id': target_user_id,
                     'log_id': log_id
-                }
-                await set_user_state(user_id, user_states[str(user_id)])
+                })
 
                 await bot.send_message(
                     user_id,
@@ -2009,12 +3903,11 @@ async def handle_query(call: types.CallbackQuery):
                 )
             else:
                 # ПОЛЬЗОВАТЕЛЬ отвечает админу
-                user_states[str(user_id)] = {
+                await set_user_state(user_id, {
                     'state': 'awaiting_support_reply',
                     'admin_id': target_user_id,  # Это ID админа
                     'log_id': log_id
-                }
-                await set_user_state(user_id, user_states[str(user_id)])
+                })
 
                 await bot.send_message(
                     user_id,
@@ -2036,17 +3929,15 @@ async def handle_query(call: types.CallbackQuery):
             [types.InlineKeyboardButton(text="❌ Отмена", callback_data='menu')]
         ])
         await bot.send_message(chat_id, "✍️ Введите ваш ответ администратору:", reply_markup=markup)
-        user_states[user_id] = {'state': 'awaiting_admin_reply', 'admin_id': admin_id}
-        await set_user_state(user_id_int, user_states[user_id])
+        await set_user_state(user_id_int, {'state': 'awaiting_admin_reply', 'admin_id': admin_id})
         await call.answer()
         return
 
     # Обработка изменения ставки (вызов ввода)
     elif data == 'change_bet_input':
-        uid = str(call.from_user.id)
         # Пытаемся определить игру по стейту или тексту
         game_type = None
-        state = user_states.get(uid)
+        state = state_cache.get(user_id_int)
         if isinstance(state, dict):
             if 'last_casino_bet' in state: game_type = 'casino'
             elif 'last_dice_bet' in state: game_type = 'dice'
@@ -2064,7 +3955,6 @@ async def handle_query(call: types.CallbackQuery):
 
         if game_type:
             new_state = {"state": f"awaiting_{game_type}_bet"}
-            user_states[uid] = new_state
             await set_user_state(call.from_user.id, new_state)
             await call.message.answer("💰 Введите новую ставку (от 1 до 50 ⭐️):", parse_mode="HTML")
             await call.answer()
@@ -2081,19 +3971,13 @@ async def handle_query(call: types.CallbackQuery):
         await call.answer()
         return
 
-    session = await get_user_session(user_id_int)
-    key = f"{user_id}:{msg_id}:{session}"
-
-    if await is_button_used(user_id_int, key):
+    ctx = await load_user_context(
+        user_id_int, call.from_user.first_name or 'Пользователь', call.from_user.username or '', msg_id
+    )
+    if ctx.button_used:
         await call.answer()
         return
-    else:
-        await mark_button_used(user_id_int, key)
-
-    user = await get_user(user_id_int)
-    if not user:
-        await create_user(user_id_int, call.from_user.first_name or 'Пользователь', call.from_user.username or '')
-        user = await get_user(user_id_int)
+    user = ctx.user
 
     data = call.data
     back_markup = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -2143,7 +4027,6 @@ async def handle_query(call: types.CallbackQuery):
             reply_markup=back_markup,
             parse_mode='HTML'
         )
-        user_states[str(user_id_int)] = 'awaiting_promo'
         await set_user_state(user_id_int, 'awaiting_promo')
 
     elif data == 'referral':
@@ -2196,7 +4079,7 @@ async def handle_query(call: types.CallbackQuery):
 
     elif data == 'daily':
         # Проверяем КД перед показом кнопки открытия
-        user_data = await get_user(user_id_int)
+        user_data = user
         now = time.time()
         if now - user_data['last_bonus'] < 86400:
             await bot.send_photo(
@@ -2240,6 +4123,17 @@ async def handle_query(call: types.CallbackQuery):
             "JACKPOT": "attached_assets/Джекпот__1767819250926.MP4"
         }
 
+        result, error = await roll_fortune_wheel(user_id_int)
+        if error:
+            await bot.send_photo(
+                chat_id, images['bonus'],
+                caption="⏱ Кейс уже открыт сегодня. Возвращайся завтра!" if error == 'cooldown' else "❌ Не удалось открыть кейс.",
+                reply_markup=back_markup
+            )
+            return
+        amount = result['amount']
+        is_jackpot = result['is_jackpot']
+
         # Каждое из видео выше должно существовать в attached_assets
         # Если видео не отправлялось, возможно проблема в типах данных (float vs int)
         # Приведем ключ к float для надежности
@@ -2257,7 +4151,7 @@ async def handle_query(call: types.CallbackQuery):
             await bot.send_message(chat_id, "🎡 Крутим колесо фортуны...")
 
         # Задержка 7 секунд перед результатом
-        await asyncio.sleep(7)
+        await animation_pause(7)
         
         if is_jackpot:
             msg = (
@@ -2372,7 +4266,7 @@ async def handle_query(call: types.CallbackQuery):
 
             # Получаем только активные турниры (идущие в данный момент)
             import json
-            async with db_pool.acquire() as conn:
+            async with acquire_conn() as conn:
                 now = int(time.time())
                 all_tournaments = await conn.fetch(
                     '''SELECT id, name, start_time, end_time, status, prize_places, prizes
@@ -2474,7 +4368,7 @@ async def handle_query(call: types.CallbackQuery):
         tournament_id = int(data.split('_')[-1])
         leaderboard = await get_tournament_leaderboard(tournament_id, 10)
 
-        async with db_pool.acquire() as conn:
+        async with acquire_conn() as conn:
             t_row = await conn.fetchrow('SELECT name FROM tournaments WHERE id = $1', tournament_id)
             t_name = t_row['name'] if t_row else "Турнир"
 
@@ -2587,12 +4481,11 @@ async def handle_query(call: types.CallbackQuery):
 
     elif data == 'knb_repeat_bet':
         chat_id = call.message.chat.id
-        uid = str(user_id_int)
 
         # Сначала пробуем из памяти, потом из БД
-        last_state = user_states.get(uid)
+        last_state = state_cache.get(user_id_int)
         if not isinstance(last_state, dict) or 'last_knb_bet' not in last_state:
-            db_state = await get_user_state(user_id_int)
+            db_state = ctx.state_data
             if db_state:
                 import json
                 try:
@@ -2617,8 +4510,7 @@ async def handle_query(call: types.CallbackQuery):
             await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
             return
 
-        balance = await get_user_balance(user_id_int)
-        if bet > balance:
+        if bet > user['balance']:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
@@ -2626,8 +4518,7 @@ async def handle_query(call: types.CallbackQuery):
             return
 
         # Устанавливаем текущую ставку для выбора предмета
-        user_states[uid] = {'bet': bet, 'last_knb_bet': bet}
-        await set_user_state(user_id_int, user_states[uid])
+        await set_user_state(user_id_int, {'bet': bet, 'last_knb_bet': bet})
 
         markup = types.InlineKeyboardMarkup(row_width=3, inline_keyboard=[
             [types.InlineKeyboardButton(text="✊ Камень", callback_data="knb_choice_rock"),
@@ -2653,15 +4544,14 @@ async def handle_query(call: types.CallbackQuery):
             reply_markup=back_markup,
             parse_mode='HTML'
         )
-        user_states[str(user_id)] = 'awaiting_casino_bet'
+        state_cache.set(user_id_int, 'awaiting_casino_bet', persist=False)
 
     elif data == 'casino_repeat_bet':
         chat_id = call.message.chat.id
-        uid = str(user_id_int)
 
-        last_state = user_states.get(uid)
+        last_state = state_cache.get(user_id_int)
         if not isinstance(last_state, dict) or 'last_casino_bet' not in last_state:
-            db_state = await get_user_state(user_id_int)
+            db_state = ctx.state_data
             if db_state:
                 import json
                 try:
@@ -2682,26 +4572,18 @@ async def handle_query(call: types.CallbackQuery):
             await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
             return
 
-        balance = await get_user_balance(user_id_int)
-        if bet > balance:
+        if bet > user['balance']:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для повторной ставки.", reply_markup=markup)
             return
 
-        await update_user_balance(user_id_int, -bet)
-        # Логируем ставку при повторной игре
-        curr_game_bet = 'casino'
-        if 'last_dice_bet' in last_state: curr_game_bet = 'dice'
-        elif 'last_basket_bet' in last_state: curr_game_bet = 'basket'
-        elif 'last_bowling_bet' in last_state: curr_game_bet = 'bowling'
-        elif 'last_knb_bet' in last_state: curr_game_bet = 'knb'
-        await log_action(user_id_int, 'casino_bet', bet, {'game': curr_game_bet})
-
-        msg = await bot.send_dice(chat_id, emoji='🎰')
+        msg = await roll_for_bet(user_id_int, 'casino', bet, lambda: bot.send_dice(chat_id, emoji='🎰'))
+        if msg is None:
+            await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для ставки.")
+            return
         value = msg.dice.value if msg.dice else 0
-        await asyncio.sleep(2)
 
         win = 0
         result_text = ""
@@ -2721,19 +4603,8 @@ async def handle_query(call: types.CallbackQuery):
         else:
             result_text = f"😓 Увы, звёзды не сошлись...\nТы проиграл {bet} ⭐️."
 
-        await update_user_balance(user_id_int, win)
-        new_balance = await get_user_balance(user_id_int)
-
-        # Логируем результат повторной игры
-        outcome = 'win' if win > 0 else 'loss'
-        # Пытаемся определить текущую игру
-        curr_game = 'casino'
-        if 'last_dice_bet' in last_state: curr_game = 'dice'
-        elif 'last_basket_bet' in last_state: curr_game = 'basket'
-        elif 'last_bowling_bet' in last_state: curr_game = 'bowling'
-        elif 'last_knb_bet' in last_state: curr_game = 'knb'
-
-        await log_action(user_id_int, 'casino_result', win, {'bet': bet, 'outcome': outcome, 'game': curr_game})
+        new_balance = await settle_reserved_bet(user_id_int, 'casino', bet, win, 'win' if win > 0 else 'loss')
+        await animation_pause(2)
 
         final_message = (
             f"🧠 <b>Результат игры</b>\n"
@@ -2750,7 +4621,6 @@ async def handle_query(call: types.CallbackQuery):
 
         await bot.send_message(chat_id, final_message, parse_mode='HTML', reply_markup=markup)
         new_state = {'last_casino_bet': bet}
-        user_states[uid] = new_state
         await set_user_state(user_id_int, new_state)
 
     elif data == 'game_knb':
@@ -2770,18 +4640,16 @@ async def handle_query(call: types.CallbackQuery):
             parse_mode='HTML'
         )
         new_state = {"state": "awaiting_knb_bet"}
-        user_states[str(user_id)] = new_state
         await set_user_state(user_id_int, new_state)
 
     elif data and data.startswith('knb_choice_'):
         user_choice = data.split('_')[-1]
         chat_id = call.message.chat.id
-        uid = str(user_id_int)
 
         # Пытаемся получить состояние из памяти или БД
-        user_state = user_states.get(uid)
+        user_state = state_cache.get(user_id_int)
         if not isinstance(user_state, dict) or 'bet' not in user_state:
-            user_state = await get_user_state(user_id_int)
+            user_state = ctx.state
 
         if not isinstance(user_state, dict) or 'bet' not in user_state:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -2791,9 +4659,7 @@ async def handle_query(call: types.CallbackQuery):
             return
 
         bet = user_state['bet']
-        balance = await get_user_balance(user_id_int)
-
-        if bet > balance:
+        if bet > user['balance']:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
@@ -2804,37 +4670,39 @@ async def handle_query(call: types.CallbackQuery):
         choices_emoji = {'rock': '✊', 'scissors': '✌️', 'paper': '🖐'}
         win_map = {'rock': 'scissors', 'scissors': 'paper', 'paper': 'rock'}
 
+        # Вычисляем результат и сразу фиксируем его, анимация идёт уже после расчёта
+        if user_choice == bot_choice:
+            result_text = "🤝 <b>Ничья!</b> Твоя ставка возвращается."
+            payout, outcome = bet, 'draw'
+        elif win_map[user_choice] == bot_choice:
+            payout, outcome = round(bet * 1.9, 2), 'win'
+            result_text = f"🎉 <b>Ты победил!</b>\nТы заработал <b>+{round(bet * 0.9, 2)} ⭐️</b>!"
+        else:
+            payout, outcome = 0, 'loss'
+            result_text = f"💥 <b>Ты проиграл...</b>\nПроиграно <b>{bet} ⭐️</b>"
+
+        new_balance = await settle_bet(user_id_int, 'knb', bet, payout, outcome)
+        if new_balance is None:
+            await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для ставки.")
+            return
+
         # Step 1: Отправляем "Вы выбрали:"
         await bot.send_message(chat_id, "<b>🧍‍♂️ Ты выбрал:</b>", parse_mode='HTML')
-        await asyncio.sleep(0.7)
+        await animation_pause(0.7)
 
         # Step 2: Отправляем стикер/эмодзи выбора пользователя
         await bot.send_message(chat_id, choices_emoji[user_choice], parse_mode='HTML')
-        await asyncio.sleep(0.7)
+        await animation_pause(0.7)
 
         # Step 3: Отправляем "Бот выбрал:"
         await bot.send_message(chat_id, "<b>🤖 Бот выбрал:</b>", parse_mode='HTML')
-        await asyncio.sleep(0.7)
+        await animation_pause(0.7)
 
         # Step 4: Отправляем Эмодзи выбора бота с анимацией
         await bot.send_message(chat_id, choices_emoji[bot_choice], parse_mode='HTML')
-        await asyncio.sleep(0.7)
+        await animation_pause(0.7)
         # Step 5: Отправляем финальный результат
 
-        # Вычисляем результат
-        if user_choice == bot_choice:
-            result_text = "🤝 <b>Ничья!</b> Твоя ставка возвращается."
-            delta = 0
-        elif win_map[user_choice] == bot_choice:
-            delta = round(bet * 0.9, 2)
-            result_text = f"🎉 <b>Ты победил!</b>\nТы заработал <b>+{delta} ⭐️</b>!"
-        else:
-            delta = -bet
-            result_text = f"💥 <b>Ты проиграл...</b>\nПроиграно <b>{bet} ⭐️</b>"
-
-        await update_user_balance(user_id_int, delta)
-        new_balance = await get_user_balance(user_id_int)
-
         # Собираем финальное сообщение в новом формате
         final_message = (
             "🧠 <b>Результат игры</b>\n"
@@ -2857,7 +4725,6 @@ async def handle_query(call: types.CallbackQuery):
 
         # Сохраняем для повтора и обновляем состояние в БД
         new_state = {'last_knb_bet': bet, 'bet': bet}
-        user_states[uid] = new_state
         await set_user_state(user_id_int, new_state)
 
     elif data == 'game_dice':
@@ -2876,15 +4743,14 @@ async def handle_query(call: types.CallbackQuery):
             reply_markup=back_markup,
             parse_mode='HTML'
         )
-        user_states[str(user_id)] = 'awaiting_dice_bet'
+        state_cache.set(user_id_int, 'awaiting_dice_bet', persist=False)
 
     elif data == 'dice_repeat_bet':
         chat_id = call.message.chat.id
-        uid = str(user_id_int)
 
-        last_state = user_states.get(uid)
+        last_state = state_cache.get(user_id_int)
         if not isinstance(last_state, dict) or 'last_dice_bet' not in last_state:
-            db_state = await get_user_state(user_id_int)
+            db_state = ctx.state_data
             if db_state:
                 import json
                 try:
@@ -2906,38 +4772,42 @@ async def handle_query(call: types.CallbackQuery):
             await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
             return
 
-        balance = await get_user_balance(user_id_int)
-        if bet > balance:
+        if bet > user['balance']:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для повторной ставки.", reply_markup=markup)
             return
 
-        await update_user_balance(user_id_int, -bet)
+        async def throw_dice():
+            await bot.send_message(chat_id, "🎲 <b>Твой бросок:</b>", parse_mode="HTML")
+            user_dice_msg = await bot.send_dice(chat_id, emoji="🎲")
+            await animation_pause(3)
 
-        await bot.send_message(chat_id, "🎲 <b>Твой бросок:</b>", parse_mode="HTML")
-        user_dice_msg = await bot.send_dice(chat_id, emoji="🎲")
-        user_value = user_dice_msg.dice.value if user_dice_msg.dice else 1
-        await asyncio.sleep(3)
+            await bot.send_message(chat_id, "🤖 <b>Бросок соперника:</b>", parse_mode="HTML")
+            bot_dice_msg = await bot.send_dice(chat_id, emoji="🎲")
+            return user_dice_msg, bot_dice_msg
 
-        await bot.send_message(chat_id, "🤖 <b>Бросок соперника:</b>", parse_mode="HTML")
-        bot_dice_msg = await bot.send_dice(chat_id, emoji="🎲")
+        throws = await roll_for_bet(user_id_int, 'dice', bet, throw_dice)
+        if throws is None:
+            await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для ставки.")
+            return
+        user_dice_msg, bot_dice_msg = throws
+        user_value = user_dice_msg.dice.value if user_dice_msg.dice else 1
         bot_value = bot_dice_msg.dice.value if bot_dice_msg.dice else 1
-        await asyncio.sleep(3)
 
-        delta = 0
         if user_value > bot_value:
-            delta = round(bet * 1.9, 2)
-            result_text = f"🎉 <b>Победа!</b> Ты выиграл <b>+{delta} ⭐️</b>"
+            payout, outcome = round(bet * 1.9, 2), 'win'
+            result_text = f"🎉 <b>Победа!</b> Ты выиграл <b>+{payout} ⭐️</b>"
         elif user_value == bot_value:
-            delta = bet
+            payout, outcome = bet, 'draw'
             result_text = f"🤝 <b>Ничья!</b> Ставка <b>{bet}</b> ⭐️ возвращается."
         else:
+            payout, outcome = 0, 'loss'
             result_text = f"💥 <b>Поражение!</b> Ты потерял <b>{bet} ⭐️</b>"
 
-        await update_user_balance(user_id_int, delta)
-        new_balance = await get_user_balance(user_id_int)
+        new_balance = await settle_reserved_bet(user_id_int, 'dice', bet, payout, outcome)
+        await animation_pause(3)
 
         final_message = (
             "🧠 <b>Результат игры</b>\n"
@@ -2958,7 +4828,6 @@ async def handle_query(call: types.CallbackQuery):
 
         await bot.send_message(chat_id, final_message, parse_mode='HTML', reply_markup=markup)
         new_state = {'last_dice_bet': bet}
-        user_states[uid] = new_state
         await set_user_state(user_id_int, new_state)
 
     elif data == 'game_basket':
@@ -2977,15 +4846,14 @@ async def handle_query(call: types.CallbackQuery):
             reply_markup=back_markup,
             parse_mode='HTML'
         )
-        user_states[str(user_id)] = 'awaiting_basket_bet'
+        state_cache.set(user_id_int, 'awaiting_basket_bet', persist=False)
 
     elif data == 'basket_repeat_bet':
         chat_id = call.message.chat.id
-        uid = str(user_id_int)
 
-        last_state = user_states.get(uid)
+        last_state = state_cache.get(user_id_int)
         if not isinstance(last_state, dict) or 'last_basket_bet' not in last_state:
-            db_state = await get_user_state(user_id_int)
+            db_state = ctx.state_data
             if db_state:
                 import json
                 try:
@@ -3007,21 +4875,18 @@ async def handle_query(call: types.CallbackQuery):
             await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
             return
 
-        balance = await get_user_balance(user_id_int)
-        if bet > balance:
+        if bet > user['balance']:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для повторной ставки.", reply_markup=markup)
             return
 
-        await update_user_balance(user_id_int, -bet)
-        # Логируем ставку при повторной игре
-        await log_action(user_id_int, 'casino_bet', bet, {'game': 'basket'})
-
-        throw_msg = await bot.send_dice(chat_id, emoji="🏀")
+        throw_msg = await roll_for_bet(user_id_int, 'basket', bet, lambda: bot.send_dice(chat_id, emoji="🏀"))
+        if throw_msg is None:
+            await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для ставки.")
+            return
         value = throw_msg.dice.value
-        await asyncio.sleep(3)
 
         if value in (4, 5):
             win = round(bet * 2)
@@ -3030,19 +4895,8 @@ async def handle_query(call: types.CallbackQuery):
             win = 0
             result_text = f"💥 <b> Мимо!</b>\n\n Ты проиграл <b>{bet}</b> ⭐️"
 
-        await update_user_balance(user_id_int, win)
-        new_balance = await get_user_balance(user_id_int)
-
-        # Логируем результат повторной игры
-        outcome = 'win' if win > 0 else 'loss'
-        # Пытаемся определить текущую игру
-        curr_game = 'casino'
-        if 'last_dice_bet' in last_state: curr_game = 'dice'
-        elif 'last_basket_bet' in last_state: curr_game = 'basket'
-        elif 'last_bowling_bet' in last_state: curr_game = 'bowling'
-        elif 'last_knb_bet' in last_state: curr_game = 'knb'
-
-        await log_action(user_id_int, 'casino_result', win, {'bet': bet, 'outcome': outcome, 'game': curr_game})
+        new_balance = await settle_reserved_bet(user_id_int, 'basket', bet, win, 'win' if win > 0 else 'loss')
+        await animation_pause(3)
 
         final_message = (
             "🧠 <b>Результат игры</b>\n"
@@ -3061,7 +4915,6 @@ async def handle_query(call: types.CallbackQuery):
 
         await bot.send_message(chat_id, final_message, parse_mode='HTML', reply_markup=markup)
         new_state = {'last_basket_bet': bet}
-        user_states[uid] = new_state
         await set_user_state(user_id_int, new_state)
 
     elif data == 'game_bowling':
@@ -3080,16 +4933,12 @@ async def handle_query(call: types.CallbackQuery):
             reply_markup=back_markup,
             parse_mode='HTML'
         )
-        user_states[str(user_id)] = 'awaiting_bowling_bet'
+        state_cache.set(user_id_int, 'awaiting_bowling_bet', persist=False)
 
     elif data == 'bowling_repeat_bet':
-        uid = str(user_id_int)
-        last_state = user_states.get(uid)
+        last_state = state_cache.get(user_id_int)
         if not last_state or 'last_bowling_bet' not in last_state:
-            last_state = await get_user_state(user_id_int)
-            if isinstance(last_state, str):
-                import json
-                last_state = json.loads(last_state)
+            last_state = ctx.state
 
         bet = last_state.get('last_bowling_bet') if isinstance(last_state, dict) else None
 
@@ -3100,21 +4949,18 @@ async def handle_query(call: types.CallbackQuery):
             await bot.send_message(chat_id, "❌ Ставка не найдена. Начни игру заново.", reply_markup=markup)
             return
 
-        balance = await get_user_balance(user_id_int)
-        if bet > balance:
+        if bet > user['balance']:
             markup = types.InlineKeyboardMarkup(inline_keyboard=[
                 [types.InlineKeyboardButton(text="🏠 Вернуться в меню", callback_data='menu')]
             ])
             await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для ставки", reply_markup=markup)
             return
 
-        await update_user_balance(user_id_int, -bet)
-        # Логируем ставку при повторной игре
-        await log_action(user_id_int, 'casino_bet', bet, {'game': 'bowling'})
-
-        throw_msg = await bot.send_dice(chat_id, emoji="🎳")
+        throw_msg = await roll_for_bet(user_id_int, 'bowling', bet, lambda: bot.send_dice(chat_id, emoji="🎳"))
+        if throw_msg is None:
+            await bot.send_message(chat_id, "❌ Недостаточно ⭐️ для ставки.")
+            return
         value = throw_msg.dice.value
-        await asyncio.sleep(3)
 
         if value == 6:
             win = round(bet * 3, 2)
@@ -3126,19 +4972,8 @@ async def handle_query(call: types.CallbackQuery):
             win = 0
             result_text = f"💥 <b>Ты промазал...</b> Кегли устояли.\n\n<b>Проиграно {bet} ⭐️</b>"
 
-        await update_user_balance(user_id_int, win)
-        new_balance = await get_user_balance(user_id_int)
-
-        # Логируем результат повторной игры
-        outcome = 'win' if win > 0 else 'loss'
-        # Пытаемся определить текущую игру
-        curr_game = 'casino'
-        if 'last_dice_bet' in last_state: curr_game = 'dice'
-        elif 'last_basket_bet' in last_state: curr_game = 'basket'
-        elif 'last_bowling_bet' in last_state: curr_game = 'bowling'
-        elif 'last_knb_bet' in last_state: curr_game = 'knb'
-
-        await log_action(user_id_int, 'casino_result', win, {'bet': bet, 'outcome': outcome, 'game': curr_game})
+        new_balance = await settle_reserved_bet(user_id_int, 'bowling', bet, win, 'win' if win > 0 else 'loss')
+        await animation_pause(3)
 
         final_message = (
             "🧠 <b>Результат игры</b>\n"
@@ -3157,7 +4992,6 @@ async def handle_query(call: types.CallbackQuery):
 
         await bot.send_message(chat_id, final_message, parse_mode='HTML', reply_markup=markup)
         new_state = {'last_bowling_bet': bet}
-        user_states[uid] = new_state
         await set_user_state(user_id_int, new_state)
 
     # Обработчик для кнопки-индикатора (не делает ничего)
@@ -3316,12 +5150,10 @@ async def handle_animation(message: types.Message):
 
 @dp.message()
 async def handle_user_input(message: types.Message):
-    uid = str(message.from_user.id)
     uid_int = message.from_user.id
 
     if message.text and message.text.startswith('/'):
         # This is a command, we should reset the state and let it be handled by command handlers
-        user_states[uid] = None
         await set_user_state(uid_int, None)
 
         # If the command has a specific handler, aiogram 3.x with Dispatcher 
@@ -3333,19 +5165,16 @@ async def handle_user_input(message: types.Message):
     if not await check_subscription(message.from_user.id):
         await send_subscription_message(message.chat.id)
         return
-    state_raw = user_states.get(uid)
+    state_raw = state_cache.get(uid_int)
     if not state_raw:
-        db_state = await get_user_state(uid_int)
-        import json
-        try:
-            if isinstance(db_state, str):
-                state_raw = json.loads(db_state)
-            else:
-                state_raw = db_state
-            if state_raw:
-                user_states[uid] = state_raw
-        except:
-            state_raw = db_state
+        # Без создания пользователя: иначе реферальная ссылка в последующем /start уже не сработала бы
+        ctx = await load_user_context(
+            uid_int, message.from_user.first_name or 'Пользователь', message.from_user.username or '',
+            create=False
+        )
+        state_raw = ctx.state if ctx else None
+        if state_raw:
+            state_cache.set(uid_int, state_raw, persist=False)
 
     state = state_raw
     if isinstance(state, dict):
@@ -3359,7 +5188,6 @@ async def handle_user_input(message: types.Message):
         
         # Если промокод неверный или исчерпан, оставляем состояние ожидания
         if result['success']:
-            user_states[uid] = None
             await set_user_state(uid_int, None)
         return
     elif state == 'awaiting_admin_reply':
@@ -3430,6 +5258,7 @@ async def handle_user_input(message: types.Message):
                 )
 
             await message.reply(f"✅ <b>Ответ успешно отправлен пользователю</b> <code>{target_uid}</code>", parse_mode='HTML')
+            await answer_support_ticket(target_uid, uid_int)
 
             # Помечаем исходное сообщение как отвеченное
             msg_to_edit = state_raw.get('message_to_edit')
@@ -3451,7 +5280,6 @@ async def handle_user_input(message: types.Message):
             await message.reply(f"❌ Не удалось отправить ответ: {e}")
 
         finally:
-            user_states[uid] = None
             await set_user_state(uid_int, None)
         return
 
@@ -3466,6 +5294,8 @@ async def handle_user_input(message: types.Message):
         admin_info = f"{prefix}\n👤 <b>Пользователь:</b> @{username}\n🆔 <b>ID:</b> <code>{uid_int}</code>"
         
         try:
+            # Тикет пишется до отправки: если админ не получит сообщение, оно останется в /active_support
+            await open_support_ticket(uid_int, support_message_preview(message))
             if message.sticker:
                 await bot.send_message(ADMIN_ID, admin_info, parse_mode='HTML')
                 await bot.send_sticker(ADMIN_ID, message.sticker.file_id, reply_markup=markup)
@@ -3504,7 +5334,6 @@ async def handle_user_input(message: types.Message):
         except Exception as e:
             await message.answer(f"❌ Ошибка при отправке: {e}")
 
-        user_states[uid] = None
         await set_user_state(uid_int, None)
         return
 
@@ -3538,6 +5367,7 @@ async def handle_user_input(message: types.Message):
                     await bot.send_message(target_user_id, f"{admin_info}\n\n{message.text or ''}", parse_mode='HTML', reply_markup=markup)
                 
                 await message.answer("✅ <b>Ответ отправлен!</b>", parse_mode='HTML')
+                await answer_support_ticket(target_user_id, uid_int)
                 
                 # Помечаем исходное сообщение как отвеченное
                 msg_to_edit = state_raw.get('message_to_edit')
@@ -3558,7 +5388,6 @@ async def handle_user_input(message: types.Message):
         else:
             await message.answer("❌ Ошибка: получатель не найден.")
 
-        user_states[uid] = None
         await set_user_state(uid_int, None)
         return
 
@@ -3572,6 +5401,8 @@ async def handle_user_input(message: types.Message):
         admin_info = f"🆘 <b>Новое сообщение в техподдержку!</b>\n👤 <b>Пользователь:</b> @{username}\n🆔 <b>ID:</b> <code>{uid_int}</code>"
         
         try:
+            # Тикет пишется до отправки: если админ не получит сообщение, оно останется в /active_support
+            await open_support_ticket(uid_int, support_message_preview(message))
             if message.sticker:
                 await bot.send_message(ADMIN_ID, admin_info, parse_mode='HTML')
                 await bot.send_sticker(ADMIN_ID, message.sticker.file_id, reply_markup=markup)
@@ -3595,7 +5426,6 @@ async def handle_user_input(message: types.Message):
         except Exception as e:
             await message.answer(f"❌ Ошибка при отправке: {e}")
 
-        user_states[uid] = None
         await set_user_state(uid_int, None)
         return
 
@@ -3619,17 +5449,15 @@ async def handle_user_input(message: types.Message):
                 await message.reply(f"❌ Недостаточно средств. Ваш баланс: {balance} ⭐️. Введите доступную сумму:")
                 return
 
-            if await withdraw_balance(uid_int, amount):
-                # Сначала логируем, потом уведомляем
-                await log_action(uid_int, 'withdraw_request', amount)
-                
+            withdrawal_id = await withdraw_balance(uid_int, amount)
+            if withdrawal_id:
                 # Создаем кнопку для админа
                 admin_markup = types.InlineKeyboardMarkup(inline_keyboard=[
-                    [types.InlineKeyboardButton(text="✅ Принять", callback_data=f"withdraw_approve_{uid_int}_{amount}")]
+                    [types.InlineKeyboardButton(text="✅ Принять", callback_data=f"withdrawal_approve_{withdrawal_id}")]
                 ])
 
                 admin_msg = (
-                    f"💰 <b>Заявка на вывод</b>\n\n"
+                    f"💰 <b>Заявка на вывод #{withdrawal_id}</b>\n\n"
                     f"👤 Пользователь: @{message.from_user.username or 'нет'}\n"
                     f"🆔 ID: {uid_int}\n"
                     f"💵 Сумма: {amount} ⭐️"
@@ -3641,11 +5469,9 @@ async def handle_user_input(message: types.Message):
                     print(f"[WITHDRAW] Error sending notification to admin: {e}")
                     await message.reply("✅ Заявка создана, но администратор не был уведомлен. Не волнуйтесь, ваша заявка сохранена.")
                 
-                user_states[uid] = None
                 await set_user_state(uid_int, None)
             else:
                 await message.reply("❌ Ошибка при создании заявки. Попробуйте позже.")
-                user_states[uid] = None
                 await set_user_state(uid_int, None)
 
         except ValueError:
@@ -3686,11 +5512,10 @@ async def handle_user_input(message: types.Message):
                 await bot.send_message(target_user_id, f"{admin_info}\n\n{message.text or ''}", parse_mode='HTML', reply_markup=markup)
 
             await message.reply(f"✅ <b>Ответ успешно отправлен пользователю</b> <code>{target_user_id}</code>", parse_mode='HTML')
-            await log_action(ADMIN_ID, 'support_replied', 0, {'target_user': target_user_id})
+            await answer_support_ticket(target_user_id, uid_int)
         except Exception as e:
             await message.reply(f"❌ Не удалось отправить ответ: {e}")
 
-        user_states[uid] = None
         await set_user_state(uid_int, None)
 
     # Обработка ввода ставки для КНБ
@@ -3707,10 +5532,8 @@ async def handle_user_input(message: types.Message):
                 await message.reply(f"❌ Недостаточно ⭐️ для ставки. Ваш баланс: {balance} ⭐️. Введите доступную ставку:")
                 return
 
-            await log_action(uid_int, 'casino_bet', float(bet), {'game': 'knb'})
             # Сохраняем ставку и переводим в состояние выбора предмета
             new_state = {"state": "awaiting_knb_choice", "bet": bet}
-            user_states[uid] = new_state
             await set_user_state(uid_int, new_state)
 
             markup = types.InlineKeyboardMarkup(row_width=3, inline_keyboard=[
@@ -3719,8 +5542,7 @@ async def handle_user_input(message: types.Message):
                  types.InlineKeyboardButton(text="🖐 Бумага", callback_data="knb_choice_paper")]
             ])
             await bot.send_message(message.chat.id, "Выбирай предмет:", parse_mode="HTML", reply_markup=markup)
-            # Log the bet and wait for result in callback
-            await log_action(uid_int, 'casino_bet', float(bet), {'game': 'knb'})
+            # Ставка списывается и логируется в settle_bet при выборе предмета
 
         except ValueError:
             await message.reply("❌ Введите число!")
@@ -3749,13 +5571,15 @@ async def handle_user_input(message: types.Message):
                 await message.reply(f"❌ Недостаточно ⭐️ для ставки. Ваш баланс: {balance} ⭐️. Попробуйте еще раз:")
                 return
 
-            await update_user_balance(uid_int, -bet)
-            await log_action(uid_int, 'casino_bet', float(bet), {'game': 'casino'})
+            async def spin():
+                await bot.send_message(message.chat.id, "🎰 <b>Твой спин:</b>", parse_mode="HTML")
+                return await bot.send_dice(message.chat.id, emoji="🎰")
 
-            await bot.send_message(message.chat.id, "🎰 <b>Твой спин:</b>", parse_mode="HTML")
-            slot_msg = await bot.send_dice(message.chat.id, emoji="🎰")
+            slot_msg = await roll_for_bet(uid_int, 'casino', bet, spin)
+            if slot_msg is None:
+                await message.reply("❌ Недостаточно ⭐️ для ставки.")
+                return
             value = slot_msg.dice.value
-            await asyncio.sleep(2)
 
             win = 0
             result_text = ""
@@ -3784,9 +5608,8 @@ async def handle_user_input(message: types.Message):
                     f"Ты проиграл {bet} ⭐️"
                 )
 
-            await update_user_balance(uid_int, win)
-            await log_action(uid_int, 'casino_result', win, {'game': 'casino', 'bet': bet, 'outcome': outcome})
-            new_balance = await get_user_balance(uid_int)
+            new_balance = await settle_reserved_bet(uid_int, 'casino', bet, win, outcome)
+            await animation_pause(2)
 
             final_message = (
                 f"🧠 <b>Результат игры</b>\n"
@@ -3805,12 +5628,10 @@ async def handle_user_input(message: types.Message):
 
             # Сохраняем состояние для повтора
             new_state = {'last_casino_bet': bet}
-            user_states[uid] = new_state
             await set_user_state(uid_int, new_state)
 
         except ValueError:
             await bot.send_message(message.chat.id, "❌ Введи число!")
-            user_states[uid] = None
             await set_user_state(uid_int, None)
 
     elif state == 'awaiting_dice_bet':
@@ -3827,30 +5648,32 @@ async def handle_user_input(message: types.Message):
                 await message.reply(f"❌ Недостаточно ⭐️ для ставки. Ваш баланс: {balance} ⭐️. Попробуйте еще раз:")
                 return
 
-            await update_user_balance(uid_int, -bet)
-            await log_action(uid_int, 'casino_bet', float(bet), {'game': 'dice'})
-
-            await bot.send_message(message.chat.id, "🎲 <b>Твой бросок:</b>", parse_mode="HTML")
-            user_dice = (await bot.send_dice(message.chat.id, emoji="🎲")).dice.value
-            await asyncio.sleep(3)
-            await bot.send_message(message.chat.id, "🤖 <b>Бросок соперника:</b>", parse_mode="HTML")
-            bot_dice = (await bot.send_dice(message.chat.id, emoji="🎲")).dice.value
-            await asyncio.sleep(3)
+            async def throw_dice():
+                await bot.send_message(message.chat.id, "🎲 <b>Твой бросок:</b>", parse_mode="HTML")
+                user_dice = (await bot.send_dice(message.chat.id, emoji="🎲")).dice.value
+                await animation_pause(3)
+                await bot.send_message(message.chat.id, "🤖 <b>Бросок соперника:</b>", parse_mode="HTML")
+                bot_dice = (await bot.send_dice(message.chat.id, emoji="🎲")).dice.value
+                return user_dice, bot_dice
+
+            throws = await roll_for_bet(uid_int, 'dice', bet, throw_dice)
+            if throws is None:
+                await message.reply("❌ Недостаточно ⭐️ для ставки.")
+                return
+            user_dice, bot_dice = throws
 
             if user_dice > bot_dice:
-                win = round(bet * 1.9, 2)
-                await update_user_balance(uid_int, win)
-                await log_action(uid_int, 'casino_result', win, {'game': 'dice', 'bet': bet, 'outcome': 'win'})
+                win, outcome = round(bet * 1.9, 2), 'win'
                 result_text = f"🎉 Ты выиграл <b>{win}</b> ⭐️"
             elif user_dice < bot_dice:
-                await log_action(uid_int, 'casino_result', 0, {'game': 'dice', 'bet': bet, 'outcome': 'loss'})
+                win, outcome = 0, 'loss'
                 result_text = f"💥 Ты потерял <b>{bet}</b> ⭐️"
             else:
-                await update_user_balance(uid_int, bet)
-                await log_action(uid_int, 'casino_result', bet, {'game': 'dice', 'bet': bet, 'outcome': 'draw'})
+                win, outcome = bet, 'draw'
                 result_text = f"🤝 <b>Ничья!</b> Ставка <b>{bet}</b> ⭐️\n возвращается"
 
-            new_balance = await get_user_balance(uid_int)
+            new_balance = await settle_reserved_bet(uid_int, 'dice', bet, win, outcome)
+            await animation_pause(3)
 
             final_message = (
                 "🧠 <b>Результат игры</b>\n"
@@ -3873,12 +5696,10 @@ async def handle_user_input(message: types.Message):
 
             # Сохраняем состояние для повтора
             new_state = {'last_dice_bet': bet}
-            user_states[uid] = new_state
             await set_user_state(uid_int, new_state)
 
         except ValueError:
             await bot.send_message(message.chat.id, "❌ Введи число!")
-            user_states[uid] = None
             await set_user_state(uid_int, None)
 
     elif state == 'awaiting_basket_bet':
@@ -3892,23 +5713,21 @@ async def handle_user_input(message: types.Message):
             if bet > balance:
                 await message.reply(f"❌ Недостаточно ⭐️ для ставки. Ваш баланс: {balance} ⭐️. Попробуйте еще раз:")
                 return
-            await update_user_balance(uid_int, -bet)
-            await log_action(uid_int, 'casino_bet', float(bet), {'game': 'basket'})
-
-            throw_msg = await bot.send_dice(message.chat.id, emoji="🏀")
+            throw_msg = await roll_for_bet(uid_int, 'basket', bet, lambda: bot.send_dice(message.chat.id, emoji="🏀"))
+            if throw_msg is None:
+                await message.reply("❌ Недостаточно ⭐️ для ставки.")
+                return
             value = throw_msg.dice.value
-            await asyncio.sleep(3)
 
             if value in (4, 5):
-                win = round(bet * 2)
-                await update_user_balance(uid_int, win)
-                await log_action(uid_int, 'casino_result', win, {'game': 'basket', 'bet': bet, 'outcome': 'win'})
+                win, outcome = round(bet * 2), 'win'
                 result_text = f"🎉 <b>Попадание!</b>\n\n Ты выигрываешь <b>{win}</b> ⭐️"
             else:
-                await log_action(uid_int, 'casino_result', 0, {'game': 'basket', 'bet': bet, 'outcome': 'loss'})
+                win, outcome = 0, 'loss'
                 result_text = f"💥 <b> Мимо!</b>\n\n Ты проиграл <b>{bet}</b> ⭐️"
 
-            new_balance = await get_user_balance(uid_int)
+            new_balance = await settle_reserved_bet(uid_int, 'basket', bet, win, outcome)
+            await animation_pause(3)
 
             final_message = (
                 "🧠 <b>Результат игры</b>\n"
@@ -3929,12 +5748,10 @@ async def handle_user_input(message: types.Message):
 
             # Сохраняем состояние для повтора
             new_state = {'last_basket_bet': bet}
-            user_states[uid] = new_state
             await set_user_state(uid_int, new_state)
 
         except ValueError:
             await bot.send_message(message.chat.id, "❌ Введи число!")
-            user_states[uid] = None
             await set_user_state(uid_int, None)
 
     elif state == 'awaiting_bowling_bet':
@@ -3948,28 +5765,24 @@ async def handle_user_input(message: types.Message):
             if bet > balance:
                 await message.reply(f"❌ Недостаточно ⭐️ для ставки. Ваш баланс: {balance} ⭐️. Попробуйте еще раз:")
                 return
-            await update_user_balance(uid_int, -bet)
-            await log_action(uid_int, 'casino_bet', float(bet), {'game': 'bowling'})
-
-            throw_msg = await bot.send_dice(message.chat.id, emoji="🎳")
+            throw_msg = await roll_for_bet(uid_int, 'bowling', bet, lambda: bot.send_dice(message.chat.id, emoji="🎳"))
+            if throw_msg is None:
+                await message.reply("❌ Недостаточно ⭐️ для ставки.")
+                return
             value = throw_msg.dice.value
-            await asyncio.sleep(3)
 
             if value == 6:
                 win = round(bet * 3, 2)
-                await log_action(uid_int, 'casino_result', win, {'game': 'bowling', 'bet': bet, 'outcome': 'win'})
                 result_text = f"🎉 <b>СТРАЙК!</b> Все кегли сбиты!\nТы получаешь <b>{win} ⭐️</b>!"
             elif value == 5:
                 win = round(bet * 2, 2)
-                await log_action(uid_int, 'casino_result', win, {'game': 'bowling', 'bet': bet, 'outcome': 'win'})
                 result_text = f"✨ <b>Отличный бросок!</b> Почти все кегли сбиты.\nТы выигрываешь <b>{win} ⭐️</b>!"
             else:
                 win = 0
-                await log_action(uid_int, 'casino_result', 0, {'game': 'bowling', 'bet': bet, 'outcome': 'loss'})
                 result_text = f"💥 <b>Ты промазал...</b> Кегли устояли.\n\n<b>Проиграно {bet} ⭐️</b>"
 
-            await update_user_balance(uid_int, win)
-            new_balance = await get_user_balance(uid_int)
+            new_balance = await settle_reserved_bet(uid_int, 'bowling', bet, win, 'win' if win > 0 else 'loss')
+            await animation_pause(3)
 
             final_message = (
                 "🧠 <b>Результат игры</b>\n"
@@ -3990,7 +5803,6 @@ async def handle_user_input(message: types.Message):
 
             # Сохраняем состояние для повтора
             new_state = {'last_bowling_bet': bet}
-            user_states[uid] = new_state
             await set_user_state(uid_int, new_state)
 
         except ValueError:
@@ -3998,44 +5810,75 @@ async def handle_user_input(message: types.Message):
                 [types.InlineKeyboardButton(text="🏠 Вернуться в меню", callback_data='menu')]
             ])
             await bot.send_message(message.chat.id, "❌ Нужно ввести число!", reply_markup=markup)
-            user_states[uid] = None
             await set_user_state(uid_int, None)
 
 # ===== BACKGROUND TASKS =====
 
+async def count_bonus_reminder_candidates(now: float) -> int:
+    async with acquire_conn() as conn:
+        return await conn.fetchval(
+            '''SELECT COUNT(*) FROM users
+               WHERE reachable AND last_bonus > 0 AND last_bonus < $1 AND last_reminded_at < $1''',
+            now - 86400
+        )
+
+async def claim_bonus_reminder_batch(now: float, limit: int):
+    """Забирает партию пользователей для напоминания и сразу отмечает их напомненными"""
+    async with acquire_conn() as conn:
+        return await conn.fetch(
+            '''UPDATE users u SET last_reminded_at = $1
+               FROM (
+                   SELECT user_id FROM users
+                   WHERE reachable AND last_bonus > 0 AND last_bonus < $2 AND last_reminded_at < $2
+                   ORDER BY last_reminded_at, user_id
+                   LIMIT $3
+                   FOR UPDATE SKIP LOCKED
+               ) candidates
+               WHERE u.user_id = candidates.user_id
+               RETURNING u.user_id, u.last_bonus''',
+            now, now - 86400, limit
+        )
+
 async def daily_bonus_notifications():
-    """Отправляет уведомления пользователям о доступной ежедневной награде"""
+    """Отправляет уведомления пользователям о доступной ежедневной награде.
+
+    Раз в час считает всех, кто не забирал награду больше суток и не получал напоминание
+    за последние сутки, и рассылает им напоминания равными партиями в течение часа.
+    """
     while True:
         try:
-            await asyncio.sleep(3600)  # Проверяем каждый час
-
             if not db_pool:
+                await asyncio.sleep(60)
                 continue
 
-            async with db_pool.acquire() as conn:
+            cycle_start = time.time()
+            candidates = await count_bonus_reminder_candidates(cycle_start)
+            batch_size = max(1, math.ceil(candidates / BONUS_REMINDER_BATCHES_PER_HOUR))
+            interval = 3600 / BONUS_REMINDER_BATCHES_PER_HOUR
+            print(f"[NOTIFICATION] {candidates} users to remind this hour, {batch_size} per batch")
+
+            for batch_no in range(BONUS_REMINDER_BATCHES_PER_HOUR):
                 now = time.time()
-                # Находим пользователей, которые не забирали награду более 24 часов
-                users_to_notify = await conn.fetch(
-                    '''SELECT user_id, name FROM users 
-                       WHERE last_bonus < $1 AND last_bonus > 0
-                       LIMIT 100''',
-                    now - 86400  # 24 часа назад
-                )
+                users_to_notify = await claim_bonus_reminder_batch(now, batch_size)
+
+                if users_to_notify:
+                    last_bonus = {row['user_id']: row['last_bonus'] for row in users_to_notify}
+
+                    async def send_func(chat_id: int):
+                        days_ago = int((now - last_bonus[chat_id]) / 86400)
+                        await bot.send_message(
+                            chat_id,
+                            f"🎁 <b>Твоя ежедневная награда ждет тебя!</b>\n\n"
+                            f"💎 Ты не забирал награду уже {days_ago} дней\n"
+                            f"⭐️ Получи 0.2 звезды прямо сейчас!",
+                            parse_mode='HTML'
+                        )
 
-                for user_row in users_to_notify:
-                    try:
-                        days_ago = int((now - user_row['last_bonus']) / 86400)
-                        if days_ago >= 1:
-                            await bot.send_message(
-                                user_row['user_id'],
-                                f"🎁 <b>Твоя ежедневная награда ждет тебя!</b>\n\n"
-                                f"💎 Ты не забирал награду уже {days_ago} дней\n"
-                                f"⭐️ Получи 0.2 звезды прямо сейчас!",
-                                parse_mode='HTML'
-                            )
-                            print(f"[NOTIFICATION] Sent daily bonus reminder to {user_row['user_id']}")
-                    except Exception as e:
-                        print(f"[NOTIFICATION] Failed to notify user {user_row['user_id']}: {e}")
+                    sent, failed = await run_broadcast(list(last_bonus), send_func, total=len(last_bonus))
+                    print(f"[NOTIFICATION] Daily bonus reminders: {sent} sent, {failed} failed")
+
+                # Следующая партия - строго по расписанию внутри часа
+                await asyncio.sleep(max(0, cycle_start + (batch_no + 1) * interval - time.time()))
 
         except Exception as e:
             print(f"[NOTIFICATION] Error in daily bonus notifications: {e}")
@@ -4049,7 +5892,7 @@ async def tournament_auto_finish():
                 await asyncio.sleep(10)
                 continue
 
-            async with db_pool.acquire() as conn:
+            async with acquire_conn() as conn:
                 now = int(time.time())
                 # Находим турниры, которые закончились, но еще активны
                 expired_tournaments = await conn.fetch(
@@ -4061,38 +5904,8 @@ async def tournament_auto_finish():
                 for tournament in expired_tournaments:
                     try:
                         print(f"[TOURNAMENT] Auto-finishing tournament {tournament['id']}: {tournament['name']}")
-                        winners = await finish_tournament(tournament['id'])
-                        print(f"[TOURNAMENT] Tournament {tournament['id']} finished successfully")
-
-                        if winners:
-                            # Получаем данные о призах
-                            async with db_pool.acquire() as conn2:
-                                t_data = await conn2.fetchrow('SELECT prizes FROM tournaments WHERE id = $1', tournament['id'])
-                                import json
-                                prizes = t_data['prizes']
-                                if isinstance(prizes, str):
-                                    try:
-                                        prizes = json.loads(prizes)
-                                    except:
-                                        prizes = {}
-
-                            # Уведомляем победителей
-                            for winner in winners:
-                                try:
-                                    place = int(winner['place'])
-                                    prize = prizes.get(str(place), 0)
-
-                                    await bot.send_message(
-                                        winner['user_id'],
-                                        f"🎉 <b>Турнир завершен!</b>\n\n"
-                                        f"Ты занял {place} место в турнире <b>{tournament['name']}</b>!\n"
-                                        f"🏆 Твоя награда: {prize}⭐️\n\n"
-                                        f"Проверь раздел 'Мои награды' 🏅",
-                                        parse_mode='HTML'
-                                    )
-                                    print(f"[TOURNAMENT] Notification sent to winner {winner['user_id']}")
-                                except Exception as e:
-                                    print(f"[TOURNAMENT] Failed to notify winner {winner['user_id']}: {e}")
+                        winners = await finish_tournament(tournament['id'], "🎉 <b>Турнир завершен!</b>")
+                        print(f"[TOURNAMENT] Tournament {tournament['id']} finished successfully, {len(winners or [])} winners notified via outbox")
                     except Exception as e:
                         print(f"[TOURNAMENT] Failed to finish tournament {tournament['id']}: {e}")
 
@@ -4117,10 +5930,20 @@ async def cleanup_task():
             print(f"[CLEANUP] Error in cleanup task: {e}")
             await asyncio.sleep(600)
 
+async def rollup_task():
+    """Поддерживает почасовые агрегаты для /stats"""
+    while True:
+        try:
+            if db_pool:
+                steps = await refresh_hourly_rollups()
+                if steps > 1:
+                    print(f"[ROLLUP] Caught up {steps} windows")
+        except Exception as e:
+            print(f"[ROLLUP] Error refreshing hourly rollups: {e}")
+        await asyncio.sleep(ROLLUP_INTERVAL_SECONDS)
+
 async def tournament_start_notifications():
     """Отправляет стартовые сообщения при начале турниров"""
-    notified_tournaments = set()  # Для отслеживания уже отправленных уведомлений
-
     while True:
         try:
             await asyncio.sleep(60)  # Проверяем каждую минуту
@@ -4128,44 +5951,33 @@ async def tournament_start_notifications():
             if not db_pool:
                 continue
 
-            async with db_pool.acquire() as conn:
-                now = int(time.time())
-                # Находим турниры, которые начались в последние 2 минуты и еще не завершены
-                starting_tournaments = await conn.fetch(
-                    '''SELECT id, name, start_message FROM tournaments 
-                       WHERE status = 'active' 
-                       AND start_time <= $1 
-                       AND start_time > $2
-                       AND start_message IS NOT NULL''',
-                    now, now - 120
-                )
+            started_jobs = []
+            async with acquire_conn() as conn:
+                async with conn.transaction():
+                    now = int(time.time())
+                    # Находим турниры, которые начались в последние 2 минуты, и атомарно
+                    # ставим маркер: рассылку создаст только один процесс
+                    starting_tournaments = await conn.fetch(
+                        '''UPDATE tournaments SET start_notified_at = NOW()
+                           WHERE status = 'active' 
+                           AND start_time <= $1 
+                           AND start_time > $2
+                           AND start_message IS NOT NULL
+                           AND start_notified_at IS NULL
+                           RETURNING id, start_message''',
+                        now, now - 120
+                    )
 
-                for tournament in starting_tournaments:
-                    # Проверяем, не отправляли ли уже уведомление для этого турнира
-                    if tournament['id'] in notified_tournaments:
-                        continue
+                    # Задание создаётся в той же транзакции, что и маркер
+                    for tournament in starting_tournaments:
+                        job_id = await create_broadcast_job({'text': tournament['start_message']}, conn=conn)
+                        started_jobs.append((tournament['id'], job_id))
 
-                    try:
-                        # Получаем всех пользователей
-                        all_users = await conn.fetch('SELECT user_id FROM users')
-
-                        sent_count = 0
-                        for user_row in all_users:
-                            try:
-                                await bot.send_message(
-                                    user_row['user_id'],
-                                    tournament['start_message'],
-                                    parse_mode='HTML'
-                                )
-                                sent_count += 1
-                                await asyncio.sleep(0.05)  # Задержка чтобы не словить лимит
-                            except Exception as e:
-                                print(f"[TOURNAMENT_START] Failed to notify user {user_row['user_id']}: {e}")
-
-                        notified_tournaments.add(tournament['id'])
-                        print(f"[TOURNAMENT_START] Sent start notifications for tournament {tournament['id']} to {sent_count} users")
-                    except Exception as e:
-                        print(f"[TOURNAMENT_START] Failed to send notifications for tournament {tournament['id']}: {e}")
+            # Соединение уже вернулось в пул: задание рассылки само читает получателей
+            # страницами и отправляет их под общим лимитом
+            for tournament_id, job_id in started_jobs:
+                start_broadcast_job(job_id)
+                print(f"[TOURNAMENT_START] Started broadcast job {job_id} for tournament {tournament_id}")
 
         except Exception as e:
             print(f"[TOURNAMENT_START] Error in start notifications: {e}")
@@ -4192,6 +6004,15 @@ async def start_health_check():
 
         app = web.Application()
         app.router.add_route('GET', '/', lambda r: web.Response(text='Bot is running'))
+        app.router.add_route('GET', '/metrics', lambda r: web.json_response({
+            'db_pool': pool_metrics.snapshot(),
+            'action_log': action_log_writer.snapshot(),
+            'button_dedup': button_dedup.snapshot(),
+            'sessions': session_counters.snapshot(),
+            'state_cache': state_cache.snapshot(),
+            'outbox': outbox_dispatcher.snapshot(),
+            'prepared': prepared_snapshot(),
+        }))
 
         runner = web.AppRunner(app)
         await runner.setup()
@@ -4233,7 +6054,17 @@ async def main():
         asyncio.create_task(tournament_auto_finish())
         asyncio.create_task(tournament_start_notifications())
         asyncio.create_task(cleanup_task())
+        asyncio.create_task(broadcast_jobs_watchdog())
         asyncio.create_task(start_health_check())
+        asyncio.create_task(rollup_task())
+        asyncio.create_task(backfill_action_logs())
+        action_log_writer.start()
+        jackpot.start()
+        session_counters.start()
+        state_cache.start()
+        outbox_dispatcher.start()
+        if DB_POOL_ADAPTIVE:
+            asyncio.create_task(pool_autoscale_task())
         print("[BOT] Background tasks started")
 
         # Регистрация обработчиков команд
@@ -4264,6 +6095,12 @@ async def main():
     except Exception as e:
         print(f"Ошибка при запуске бота: {e}")
     finally:
+        await stop_broadcast_jobs()
+        await outbox_dispatcher.stop()
+        await session_counters.stop()
+        await state_cache.stop()
+        await jackpot.stop()
+        await action_log_writer.stop()
         await close_db_pool()
         await bot.session.close()
 
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# main.py читает конфигурацию при импорте; для тестов без БД хватает заглушек
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+os.environ.setdefault('DATABASE_URL', os.getenv('TEST_DATABASE_URL', 'postgresql://localhost/test'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
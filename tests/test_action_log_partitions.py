@@ -0,0 +1,94 @@
+import asyncio
+import os
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(
+    not os.getenv('TEST_DATABASE_URL'),
+    reason="нужна тестовая БД PostgreSQL в TEST_DATABASE_URL"
+)
+
+USER_ID = 9_500_000_001
+
+
+def run_with_db(scenario):
+    async def wrapper():
+        await main.init_db_pool()
+        try:
+            async with main.acquire_conn() as conn:
+                await conn.execute('DELETE FROM action_logs WHERE user_id = $1', USER_ID)
+            return await scenario()
+        finally:
+            async with main.acquire_conn() as conn:
+                await conn.execute('DELETE FROM action_logs WHERE user_id = $1', USER_ID)
+                await conn.execute(f'CREATE OR REPLACE VIEW action_log_history AS SELECT {main.ACTION_LOG_COLUMNS} FROM action_logs')
+                await conn.execute('DROP TABLE IF EXISTS action_logs_legacy')
+            await main.close_db_pool()
+            await main.bot.session.close()
+
+    return asyncio.run(wrapper())
+
+
+def test_rows_past_the_last_partition_land_in_default_and_move_with_it():
+    async def scenario():
+        async with main.acquire_conn() as conn:
+            month = await conn.fetchval("SELECT date_trunc('month', LOCALTIMESTAMP + INTERVAL '5 years')")
+            name = main.action_log_partition_name(month)
+            await conn.execute(f'DROP TABLE IF EXISTS {name}')
+            await conn.execute(
+                'INSERT INTO action_logs (user_id, action_type, created_at) VALUES ($1, $2, $3)',
+                USER_ID, 'test', month
+            )
+            in_default = await conn.fetchval('SELECT COUNT(*) FROM action_logs_default WHERE user_id = $1', USER_ID)
+            await main.create_action_log_partition(conn, month)
+            moved = await conn.fetchval(f'SELECT COUNT(*) FROM {name} WHERE user_id = $1', USER_ID)
+            expired = await main.apply_action_log_retention(conn)
+            await conn.execute('DELETE FROM action_logs WHERE user_id = $1', USER_ID)
+            await conn.execute(f'DROP TABLE {name}')
+        return in_default, moved, expired
+
+    in_default, moved, expired = run_with_db(scenario)
+
+    assert in_default == 1
+    assert moved == 1
+    assert 'action_logs_default' not in expired
+
+
+def test_backfill_moves_legacy_rows_and_drops_the_table(monkeypatch):
+    monkeypatch.setattr(main, 'ACTION_LOG_BACKFILL_BATCH', 2)
+    monkeypatch.setattr(main, 'ACTION_LOG_BACKFILL_PAUSE_MS', 0)
+
+    async def scenario():
+        async with main.acquire_conn() as conn:
+            # Состояние сразу после миграции 7: старые строки ещё в action_logs_legacy
+            await conn.execute(
+                '''CREATE TABLE action_logs_legacy (
+                    id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, action_type TEXT NOT NULL,
+                    amount DECIMAL(10, 2) DEFAULT 0, details JSONB, created_at TIMESTAMP DEFAULT NOW()
+                )'''
+            )
+            await conn.execute(
+                '''INSERT INTO action_logs_legacy (id, user_id, action_type, created_at)
+                   SELECT -g, $1, 'test', LOCALTIMESTAMP - g * INTERVAL '1 month' FROM generate_series(1, 5) g''',
+                USER_ID
+            )
+            await conn.execute(
+                f'''CREATE OR REPLACE VIEW action_log_history AS
+                    SELECT {main.ACTION_LOG_COLUMNS} FROM action_logs
+                    UNION ALL SELECT {main.ACTION_LOG_COLUMNS} FROM action_logs_legacy'''
+            )
+            before = await conn.fetchval('SELECT COUNT(*) FROM action_log_history WHERE user_id = $1', USER_ID)
+        await main.backfill_action_logs()
+        async with main.acquire_conn() as conn:
+            legacy = await conn.fetchval("SELECT to_regclass('action_logs_legacy')")
+            after = await conn.fetchval('SELECT COUNT(*) FROM action_log_history WHERE user_id = $1', USER_ID)
+            moved = await conn.fetchval('SELECT COUNT(*) FROM action_logs WHERE user_id = $1', USER_ID)
+        return before, legacy, after, moved
+
+    before, legacy, after, moved = run_with_db(scenario)
+
+    assert before == 5
+    assert legacy is None
+    assert after == moved == 5
@@ -0,0 +1,288 @@
+import asyncio
+import contextlib
+
+import main
+
+
+class SlowConnection:
+    """Соединение-заглушка: каждый запрос занимает delay секунд и запоминается"""
+
+    def __init__(self, delay: float = 0.0, sessions: dict = None):
+        self.delay = delay
+        self.calls = []
+        self.sessions = sessions if sessions is not None else {}
+
+    def get_server_pid(self):
+        return 1
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def record(self, method, *args):
+        await asyncio.sleep(self.delay)
+        self.calls.append((method, args))
+
+    async def copy_records_to_table(self, table, records, columns):
+        await self.record('copy', list(records))
+
+    async def execute(self, sql, *args):
+        await self.record('execute', sql, *args)
+
+    async def executemany(self, sql, args):
+        await self.record('executemany', sql, list(args))
+
+    async def fetch(self, sql, user_ids, deltas):
+        # upsert flush_user_sessions: коммит случается в середине задержки
+        await asyncio.sleep(self.delay / 2)
+        for user_id, delta in zip(user_ids, deltas):
+            self.sessions[user_id] = self.sessions.get(user_id, 0) + delta
+        await self.record('fetch', list(user_ids), list(deltas))
+        return [{'user_id': user_id, 'session_count': self.sessions[user_id]} for user_id in user_ids]
+
+
+async def run_prepared(conn, name, method, *args):
+    """run_prepared для заглушки: запрос из реестра идёт прямым вызовом метода соединения"""
+    return await getattr(conn, method)(main.PREPARED[name], *args)
+
+
+def use_connection(monkeypatch, conn):
+    @contextlib.asynccontextmanager
+    async def acquire_conn():
+        yield conn
+
+    monkeypatch.setattr(main, 'acquire_conn', acquire_conn)
+    monkeypatch.setattr(main, 'run_prepared', run_prepared)
+    monkeypatch.setattr(main, 'db_pool', object())
+
+
+def test_action_log_stop_waits_for_flush_in_progress(monkeypatch):
+    conn = SlowConnection(delay=0.2)
+    use_connection(monkeypatch, conn)
+
+    async def scenario():
+        writer = main.ActionLogWriter(flush_ms=10, batch_size=500, max_buffer=1000)
+        writer.start()
+        for i in range(5):
+            writer.add(i, 'casino_bet', 1)
+        await asyncio.sleep(0.05)  # сброс уже идёт и держит пачку вне буфера
+        writer.add(99, 'casino_bet', 1)
+        await writer.stop()
+        return writer
+
+    writer = asyncio.run(scenario())
+    copied = [record[0] for method, (records,) in conn.calls for record in records]
+    assert sorted(copied) == [0, 1, 2, 3, 4, 99]
+    assert writer.written == 6
+    assert not writer.buffer
+
+
+def test_action_log_batch_is_requeued_when_flush_is_cancelled(monkeypatch):
+    use_connection(monkeypatch, SlowConnection(delay=1))
+
+    async def scenario():
+        writer = main.ActionLogWriter(flush_ms=10, batch_size=500, max_buffer=1000)
+        writer.add(1, 'casino_bet', 1)
+        task = asyncio.create_task(writer.flush())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        return writer
+
+    writer = asyncio.run(scenario())
+    assert [record[0] for record in writer.buffer] == [1]
+
+
+def test_session_stop_waits_for_flush_in_progress(monkeypatch):
+    conn = SlowConnection(delay=0.2)
+    use_connection(monkeypatch, conn)
+
+    async def scenario():
+        counters = main.SessionCounters(flush_seconds=0.01)
+        counters.start()
+        counters.increment(1)
+        counters.increment(1)
+        await asyncio.sleep(0.05)
+        counters.increment(2)
+        await counters.stop()
+        return counters
+
+    counters = asyncio.run(scenario())
+    assert conn.sessions == {1: 2, 2: 1}
+    assert not counters.pending and not counters.flushing
+
+
+def test_session_increments_are_requeued_when_flush_is_cancelled(monkeypatch):
+    use_connection(monkeypatch, SlowConnection(delay=1))
+
+    async def scenario():
+        counters = main.SessionCounters(flush_seconds=60)
+        counters.increment(1)
+        task = asyncio.create_task(counters.flush())
+        await asyncio.sleep(0.05)
+        counters.increment(1)
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        return counters
+
+    counters = asyncio.run(scenario())
+    assert counters.pending == {1: 2}
+    assert not counters.flushing
+
+
+def test_session_read_during_flush_is_not_double_counted(monkeypatch):
+    conn = SlowConnection(delay=0.2, sessions={1: 5})
+    use_connection(monkeypatch, conn)
+
+    async def scenario():
+        counters = main.SessionCounters(flush_seconds=60)
+        for _ in range(3):
+            counters.increment(1)
+        flush = asyncio.create_task(counters.flush())
+        await asyncio.sleep(0.15)  # upsert уже закоммичен, но сброс ещё не завершился
+        db_count = conn.sessions[1]
+        counters.increment(1)
+        current = await counters.current(1, db_count)
+        stale = await counters.current(1, 5)  # значение, прочитанное до коммита
+        await flush
+        return current, stale
+
+    current, stale = asyncio.run(scenario())
+    assert current == 9
+    assert stale == 9
+
+
+def test_state_read_during_flush_does_not_revive_cleared_state(monkeypatch):
+    use_connection(monkeypatch, SlowConnection(delay=0.2))
+
+    async def scenario():
+        cache = main.StateCache(ttl=60, max_entries=100, max_bytes=10**6, flush_seconds=60)
+        cache.stored(7, 'awaiting_promo')
+        cache.set(7, None)
+        flush = asyncio.create_task(cache.flush())
+        await asyncio.sleep(0.05)
+        # Строка из БД прочитана, пока DELETE ещё не закоммичен
+        during = cache.stored(7, 'awaiting_promo')
+        await flush
+        after = cache.stored(7, 'awaiting_promo')
+        cache.set(7, 'awaiting_promo')
+        return cache, during, after
+
+    cache, during, after = asyncio.run(scenario())
+    assert during is None
+    assert after is None
+    assert cache.dirty == {7: ('awaiting_promo', 'awaiting_promo')}
+
+
+def test_state_stop_waits_for_flush_in_progress(monkeypatch):
+    conn = SlowConnection(delay=0.2)
+    use_connection(monkeypatch, conn)
+
+    async def scenario():
+        cache = main.StateCache(ttl=60, max_entries=100, max_bytes=10**6, flush_seconds=0.01)
+        cache.start()
+        cache.set(1, {'state': 'awaiting_dice_bet'})
+        await asyncio.sleep(0.05)
+        cache.set(2, None)
+        await cache.stop()
+        return cache
+
+    cache = asyncio.run(scenario())
+    methods = [method for method, _ in conn.calls]
+    assert methods == ['executemany', 'execute']
+    assert not cache.dirty and not cache.flushing
+
+
+def test_state_changes_are_requeued_when_flush_is_cancelled(monkeypatch):
+    use_connection(monkeypatch, SlowConnection(delay=1))
+
+    async def scenario():
+        cache = main.StateCache(ttl=60, max_entries=100, max_bytes=10**6, flush_seconds=60)
+        cache.set(1, 'awaiting_support')
+        task = asyncio.create_task(cache.flush())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        return cache
+
+    cache = asyncio.run(scenario())
+    assert cache.dirty == {1: ('awaiting_support', 'awaiting_support')}
+    assert not cache.flushing
+
+
+def test_jackpot_stop_waits_for_flush_in_progress(monkeypatch):
+    conn = SlowConnection(delay=0.2)
+    use_connection(monkeypatch, conn)
+
+    async def scenario():
+        pot = main.JackpotAccumulator(flush_seconds=0.01, cache_ttl=60)
+        pot.start()
+        pot.add(0.02)
+        await asyncio.sleep(0.05)
+        pot.add(0.03)
+        await pot.stop()
+        return pot
+
+    pot = asyncio.run(scenario())
+    flushed = [args[1] for method, args in conn.calls if method == 'execute']
+    assert sum(flushed) == main.Decimal('0.05')
+    assert not pot.pending
+
+
+def test_jackpot_increment_is_requeued_when_flush_is_cancelled(monkeypatch):
+    use_connection(monkeypatch, SlowConnection(delay=1))
+
+    async def scenario():
+        pot = main.JackpotAccumulator(flush_seconds=60, cache_ttl=60)
+        pot.add(0.02)
+        task = asyncio.create_task(pot.flush())
+        await asyncio.sleep(0.05)
+        pot.add(0.03)
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        return pot
+
+    pot = asyncio.run(scenario())
+    assert pot.pending == main.Decimal('0.05')
+
+
+class OneConnectionPool:
+    """Заглушка pool_metrics на одно соединение"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.free = asyncio.Semaphore(1)
+
+    async def checkout(self):
+        await self.free.acquire()
+        return self.conn
+
+    async def checkin(self, conn):
+        self.free.release()
+
+
+def test_session_read_during_flush_does_not_hold_the_request_connection(monkeypatch):
+    conn = SlowConnection(delay=0.1, sessions={1: 5})
+    monkeypatch.setattr(main, 'pool_metrics', OneConnectionPool(conn))
+    monkeypatch.setattr(main, 'run_prepared', run_prepared)
+
+    async def update():
+        counters = main.SessionCounters(flush_seconds=60)
+        counters.increment(1)
+        main.request_scope.set(main.RequestScope())
+        async with main.acquire_conn():
+            pass  # апдейт держит единственное соединение пула
+        flush = asyncio.create_task(counters.flush())
+        await asyncio.sleep(0.01)  # сброс забрал приросты и ждёт соединения
+        current = await counters.current(1, 5)
+        await flush
+        return current
+
+    async def scenario():
+        return await asyncio.wait_for(update(), timeout=2)
+
+    assert asyncio.run(scenario()) == 6
@@ -0,0 +1,97 @@
+import asyncio
+import os
+from decimal import Decimal
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(
+    not os.getenv('TEST_DATABASE_URL'),
+    reason="нужна тестовая БД PostgreSQL в TEST_DATABASE_URL"
+)
+
+USER_ID = 9_400_000_001
+
+
+def run_with_user(balance, scenario):
+    async def wrapper():
+        await main.init_db_pool()
+        try:
+            async with main.acquire_conn() as conn:
+                await reset(conn)
+                await conn.execute(
+                    'INSERT INTO users (user_id, name, balance) VALUES ($1, $2, $3)',
+                    USER_ID, 'bet test', Decimal(balance)
+                )
+            return await scenario()
+        finally:
+            async with main.acquire_conn() as conn:
+                await reset(conn)
+            await main.close_db_pool()
+            await main.bot.session.close()
+
+    return asyncio.run(wrapper())
+
+
+async def reset(conn):
+    for table in ('action_logs', 'user_game_totals', 'users'):
+        await conn.execute(f'DELETE FROM {table} WHERE user_id = $1', USER_ID)
+
+
+async def balance_and_logs():
+    async with main.acquire_conn() as conn:
+        balance = await conn.fetchval('SELECT balance FROM users WHERE user_id = $1', USER_ID)
+        logs = await conn.fetch(
+            'SELECT action_type, amount FROM action_logs WHERE user_id = $1 ORDER BY id', USER_ID
+        )
+    return float(balance), [(row['action_type'], float(row['amount'])) for row in logs]
+
+
+def test_stake_is_debited_before_the_roll():
+    async def scenario():
+        async def roll():
+            return await balance_and_logs()
+
+        during = await main.roll_for_bet(USER_ID, 'basket', 5, roll)
+        after = await main.settle_reserved_bet(USER_ID, 'basket', 5, 10, 'win')
+        return during, after, await balance_and_logs()
+
+    during, after, (balance, logs) = run_with_user('10', scenario)
+
+    assert during == (5.0, [('casino_bet', 5.0)])
+    assert after == 15.0
+    assert logs == [('casino_bet', 5.0), ('casino_result', 10.0)]
+
+
+def test_failed_roll_refunds_the_stake():
+    async def scenario():
+        async def roll():
+            raise RuntimeError("send_dice failed")
+
+        with pytest.raises(RuntimeError):
+            await main.roll_for_bet(USER_ID, 'bowling', 5, roll)
+        return await balance_and_logs()
+
+    balance, logs = run_with_user('10', scenario)
+
+    assert balance == 10.0
+    assert logs == [('casino_bet', 5.0), ('casino_result', 5.0)]
+
+
+def test_roll_is_not_sent_without_enough_balance():
+    rolled = []
+
+    async def scenario():
+        async def roll():
+            rolled.append(True)
+
+        result = await main.roll_for_bet(USER_ID, 'dice', 5, roll)
+        return result, await balance_and_logs()
+
+    result, (balance, logs) = run_with_user('3', scenario)
+
+    assert result is None
+    assert rolled == []
+    assert balance == 3.0
+    assert logs == []
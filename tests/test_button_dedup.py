@@ -0,0 +1,52 @@
+import time
+
+import main
+
+
+def test_repeated_click_is_detected():
+    dedup = main.ButtonDedup(ttl=60, max_entries=100)
+    assert dedup.add((1, '1:10:0'))
+    assert not dedup.add((1, '1:10:0'))
+    assert dedup.add((1, '1:11:0'))
+    assert dedup.seen((1, '1:10:0'))
+
+
+def test_expired_click_is_accepted_again():
+    dedup = main.ButtonDedup(ttl=0.05, max_entries=100)
+    assert dedup.add((1, 'a'))
+    time.sleep(0.06)
+    assert not dedup.seen((1, 'a'))
+    assert dedup.add((1, 'a'))
+
+
+def test_oldest_entries_are_evicted_at_capacity():
+    dedup = main.ButtonDedup(ttl=60, max_entries=3)
+    for i in range(5):
+        dedup.add((i, 'x'))
+    assert len(dedup.entries) == 3
+    assert dedup.evicted == 2
+    assert not dedup.seen((0, 'x'))
+    assert dedup.seen((4, 'x'))
+
+
+def test_add_stays_constant_time_at_capacity():
+    # Установившийся режим: множество заполнено, каждое нажатие вытесняет самую старую запись
+    capacity = 200_000
+    dedup = main.ButtonDedup(ttl=3600, max_entries=capacity)
+    for i in range(capacity):
+        dedup.add((i, 'warm'))
+
+    timings = []
+    start = time.perf_counter()
+    for i in range(capacity):
+        click = time.perf_counter()
+        dedup.add((i, 'steady'))
+        timings.append(time.perf_counter() - click)
+    elapsed = time.perf_counter() - start
+
+    assert len(dedup.entries) == capacity
+    assert dedup.evicted == capacity
+    assert elapsed / capacity < 20e-6
+    # Редкие пересборки хэш-таблицы допустимы, но 99.9% нажатий - в пределах десятков микросекунд
+    timings.sort()
+    assert timings[int(len(timings) * 0.999)] < 100e-6
@@ -0,0 +1,119 @@
+import asyncio
+import os
+from decimal import Decimal
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(
+    not os.getenv('TEST_DATABASE_URL'),
+    reason="нужна тестовая БД PostgreSQL в TEST_DATABASE_URL"
+)
+
+SPINNERS = range(9_100_000_001, 9_100_000_031)
+REFERRER_OFFSET = 1000
+
+
+async def reset_users(conn):
+    user_ids = list(SPINNERS) + [u + REFERRER_OFFSET for u in SPINNERS]
+    await conn.execute('DELETE FROM referral_connections WHERE user_id = ANY($1::bigint[])', user_ids)
+    await conn.execute('DELETE FROM action_logs WHERE user_id = ANY($1::bigint[])', user_ids)
+    await conn.execute('DELETE FROM outbox WHERE chat_id = ANY($1::bigint[])', user_ids)
+    await conn.execute('DELETE FROM users WHERE user_id = ANY($1::bigint[])', user_ids)
+    return user_ids
+
+
+def test_concurrent_first_spins_do_not_starve_a_two_connection_pool(monkeypatch):
+    # Пул на 2 соединения: раньше каждый прокрут под FOR UPDATE брал ещё соединение для награды пригласителю
+    monkeypatch.setattr(main, 'pool_metrics', main.PoolMetrics(2, 2))
+    monkeypatch.setattr(main, 'DB_POOL_MIN', 1)
+
+    async def scenario():
+        await main.init_db_pool()
+        try:
+            async with main.acquire_conn() as conn:
+                user_ids = await reset_users(conn)
+                await conn.execute(
+                    'INSERT INTO users (user_id, name) SELECT u, $2 FROM unnest($1::bigint[]) u',
+                    user_ids, 'spin test'
+                )
+                await conn.executemany(
+                    'INSERT INTO referral_connections (user_id, referrer_id) VALUES ($1, $2)',
+                    [(u, u + REFERRER_OFFSET) for u in SPINNERS]
+                )
+
+            results = await asyncio.wait_for(
+                asyncio.gather(*(main.roll_fortune_wheel(u) for u in SPINNERS)), timeout=30
+            )
+            pending_jackpot = main.jackpot.pending
+            cooldown = await asyncio.wait_for(
+                asyncio.gather(*(main.roll_fortune_wheel(u) for u in SPINNERS)), timeout=30
+            )
+
+            async with main.acquire_conn() as conn:
+                credited = await conn.fetchval(
+                    '''SELECT COUNT(*) FROM users
+                       WHERE user_id = ANY($1::bigint[]) AND refs = 1 AND balance = 2''',
+                    [u + REFERRER_OFFSET for u in SPINNERS]
+                )
+                notifications = await conn.fetchval(
+                    'SELECT COUNT(*) FROM outbox WHERE chat_id = ANY($1::bigint[])',
+                    [u + REFERRER_OFFSET for u in SPINNERS]
+                )
+                await reset_users(conn)
+            return results, cooldown, pending_jackpot, credited, notifications
+        finally:
+            await main.close_db_pool()
+            await main.bot.session.close()
+
+    results, cooldown, pending_jackpot, credited, notifications = asyncio.run(scenario())
+
+    assert [error for _, error in results] == [None] * len(SPINNERS)
+    assert credited == len(SPINNERS)
+    assert notifications == len(SPINNERS)
+    assert main.pool_metrics.peak_in_use <= 2
+    # Повторные нажатия упираются в кулдаун и не пополняют джекпот
+    assert [error for _, error in cooldown] == ['cooldown'] * len(SPINNERS)
+    assert main.jackpot.pending == pending_jackpot
+    assert pending_jackpot >= Decimal('0.02') * len(SPINNERS) or any(r['is_jackpot'] for r, _ in results)
+
+
+def test_jackpot_increments_survive_a_rolled_back_spin(monkeypatch):
+    user_id = SPINNERS[0]
+    monkeypatch.setattr(main, 'jackpot', main.JackpotAccumulator(flush_seconds=60, cache_ttl=60))
+    main.jackpot.add(1)
+    # Выпадает джекпот, а запись jackpot_win падает уже после claim
+    monkeypatch.setattr(main.random, 'randint', lambda low, high: high)
+    run_prepared = main.run_prepared
+
+    async def failing_run_prepared(conn, name, method, *args):
+        if 'jackpot_win' in args:
+            raise RuntimeError("log failed")
+        return await run_prepared(conn, name, method, *args)
+
+    monkeypatch.setattr(main, 'run_prepared', failing_run_prepared)
+
+    async def scenario():
+        await main.init_db_pool()
+        try:
+            async with main.acquire_conn() as conn:
+                await reset_users(conn)
+                await conn.execute('INSERT INTO users (user_id, name) VALUES ($1, $2)', user_id, 'spin test')
+                pot_before = await conn.fetchval('SELECT amount FROM jackpot WHERE id = 1')
+            with pytest.raises(RuntimeError):
+                await main.roll_fortune_wheel(user_id)
+            async with main.acquire_conn() as conn:
+                pot_after = await conn.fetchval('SELECT amount FROM jackpot WHERE id = 1')
+                balance = await conn.fetchval('SELECT balance FROM users WHERE user_id = $1', user_id)
+                await reset_users(conn)
+            return pot_before, pot_after, balance
+        finally:
+            await main.close_db_pool()
+            await main.bot.session.close()
+
+    pot_before, pot_after, balance = asyncio.run(scenario())
+
+    assert pot_after == pot_before
+    assert balance == 0
+    assert main.jackpot.pending == Decimal('1')
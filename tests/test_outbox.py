@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(
+    not os.getenv('TEST_DATABASE_URL'),
+    reason="нужна тестовая БД PostgreSQL в TEST_DATABASE_URL"
+)
+
+CHAT_ID = 9_200_000_001
+
+
+def run_dispatch(monkeypatch, send_func):
+    """Ставит одно уведомление в пустой outbox, прогоняет одну пачку и возвращает строку и диспетчер"""
+    monkeypatch.setattr(main, 'make_broadcast_sender', lambda payload: send_func)
+    dispatcher = main.OutboxDispatcher(poll_seconds=1, batch_size=10, max_attempts=5)
+
+    async def scenario():
+        await main.init_db_pool()
+        try:
+            async with main.acquire_conn() as conn:
+                await conn.execute('DELETE FROM outbox')
+                await main.enqueue_notification(conn, CHAT_ID, 'test')
+            await dispatcher.dispatch()
+            async with main.acquire_conn() as conn:
+                row = await conn.fetchrow(
+                    'SELECT status, attempts, last_error FROM outbox WHERE chat_id = $1', CHAT_ID
+                )
+                await conn.execute('DELETE FROM outbox')
+            return row
+        finally:
+            await main.close_db_pool()
+            await main.bot.session.close()
+
+    return asyncio.run(scenario()), dispatcher
+
+
+def test_retry_keeps_the_error_text(monkeypatch):
+    async def send(chat_id):
+        raise RuntimeError("Bad Request: message text is empty")
+
+    row, dispatcher = run_dispatch(monkeypatch, send)
+
+    assert row['status'] == 'pending'
+    assert row['attempts'] == 1
+    assert row['last_error'] == "Bad Request: message text is empty"
+    assert dispatcher.retried == 1
+
+
+def test_result_is_not_written_after_another_replica_took_the_lease(monkeypatch):
+    async def send(chat_id):
+        # Пока шла отправка, аренда истекла и строку забрала другая реплика
+        async with main.acquire_conn() as conn:
+            await conn.execute(
+                "UPDATE outbox SET next_attempt_at = NOW() + INTERVAL '1 minute' WHERE chat_id = $1",
+                chat_id
+            )
+
+    row, dispatcher = run_dispatch(monkeypatch, send)
+
+    assert row['status'] == 'pending'
+    assert row['attempts'] == 0
+
+
+def test_nothing_is_sent_once_the_lease_runs_out(monkeypatch):
+    sent = []
+
+    async def send(chat_id):
+        sent.append(chat_id)
+
+    monkeypatch.setattr(main, 'OUTBOX_LEASE_SECONDS', 0)
+    row, dispatcher = run_dispatch(monkeypatch, send)
+
+    assert sent == []
+    assert row['status'] == 'pending'
+    assert row['attempts'] == 0
+    assert dispatcher.expired == 1
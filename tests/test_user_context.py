@@ -0,0 +1,104 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(
+    not os.getenv('TEST_DATABASE_URL'),
+    reason="нужна тестовая БД PostgreSQL в TEST_DATABASE_URL"
+)
+
+USER_ID = 9_300_000_001
+
+
+def run_with_db(scenario):
+    async def wrapper():
+        await main.init_db_pool()
+        try:
+            async with main.acquire_conn() as conn:
+                for table in ('used_buttons', 'user_sessions', 'user_states', 'users'):
+                    await conn.execute(f'DELETE FROM {table} WHERE user_id = $1', USER_ID)
+            return await scenario()
+        finally:
+            async with main.acquire_conn() as conn:
+                for table in ('used_buttons', 'user_sessions', 'user_states', 'users'):
+                    await conn.execute(f'DELETE FROM {table} WHERE user_id = $1', USER_ID)
+            await main.close_db_pool()
+            await main.bot.session.close()
+
+    return asyncio.run(wrapper())
+
+
+def test_db_button_key_uses_the_session_with_pending_increments(monkeypatch):
+    monkeypatch.setattr(main, 'BUTTON_DEDUP_DB', True)
+    monkeypatch.setattr(main, 'session_counters', main.SessionCounters(flush_seconds=60))
+    monkeypatch.setattr(main, 'button_dedup', main.ButtonDedup(ttl=60, max_entries=100))
+
+    async def scenario():
+        await main.load_user_context(USER_ID, 'ctx test')
+        main.session_counters.increment(USER_ID)
+        first = await main.load_user_context(USER_ID, 'ctx test', msg_id=5)
+        # Другая реплика: в памяти нажатия нет, есть только used_buttons
+        main.button_dedup.entries.clear()
+        repeat = await main.load_user_context(USER_ID, 'ctx test', msg_id=5)
+        async with main.acquire_conn() as conn:
+            keys = await conn.fetch('SELECT button_id FROM used_buttons WHERE user_id = $1', USER_ID)
+        return first, repeat, [row['button_id'] for row in keys]
+
+    first, repeat, keys = run_with_db(scenario)
+
+    assert first.session == 1
+    assert not first.button_used
+    assert repeat.button_used
+    assert keys == [f"{USER_ID}:5:1"]
+
+
+def test_loading_without_create_does_not_insert_the_user(monkeypatch):
+    monkeypatch.setattr(main, 'state_cache', main.StateCache(ttl=60, max_entries=100, max_bytes=10**6, flush_seconds=60))
+
+    async def scenario():
+        missing = await main.load_user_context(USER_ID, 'ctx test', create=False)
+        async with main.acquire_conn() as conn:
+            inserted = await conn.fetchval('SELECT COUNT(*) FROM users WHERE user_id = $1', USER_ID)
+        await main.load_user_context(USER_ID, 'ctx test')
+        async with main.acquire_conn() as conn:
+            await conn.execute(
+                '''INSERT INTO user_states (user_id, state_data, updated_at) VALUES ($1, $2, NOW())''',
+                USER_ID, '{"state": "awaiting_promo"}'
+            )
+        existing = await main.load_user_context(USER_ID, 'ctx test', create=False)
+        return missing, inserted, existing
+
+    missing, inserted, existing = run_with_db(scenario)
+
+    assert missing is None
+    assert inserted == 0
+    assert existing.user_id == USER_ID
+    assert not existing.created
+    assert existing.state == {'state': 'awaiting_promo'}
+
+
+def test_any_update_from_the_user_clears_the_unreachable_flag():
+    async def scenario():
+        await main.load_user_context(USER_ID, 'ctx test')
+        await main.mark_users_unreachable([USER_ID])
+
+        async def handler(event, data):
+            return 'handled'
+
+        event = SimpleNamespace(message=None, callback_query=object())
+        result = await main.request_scope_middleware(
+            handler, event, {'event_from_user': SimpleNamespace(id=USER_ID)}
+        )
+        async with main.acquire_conn() as conn:
+            row = await conn.fetchrow('SELECT reachable, unreachable_at FROM users WHERE user_id = $1', USER_ID)
+        return result, row
+
+    result, row = run_with_db(scenario)
+
+    assert result == 'handled'
+    assert row['reachable']
+    assert row['unreachable_at'] is None